@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+import asyncio
+import sys
+from CommunicationProtocols import AsyncCommunicationProtocol
+from Connections import ConnectionRegistry
+from Groups import Groups
+from KeyExchange import backends
+from KeyStore import KeyStore
+from Peer import BACKLOG, PEERLIST_REQ, Peer
+from Sessions import SessionCache
+from Shards import Shard
+from Workers import HandlerPool
+
+
+class AsyncClient(Peer):
+
+    def __init__(self, name: str, host: str, port: int, _debug: bool = False, framing: str = 'eom',
+                 cipher: str = 'cbc', curve: str = 'brainpoolP256r1', resumption: bool = False,
+                 session_ttl: float = 3600, key_directory: str = None,
+                 backlog: int = BACKLOG, handler_workers: int = 0, handler_queue: int = 1024,
+                 handler_policy: str = 'block', mux: bool = False, gossip_interval: float = 0.0,
+                 gossip_fanout: int = 3, compression: str = None, compression_threshold: int = 256,
+                 compression_dictionary: bytes = None, schema: bool = False, pipeline: bool = False,
+                 metrics: bool = False, metrics_endpoint=None, group: bool = False, discovery: bool = False,
+                 discovery_interval: float = 30.0, discovery_secret: bytes = None, reconnect_workers: int = 4,
+                 reconnect_base: float = 0.5, reconnect_cap: float = 60.0, handshake_workers: int = 16,
+                 handshake_timeout: float = 10.0, shard: Shard = None):
+        """
+        Initialise AsyncClient Object, a Peer running every connection on a single asyncio event loop.
+
+        :param name: Name of this Peer.
+        :param host: IP address of the server.
+        :param port: Port the peer is listening to.
+        :param _debug: If True prints debug information to the console; otherwise no debug information is printed.
+        :param framing: Framing offered on outgoing connections, 'eom' or 'binary'.
+        :param cipher: Cipher offered on outgoing connections, 'cbc', 'aes-gcm' or 'chacha20-poly1305'.
+        :param curve: Curve offered for the key exchange on outgoing connections, 'brainpoolP256r1' or 'P-256'.
+        :param resumption: If True outgoing connections offer to resume cached sessions instead of a full handshake.
+        :param session_ttl: Seconds a session can be resumed for.
+        :param key_directory: Directory the identity key and peer keys are saved in, None keeps them in memory.
+        :param backlog: Maximum number of queued incoming connections.
+        :param handler_workers: Threads running message handlers, 0 runs them on the event loop.
+        :param handler_queue: Maximum number of received messages waiting for a handler thread.
+        :param handler_policy: 'block' stops reading while the queue is full, 'drop' discards new messages.
+        :param mux: If True outgoing connections offer logical channels, requires an AEAD cipher.
+        :param gossip_interval: Seconds between gossip rounds exchanging only changed peer list entries,
+                                0 requests the full peer list from every known peer at start up instead.
+        :param gossip_fanout: Peers gossiped with per round.
+        :param compression: Compression offered on outgoing connections, 'zlib' or 'lzma', requires an AEAD cipher.
+        :param compression_threshold: Messages shorter than this many bytes are sent uncompressed.
+        :param compression_dictionary: Preset zlib dictionary shared with peers, improves ratios of short messages.
+        :param schema: If True outgoing connections offer binary messages of registered commands,
+                       requires an AEAD cipher.
+        :param pipeline: If True outgoing connections offer the pipelined handshake, messages are sent
+                         one round trip sooner.
+        :param metrics: If True records handler latency, handshake and encryption time and message counters.
+        :param metrics_endpoint: Port on 127.0.0.1 or Unix socket path serving stats as JSON, enables metrics.
+        :param group: If True outgoing connections offer group frames, see send_group.
+        :param discovery: If True announces this peer and learns other peers by UDP multicast on the LAN.
+        :param discovery_interval: Seconds between announcements.
+        :param discovery_secret: Shared key authenticating announcements, None accepts every peer on the LAN.
+        :param reconnect_workers: Connection attempts to supervised peers running at the same time.
+        :param reconnect_base: Seconds before the first attempt to reconnect to a supervised peer.
+        :param reconnect_cap: Largest number of seconds between attempts to reconnect to a supervised peer.
+        :param handshake_workers: Handshakes of incoming connections running at the same time,
+                                  the others wait for one to complete.
+        :param handshake_timeout: Seconds the handshake of an incoming connection may take.
+        :param shard: Shard of a ShardedServer this peer runs as a worker of, its identity is used instead of
+                      loading or generating one, see set_shard.
+        """
+        self.name = name
+        self.host = host
+        self.port = port
+        self._debug = _debug
+        self.framing = framing
+        self.cipher = cipher
+        self.curve = curve
+        self.resumption = resumption
+        self.mux = mux
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.compression_dictionary = compression_dictionary
+        self.schema = schema
+        self.pipeline = pipeline
+        self.group = group
+        self.groups = Groups()
+        self.sessions = SessionCache(ttl=session_ttl)
+        self.keystore = KeyStore(key_directory)
+        if shard is not None:
+            self.set_shard(shard)
+        else:
+            self.private_key, self.public_key = self.keystore.load_local_keys('{0}-'.format(name),
+                                                                              backends['brainpoolP256r1'])
+        self.register_builtins()
+        if handler_workers > 0:
+            self.handler_pool = HandlerPool(handler_workers, handler_queue, handler_policy, _debug=_debug)
+        self.backlog = backlog
+        self.handshake_workers = handshake_workers
+        self.handshake_timeout = handshake_timeout
+        self.handshake_slots: asyncio.Semaphore = None  # Created by serve, on the event loop
+
+        self.connections = ConnectionRegistry()
+        self.create_gossip(gossip_fanout, gossip_interval)
+        self.create_metrics(metrics, metrics_endpoint)
+        if discovery:
+            self.create_discovery(discovery_interval, discovery_secret)
+        self.create_supervisor(reconnect_workers, reconnect_base, reconnect_cap)
+        self.loop: asyncio.AbstractEventLoop = None
+        self.server: asyncio.AbstractServer = None
+        self._stopped: asyncio.Event = None
+
+    def _in_loop(self) -> bool:
+        """
+        Checks if the caller is running on the event loop thread.
+
+        :return: True if called from the event loop; False otherwise.
+        """
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def send_message(self, name: str, msg, channel: int = 0):
+        """
+        Sends message to peer by name, safe to call from any thread.
+
+        :param name: Name of peer to send message to.
+        :param msg: Message to be sent to the peer, text or a message created by a command of the schema.
+        :param channel: Channel to send on, lower channels are sent first when channels were negotiated.
+        """
+        if self._in_loop():
+            self._send_message(name, msg, channel)
+        elif self.loop is not None and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self._send_message, name, msg, channel)
+        else:
+            print('Peer {0} is not connected'.format(name))
+
+    def _send_message(self, name: str, msg: str, channel: int = 0, route: bool = True):
+        """
+        Sends message to peer by name, connecting first if the peer is known but not connected.
+
+        :param name: Name of peer to send message to.
+        :param msg: Message to be sent to the peer.
+        :param channel: Channel to send on.
+        :param route: If True a peer connected to another shard is sent to by that shard.
+        """
+        comm = self.connections.get(name)
+        if comm is not None:
+            comm.send_message(msg, channel)
+        elif route and self.shard is not None and self.shard.forward(name, msg, channel):
+            pass
+        elif self.connections.get_known_peer(name) is not None:
+            self.loop.create_task(self._connect_and_send(name, msg, channel))
+        else:
+            if self._debug:
+                print('UNKNOWN name {0}'.format(name))
+            print('Peer {0} is not connected'.format(name))
+
+    def deliver_message(self, name: str, msg, channel: int = 0):
+        if self.loop is not None and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self._send_message, name, msg, channel, False)
+
+    async def _connect_and_send(self, name: str, msg: str, channel: int = 0):
+        comm = await self.open_connection_async(*self.connections.get_known_peer(name))
+        if comm is not None:
+            comm.send_message(msg, channel)
+        else:
+            print('Peer {0} is not connected'.format(name))
+
+    def fan_out(self, names: list, send):
+        """
+        Calls send with the connection of every peer on the event loop, safe to call from any thread.
+        Writes do not block the loop, so peers are sent to one after the other without waiting for any.
+
+        :param names: Names of the peers.
+        :param send: Called with each connection.
+        """
+        if self._in_loop():
+            self._fan_out(names, send)
+        elif self.loop is not None and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self._fan_out, names, send)
+        else:
+            print('Peers {0} are not connected'.format(', '.join(names)))
+
+    def _fan_out(self, names: list, send):
+        for name in names:
+            comm = self.connections.get(name)
+            if comm is not None:
+                send(comm)
+            elif self.connections.get_known_peer(name) is not None:
+                self.loop.create_task(self._connect_and_fan_out(name, send))
+            else:
+                print('Peer {0} is not connected'.format(name))
+
+    async def _connect_and_fan_out(self, name: str, send):
+        comm = await self.open_connection_async(*self.connections.get_known_peer(name))
+        if comm is not None:
+            send(comm)
+        else:
+            print('Peer {0} is not connected'.format(name))
+
+    def send_stream(self, name: str, source, stream_name: str = '', channel: int = 1, chunk_size: int = None) -> int:
+        """
+        Streams a file or other large payload to a peer by name, blocks until it is sent.
+        Must not be called from the event loop, use send_stream_async there.
+
+        :param name: Name of peer to stream to.
+        :param source: File path, binary file object, bytes-like object or iterable of bytes-like objects.
+        :param stream_name: Name of the stream, passed to the peers stream handler.
+        :param channel: Channel to stream on, one stream per channel at a time.
+        :param chunk_size: Bytes per chunk, the fragment size of the channels if None.
+        :return: Number of bytes streamed.
+        """
+        if self._in_loop():
+            raise Exception('send_stream blocks, use send_stream_async on the event loop.')
+        if self.loop is None or not self.loop.is_running():
+            raise Exception('Peer {0} is not connected'.format(name))
+        return asyncio.run_coroutine_threadsafe(self.send_stream_async(name, source, stream_name, channel,
+                                                                       chunk_size), self.loop).result()
+
+    async def send_stream_async(self, name: str, source, stream_name: str = '', channel: int = 1,
+                                chunk_size: int = None) -> int:
+        """
+        Streams a file or other large payload to a peer by name, see send_stream.
+
+        :return: Number of bytes streamed.
+        """
+        comm = self.connections.get(name)
+        if comm is None and self.connections.get_known_peer(name) is not None:
+            comm = await self.open_connection_async(*self.connections.get_known_peer(name))
+        if comm is None:
+            raise Exception('Peer {0} is not connected'.format(name))
+        return await comm.send_stream(source, stream_name, channel, chunk_size)
+
+    def open_connection(self, ip: str, port: int):
+        """
+        Open connection to the server. Blocks until the handshake completes when called from another thread,
+        schedules the connection when called from the event loop.
+
+        :param ip: IP address to open a connection to.
+        :param port: Port to open a connection on.
+        """
+        if self._in_loop():
+            self.loop.create_task(self.open_connection_async(ip, port))
+        elif self.loop is not None and self.loop.is_running():
+            asyncio.run_coroutine_threadsafe(self.open_connection_async(ip, port), self.loop).result()
+
+    async def open_connection_async(self, ip: str, port: int) -> AsyncCommunicationProtocol:
+        """
+        Open connection to the server, unless one is already open or being opened.
+
+        :param ip: IP address to open a connection to.
+        :param port: Port to open a connection on.
+        :return: The connection, None if it could not be opened.
+        """
+        try:
+            return await self.connections.get_or_connect_async((ip, port), lambda: self._connect(ip, port),
+                                                               on_connected=self._connected)
+        except ConnectionRefusedError:
+            if self._debug:
+                print('[FAILED] Unable to connect to \'{0}:{1}\''.format(ip, port))
+            return None
+
+    async def _connect(self, ip: str, port: int) -> AsyncCommunicationProtocol:
+        reader, writer = await asyncio.open_connection(ip, port)
+        try:
+            comm = AsyncCommunicationProtocol(reader, writer, (ip, port), self.name,
+                                              **self.connection_options((ip, port)))
+            await comm.establish_encrypted_connection_cs()
+        except BaseException:
+            writer.close()
+            raise
+        return comm
+
+    def _connected(self, comm: AsyncCommunicationProtocol):
+        self.loop.create_task(self.connection_listener(comm))
+        self.add_peer(comm.get_peer_name(), *comm.get_address())
+        self.connection_opened(comm)
+
+    async def connection_listener(self, comm: AsyncCommunicationProtocol):
+        """
+        Receive loop for a single connection, dispatches every message to the message handler.
+        A message the peer sent that cannot be read, or a handler failing on it, closes the connection.
+
+        :param comm: AsyncCommunicationProtocol object representing the connection to the peer.
+        """
+        try:
+            while comm.is_open() and self.running:
+                messages = await comm.receive_message()
+                for message in messages:
+                    call = self.received_handler(comm.get_peer_name(), message)
+                    if call is None:
+                        continue
+                    handler, args = call
+                    if self.handler_pool is None:
+                        handler(*args)
+                    elif not self.handler_pool.offer(comm.get_peer_name(), handler, *args):
+                        # Queue full, apply the policy off the loop
+                        await self.loop.run_in_executor(None, self.handler_pool.submit, comm.get_peer_name(),
+                                                        handler, *args)
+        except Exception as e:
+            print('[ERROR] Connection {0}@{1}:{2} {3}'.format(comm.get_peer_name(), *comm.get_address()[:2], e))
+        finally:
+            comm.close_connection()
+            self.connection_closed(comm)
+
+    async def incoming_connection_handler(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Called for every new incoming connection, runs the handshake then the receive loop.
+
+        :param reader: StreamReader of the new connection.
+        :param writer: StreamWriter of the new connection.
+        """
+        handshakes = self.metrics.handshakes if self.metrics is not None else None
+        async with self.handshake_slots:
+            started = handshakes.begin() if handshakes is not None else 0.0
+            error = None
+            try:
+                comm = AsyncCommunicationProtocol(reader, writer, writer.get_extra_info('peername')[:2], self.name,
+                                                  **self.connection_options())
+                await asyncio.wait_for(comm.establish_encrypted_connection_ss(), self.handshake_timeout)
+                self.connections.add(comm)
+                self.connection_opened(comm)
+            except Exception as e:
+                error = e
+            if handshakes is not None:
+                handshakes.end(started, error)
+        if error is not None:
+            print(str(error))
+            writer.close()
+            return
+
+        await self.connection_listener(comm)
+
+    async def serve(self):
+        """
+        Binds the listening socket and runs until the peer is stopped.
+        """
+        self.loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        self.handshake_slots = asyncio.Semaphore(self.handshake_workers)
+
+        while self.server is None:
+            try:
+                self.server = await asyncio.start_server(self.incoming_connection_handler, host=self.host or None,
+                                                         port=self.port, reuse_address=True, backlog=self.backlog,
+                                                         reuse_port=self.shard is not None)
+                if self._debug:
+                    print('[AVAILABLE] \'{0}:{1}\''.format(self.host, self.port))
+
+            except OSError as e:
+                print(str(e))
+                if self._debug:
+                    print('[UNAVAILABLE] \'{0}:{1}\' RETRYING in 1 second'.format(self.host, self.port))
+                await asyncio.sleep(1)
+
+        self.running = True
+        self.stopped.clear()
+        self.started.set()
+        self.start_metrics_server()
+        self.start_discovery()
+        self.supervisor.start()
+        if self.shard is not None:
+            self.shard.start(self.deliver_message)
+        self.loop.create_task(self.request_known_peers())
+        await self._stopped.wait()
+
+    def start(self):
+        """
+        Runs the event loop on the calling thread until the peer is stopped.
+        """
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt as interrupt:
+            print()
+            self.stop()
+            sys.exit(interrupt)
+
+    def stop(self):
+        """
+        Stops the peer safely, safe to call from any thread.
+        """
+        self.supervisor.stop()
+        self.running = False
+        if self.handler_pool is not None:
+            self.handler_pool.close()
+        self.gossip.stop()
+        self.stop_metrics_server()
+        if self.discovery is not None:
+            self.discovery.stop()
+        if self.shard is not None:
+            self.shard.stop()
+        if self._in_loop():
+            self._stop()
+        elif self.loop is not None and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self._stop)
+        self.started.clear()
+        self.stopped.set()
+        if self._debug:
+            print('Stopped peer.')
+
+    def _stop(self):
+        for comm in self.connections.values():
+            comm.close_connection()
+        if self.server is not None:
+            self.server.close()
+        self._stopped.set()
+
+    def close_connection(self):
+        """
+        Closes connection to the server.
+        """
+        self.comm.close_connection()
+
+    async def request_known_peers(self):
+        if self.gossip_interval > 0:
+            self.gossip.run_round()
+            self.gossip.start()  # Rounds run on a thread, send_message hands them to the loop
+            return
+
+        for peer in self.connections.known_peers():
+            self._send_message(peer, PEERLIST_REQ())
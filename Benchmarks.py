@@ -0,0 +1,1063 @@
+#!/usr/bin/env python3
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import random
+import socket
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import KeyExchange
+from AsyncPeer import AsyncClient
+import Compression
+from CryptoPool import CryptoPool
+from CommunicationProtocols import BinaryFraming, CommunicationProtocol, EncryptionProtocol
+from Gossip import Gossip
+from Groups import GroupKey
+from Modules import MONITORCAMERA, TIME_ALARM, TIME_TIMER, PeerModule
+from Peer import PEERLIST_UPD, Client
+from Scheduler import Scheduler
+from Schema import SCHEMA
+
+ENGINES = {'threaded': Client, 'asyncio': AsyncClient}
+
+
+def read_proc_status(pid: int) -> dict:
+    """
+    Reads memory and thread usage of a process from /proc.
+
+    :param pid: Process id to inspect.
+    :return: Dictionary of {'rss_kb': int, 'threads': int}, empty if /proc is unavailable.
+    """
+    status = {}
+    try:
+        with open('/proc/{0}/status'.format(pid)) as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    status['rss_kb'] = int(line.split()[1])
+                elif line.startswith('Threads:'):
+                    status['threads'] = int(line.split()[1])
+    except OSError:
+        pass
+    return status
+
+
+def wait_for_port(port: int, timeout: float = 10.0):
+    """
+    Blocks until something accepts connections on localhost:port.
+
+    :param port: Port to poll.
+    :param timeout: Seconds to wait before giving up.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError('Nothing listening on port {0}'.format(port))
+
+
+def _run_peer(engine: str, name: str, port: int, options: dict = None):
+    peer = ENGINES[engine](name, '', port, **(options or {}))
+    peer.set_message_handler(peer.dispatch_message)
+    peer.start()
+
+
+def _run_echo_peer(engine: str, name: str, port: int):
+    peer = ENGINES[engine](name, '', port)
+    peer.register_handler('BENCH', lambda sender, message: peer.send_message(sender, message) or True)
+    peer.set_message_handler(peer.dispatch_message)
+    peer.start()
+
+
+def _receive(comm: CommunicationProtocol, expected: int, received: list):
+    """
+    Receives until expected messages arrived or the connection closed, appending the time of each to received.
+    """
+    while len(received) < expected and comm.is_open():
+        for _ in comm.receive_message():
+            received.append(time.perf_counter())
+
+
+def bench_suite(engine: str, peers: int, port: int, connections: int, messages: int, size: int, pings: int,
+                workers: int, cipher: str) -> dict:
+    """
+    Measures a group of peers on localhost, each in its own process and echoing every BENCH message:
+    handshakes per second and memory per connection, ping latency, throughput to one peer and fanned out to all.
+    Throughput counts a message once its echo is back, so both directions are included.
+
+    :param engine: Name of the engine in ENGINES the peers run.
+    :param peers: Number of peer processes, listening on port, port + 1, ...
+    :param port: Port of the first peer.
+    :param connections: Number of connections opened for the handshake rate, spread over the peers.
+    :param messages: Messages sent to each peer for the throughput measurements.
+    :param size: Bytes per message.
+    :param pings: Round trips timed one at a time for the latency.
+    :param workers: Number of threads opening connections concurrently.
+    :param cipher: Cipher offered by the connections.
+    :return: Dictionary of results.
+    """
+    processes = [multiprocessing.Process(target=_run_echo_peer, args=(engine, 'bench-peer-{0}'.format(i), port + i),
+                                         daemon=True) for i in range(peers)]
+    for process in processes:
+        process.start()
+    comms = []
+    try:
+        for i in range(peers):
+            wait_for_port(port + i)
+        time.sleep(0.5)
+        before = [read_proc_status(process.pid).get('rss_kb', 0) for process in processes]
+
+        private_key, public_key = CommunicationProtocol.generate_keys()
+
+        def connect(i):
+            sock = socket.create_connection(('127.0.0.1', port + i % peers))
+            comm = CommunicationProtocol(sock, ('127.0.0.1', port + i % peers), 'bench-{0}'.format(i),
+                                         private_key=private_key, public_key=public_key, cipher=cipher)
+            comm.establish_encrypted_connection_cs()
+            return comm
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            comms = list(pool.map(connect, range(max(connections, peers))))
+        handshake_seconds = time.perf_counter() - start
+        time.sleep(0.5)
+        after = [read_proc_status(process.pid).get('rss_kb', 0) for process in processes]
+
+        message = 'BENCH-' + 'x' * max(0, size - 6)
+        latencies = []
+        for _ in range(pings):
+            start = time.perf_counter()
+            comms[0].send_message(message)
+            received = []
+            _receive(comms[0], 1, received)
+            latencies.append(received[0] - start)
+        latencies.sort()
+
+        def throughput(targets: list) -> tuple:
+            receivers = []
+            for comm in targets:
+                received = []
+                thread = threading.Thread(target=_receive, args=(comm, messages, received), daemon=True)
+                thread.start()
+                receivers.append((thread, received))
+            start_ = time.perf_counter()
+            for _ in range(messages):
+                for comm in targets:
+                    comm.send_message(message)
+            for thread, received in receivers:
+                thread.join(timeout=60)
+            done = [received[-1] for thread, received in receivers if received]
+            total = sum(len(received) for thread, received in receivers)
+            return total, (max(done) - start_) if done else float('inf')
+
+        one_count, one_seconds = throughput(comms[:1])
+        fan_count, fan_seconds = throughput(comms[:peers])
+    finally:
+        for comm in comms:
+            comm.close_connection()
+        for process in processes:
+            process.terminate()
+            process.join()
+
+    return {'engine': engine, 'peers': peers, 'connections': len(comms), 'size': size, 'cipher': cipher,
+            'handshakes_per_second': len(comms) / handshake_seconds,
+            'rss_kb_per_connection': (sum(after) - sum(before)) / len(comms),
+            'latency_p50_ms': latencies[len(latencies) // 2] * 1000,
+            'latency_p99_ms': latencies[int(0.99 * (len(latencies) - 1))] * 1000,
+            'one_to_one_messages_per_second': one_count / one_seconds,
+            'one_to_one_lost': messages - one_count,
+            'fanout_messages_per_second': fan_count / fan_seconds,
+            'fanout_lost': messages * peers - fan_count}
+
+
+def bench_engine(engine: str, connections: int, port: int, workers: int) -> dict:
+    """
+    Measures connections per second and memory per connection of a listening peer.
+    The peer runs in its own process, connections are opened from a thread pool in this process.
+
+    :param engine: Name of the engine in ENGINES to benchmark.
+    :param connections: Number of connections to open.
+    :param port: Port the peer listens on.
+    :param workers: Number of threads opening connections concurrently.
+    :return: Dictionary of results.
+    """
+    server = multiprocessing.Process(target=_run_peer, args=(engine, 'bench-server', port), daemon=True)
+    server.start()
+    try:
+        wait_for_port(port)
+        time.sleep(0.5)
+        before = read_proc_status(server.pid)
+
+        private_key, public_key = CommunicationProtocol.generate_keys()
+
+        def connect(i):
+            sock = socket.create_connection(('127.0.0.1', port))
+            comm = CommunicationProtocol(sock, ('127.0.0.1', port), 'bench-{0}'.format(i),
+                                         private_key=private_key, public_key=public_key)
+            comm.establish_encrypted_connection_cs()
+            return comm
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            comms = list(pool.map(connect, range(connections)))
+        elapsed = time.perf_counter() - start
+
+        time.sleep(0.5)
+        after = read_proc_status(server.pid)
+        for comm in comms:
+            comm.close_connection()
+    finally:
+        server.terminate()
+        server.join()
+
+    result = {'engine': engine, 'connections': connections, 'seconds': elapsed,
+              'connections_per_second': connections / elapsed}
+    if 'rss_kb' in before and 'rss_kb' in after:
+        result['rss_kb_per_connection'] = (after['rss_kb'] - before['rss_kb']) / connections
+        result['threads'] = after['threads']
+    return result
+
+
+def bench_accept(engine: str, connections: int, port: int, backlog: int, workers: int, timeout: float,
+                 slow: int = 0) -> dict:
+    """
+    Storms a listening peer with simultaneous connects, as peers reconnecting after a network blip do.
+    Every connection has its own thread, released together, and is timed to its TCP connect and to its
+    established handshake. The peer runs in its own process and reports its handshake metrics.
+    Slow clients connect first and drip their hello a byte at a time, well within the timeout of each read,
+    they hold a handshake slot until the peer gives up on them.
+
+    :param engine: Name of the engine in ENGINES to benchmark.
+    :param connections: Number of simultaneous connects.
+    :param port: Port the peer listens on, its metrics are served on port + 1.
+    :param backlog: Backlog of the peer.
+    :param workers: Handshakes the peer runs at the same time.
+    :param timeout: Handshake timeout of the peer, in seconds.
+    :param slow: Number of slow clients, never completing their hello.
+    :return: Dictionary of results, times in milliseconds from the release of the connects,
+             slow clients in seconds from their connect until the peer closed them.
+    """
+    options = {'handshake_workers': workers, 'handshake_timeout': timeout, 'metrics_endpoint': port + 1,
+               'backlog': backlog}
+    server = multiprocessing.Process(target=_run_peer, args=(engine, 'bench-server', port, options), daemon=True)
+    server.start()
+    comms = []
+    try:
+        wait_for_port(port)
+        time.sleep(0.5)
+        private_key, public_key = CommunicationProtocol.generate_keys()
+        barrier = threading.Barrier(connections + 1)
+        connected, established, errors = [], [], []
+        dripped = []
+
+        def drip():
+            sock = socket.create_connection(('127.0.0.1', port), timeout=timeout * 4)
+            opened = time.perf_counter()
+            try:
+                sock.sendall(BinaryFraming.header.pack(1024))  # A framed hello that never completes
+                sock.settimeout(timeout / 4)
+                while time.perf_counter() - opened < timeout * 4:
+                    try:
+                        if not sock.recv(1):  # Closed by the peer
+                            break
+                    except socket.timeout:
+                        sock.sendall(b'0')  # One more byte, within the timeout of each read
+                else:
+                    return  # The peer never gave up on it
+            except OSError:  # Reset by the peer
+                pass
+            finally:
+                sock.close()
+            dripped.append(time.perf_counter() - opened)
+
+        def connect(i):
+            barrier.wait()
+            try:
+                sock = socket.create_connection(('127.0.0.1', port), timeout=60)
+                connected.append(time.perf_counter())
+                comm = CommunicationProtocol(sock, ('127.0.0.1', port), 'bench-{0}'.format(i),
+                                             private_key=private_key, public_key=public_key)
+                comm.establish_encrypted_connection_cs()
+                established.append(time.perf_counter())
+                comms.append(comm)
+            except Exception as e:
+                errors.append(type(e).__name__)
+
+        drippers = [threading.Thread(target=drip, daemon=True) for _ in range(slow)]
+        for thread in drippers:
+            thread.start()
+        if slow:
+            time.sleep(0.5)  # Slow clients take their handshake slots first
+        threads = [threading.Thread(target=connect, args=(i,), daemon=True) for i in range(connections)]
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for thread in threads:
+            thread.join(timeout=300)
+        elapsed = time.perf_counter() - start
+        for thread in drippers:
+            thread.join(timeout=timeout * 4 + 1)
+
+        with socket.create_connection(('127.0.0.1', port + 1), timeout=10) as stats_socket:
+            stats_socket.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+            response = b''.join(iter(lambda: stats_socket.recv(65536), b''))
+        handshakes = json.loads(response.partition(b'\r\n\r\n')[2])['handshakes']
+    finally:
+        for comm in comms:
+            comm.close_connection()
+        server.terminate()
+        server.join()
+
+    connected = sorted(t - start for t in connected)
+    established = sorted(t - start for t in established)
+
+    def percentile(values: list, fraction: float) -> float:
+        return values[int(fraction * (len(values) - 1))] * 1000 if values else float('nan')
+
+    return {'engine': engine, 'connections': connections, 'backlog': backlog, 'workers': workers,
+            'slow': slow, 'slow_closed': len(dripped), 'slow_closed_max_s': max(dripped, default=float('nan')),
+            'established': len(established), 'errors': len(errors),
+            'error_types': ','.join(sorted(set(errors))) or '-', 'seconds': elapsed,
+            'handshakes_per_second': len(established) / elapsed,
+            'connect_p50_ms': percentile(connected, 0.5), 'connect_p99_ms': percentile(connected, 0.99),
+            'established_p50_ms': percentile(established, 0.5),
+            'established_p99_ms': percentile(established, 0.99),
+            'server_handshake_p99_ms': handshakes['handshake_ms'].get('p99', float('nan')),
+            'server_peak_in_progress': handshakes['peak_in_progress'],
+            'server_timed_out': handshakes['timed_out'], 'server_failed': handshakes['failed']}
+
+
+def bench_crypto(cipher: str, size: int, duration: float) -> dict:
+    """
+    Measures encode + decode throughput of EncryptionProtocol for one cipher and message size.
+    CBC goes through the original string API, AEAD ciphers through the bytes API.
+
+    :param cipher: 'cbc' or a key of EncryptionProtocol.aead_ciphers.
+    :param size: Message size in bytes.
+    :param duration: Seconds to run for.
+    :return: Dictionary of results.
+    """
+    sender = EncryptionProtocol(12345, 1, 2, cipher=cipher, initiator=True)
+    receiver = EncryptionProtocol(12345, 2, 1, cipher=cipher, initiator=False)
+    if cipher == 'cbc':
+        message, encode, decode = 'x' * size, sender.encode_message, receiver.decode_message
+    else:
+        message, encode, decode = os.urandom(size), sender.encode_bytes, receiver.decode_bytes
+
+    count = 0
+    wire_bytes = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < duration:
+        encoded = encode(message)
+        decode(encoded)
+        wire_bytes += len(encoded)
+        count += 1
+        elapsed = time.perf_counter() - start
+
+    return {'cipher': cipher, 'size': size, 'messages_per_second': count / elapsed,
+            'bytes_per_second': count * size / elapsed, 'overhead_bytes': wire_bytes // count - size}
+
+
+def bench_crypto_pool(processes: int, connections: int, cipher: str, size: int, count: int,
+                      window: int = CommunicationProtocol.sealing_window) -> dict:
+    """
+    Measures encryption throughput of many connections, each sending from its own thread as the threaded peer
+    does, with encryption on each thread or on a CryptoPool. Each connection keeps up to window messages on
+    the pool, as send_pooled does, a window of 1 waits for every message before the next one.
+
+    :param processes: Processes of the pool, 0 encrypts on each connection's thread.
+    :param connections: Number of connections sending concurrently.
+    :param cipher: 'cbc' or a key of EncryptionProtocol.aead_ciphers.
+    :param size: Message size in bytes.
+    :param count: Messages sent per connection.
+    :param window: Messages of a connection on the pool before it waits for the oldest.
+    :return: Dictionary of results.
+    """
+    pool = CryptoPool(processes) if processes > 0 else None
+    message = b'x' * size
+
+    def send(i):
+        sender = EncryptionProtocol(12345, i, i + 1, cipher=cipher, initiator=True)
+        pending = collections.deque()
+        for _ in range(count):
+            if pool is None:
+                sender.encode_bytes(message)
+                continue
+            pending.append(pool.submit(EncryptionProtocol.seal, sender.seal_job(message)))
+            if len(pending) >= window:
+                pending.popleft().result()
+        for future in pending:
+            future.result()
+
+    if pool is not None:  # Start the worker processes before timing
+        pool.submit(EncryptionProtocol.seal, EncryptionProtocol(12345, 0, 1, cipher).seal_job(message)).result()
+    threads = [threading.Thread(target=send, args=(i,)) for i in range(connections)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    result = {'processes': processes, 'connections': connections, 'window': window, 'cipher': cipher, 'size': size,
+              'messages_per_second': connections * count / elapsed,
+              'bytes_per_second': connections * count * size / elapsed}
+    if pool is not None:
+        result['jobs_per_batch'] = pool.stats()['jobs_per_batch']
+        pool.close()
+    return result
+
+
+def bench_handshake(backend: KeyExchange.ECBackend, count: int) -> dict:
+    """
+    Measures key generation, Diffie-Hellman and full handshake latency over a socketpair for one EC backend.
+    Handshakes use fresh key-pairs on both sides, no keystore or session cache.
+
+    :param backend: ECBackend to use for its curve.
+    :param count: Number of operations and handshakes to time.
+    :return: Dictionary of results, times in milliseconds.
+    """
+    original = KeyExchange.backends.get(backend.name)
+    KeyExchange.backends[backend.name] = backend
+    try:
+        backend.generate_keys()  # Builds any precomputed tables
+        start = time.perf_counter()
+        keys = [backend.generate_keys() for _ in range(count)]
+        keygen = (time.perf_counter() - start) / count
+
+        start = time.perf_counter()
+        for private_key, public_key in keys:
+            backend.shared_secret(private_key, public_key)
+        shared = (time.perf_counter() - start) / count
+
+        latencies = []
+        for _ in range(count):
+            client_socket, server_socket = socket.socketpair()
+            client = CommunicationProtocol(client_socket, ('client', 0), 'client', curve=backend.name)
+            server = CommunicationProtocol(server_socket, ('server', 0), 'server')
+            start = time.perf_counter()
+            thread = threading.Thread(target=server.establish_encrypted_connection_ss)
+            thread.start()
+            client.establish_encrypted_connection_cs()
+            thread.join()
+            latencies.append(time.perf_counter() - start)
+            client.close_connection()
+            server.close_connection()
+    finally:
+        KeyExchange.backends[backend.name] = original
+
+    return {'backend': type(backend).__name__, 'curve': backend.name, 'keygen_ms': keygen * 1000,
+            'shared_secret_ms': shared * 1000, 'handshake_p50_ms': statistics.median(latencies) * 1000,
+            'handshake_max_ms': max(latencies) * 1000}
+
+
+class DelayProxy(object):
+
+    def __init__(self, target: tuple, rtt: float):
+        """
+        Initialise DelayProxy, relays connections to a target on localhost, delaying every chunk by half the round
+        trip time in each direction, to measure round trips as they would be on a slow link.
+
+        :param target: Tuple of (ip, port) to relay to.
+        :param rtt: Round trip time to add, in seconds.
+        """
+        self.target = target
+        self.delay = rtt / 2
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.address = self.listener.getsockname()
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            server = socket.create_connection(self.target)
+            for source, destination in ((client, server), (server, client)):
+                destination.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                chunks = queue.Queue()
+                threading.Thread(target=self.read, args=(source, chunks), daemon=True).start()
+                threading.Thread(target=self.write, args=(destination, chunks), daemon=True).start()
+
+    def read(self, source: socket.socket, chunks: queue.Queue):
+        data = b' '
+        while data:
+            try:
+                data = source.recv(65536)
+            except OSError:
+                data = b''
+            chunks.put((time.monotonic() + self.delay, data))
+
+    @staticmethod
+    def write(destination: socket.socket, chunks: queue.Queue):
+        while True:
+            due, data = chunks.get()
+            time.sleep(max(0.0, due - time.monotonic()))
+            try:
+                if not data:
+                    destination.shutdown(socket.SHUT_WR)
+                    return
+                destination.sendall(data)
+            except OSError:
+                return
+
+    def close(self):
+        self.listener.close()
+
+
+def bench_first_message(rtt: float, count: int, pipeline: bool) -> dict:
+    """
+    Measures the time from connecting until the server received the first message, over a DelayProxy.
+
+    :param rtt: Round trip time added by the proxy, in seconds.
+    :param count: Number of connections to time.
+    :param pipeline: If True the client offers the pipelined handshake.
+    :return: Dictionary of results, times in milliseconds.
+    """
+    listener = socket.create_server(('127.0.0.1', 0))
+    proxy = DelayProxy(listener.getsockname(), rtt)
+    latencies = []
+    try:
+        for _ in range(count):
+            received = []
+
+            def serve():
+                connection, address = listener.accept()
+                server = CommunicationProtocol(connection, address, 'server')
+                server.establish_encrypted_connection_ss()
+                while not received:
+                    received.extend(server.receive_message())
+                received.append(time.perf_counter())
+                server.close_connection()
+
+            thread = threading.Thread(target=serve)
+            thread.start()
+            start = time.perf_counter()
+            client = CommunicationProtocol(socket.create_connection(proxy.address), proxy.address, 'client',
+                                           cipher='aes-gcm', pipeline=pipeline)
+            client.establish_encrypted_connection_cs()
+            client.send_message('PING')
+            thread.join()
+            latencies.append(received[-1] - start)
+            client.close_connection()
+    finally:
+        proxy.close()
+        listener.close()
+    return {'pipeline': pipeline, 'rtt_ms': rtt * 1000, 'first_message_p50_ms': statistics.median(latencies) * 1000,
+            'first_message_max_ms': max(latencies) * 1000, 'round_trips': statistics.median(latencies) / rtt}
+
+
+def bench_dispatch(modules: int, count: int) -> dict:
+    """
+    Measures messages/sec routed to the innermost of a stack of modules, through the prefix registry and
+    through the original decorator chain where every module checks the prefix and passes the message on.
+
+    :param modules: Number of modules stacked on the peer.
+    :param count: Number of messages to route.
+    :return: Dictionary of results.
+    """
+    def handle_message(self, name, message):
+        return True
+
+    def process_message(self, name, message, handled):
+        if not handled and message.startswith(self.prefix):
+            handled = True
+            message.split('-')
+        self._peer.process_message(name, message, handled)
+
+    result = {'modules': modules, 'messages': count}
+    for mode, methods in (('registry', {'handle_message': handle_message}),
+                          ('chain', {'process_message': process_message})):
+        peer = Client('bench-dispatch', '', 0)
+        for i in range(modules):
+            peer = type('Module{0}'.format(i), (PeerModule,), dict(methods, prefix='MOD{0}'.format(i)))(peer)
+        handler = peer.dispatch_message if mode == 'registry' else peer.process_message
+        start = time.perf_counter()
+        for _ in range(count):
+            handler('bench', 'MOD0-PING-1', False)
+        result['{0}_messages_per_second'.format(mode)] = count / (time.perf_counter() - start)
+    return result
+
+
+def bench_gossip(peers: int, fanout: int, interval: float, max_rounds: int = 100) -> dict:
+    """
+    Simulates gossip between peers in memory, every peer starts knowing itself and one seed peer.
+    Each round every peer gossips with fanout random known peers, until every peer knows every peer.
+    The same schedule exchanging full peer lists, as BUILTIN-PEERLIST does, is measured for comparison.
+
+    :param peers: Number of simulated peers.
+    :param fanout: Peers gossiped with per round.
+    :param interval: Seconds between rounds, converts rounds to convergence time.
+    :param max_rounds: Rounds after which the simulation gives up.
+    :return: Dictionary of results.
+    """
+    names = ['peer{0}'.format(i) for i in range(peers)]
+    addresses = {name: ('10.{0}.{1}.{2}'.format(i >> 16, (i >> 8) & 255, i & 255), 12109)
+                 for i, name in enumerate(names)}
+    queue = []
+    nodes = {}
+    for name in names:
+        node = Gossip(name, lambda target, message, sender=name: queue.append((sender, target, message)),
+                      None, fanout=fanout, interval=interval)
+        node.peers = node.entries.keys
+        node.observe(name, addresses[name])
+        node.observe(names[0], addresses[names[0]])
+        nodes[name] = node
+
+    start = time.perf_counter()
+    rounds = 0
+    while rounds < max_rounds and any(len(node.entries) < peers for node in nodes.values()):
+        rounds += 1
+        for node in nodes.values():
+            node.run_round()
+            while queue:
+                sender, target, message = queue.pop()
+                nodes[target].handle(sender, message)
+    simulation = time.perf_counter() - start
+    converged_bytes = sum(node.bytes_sent for node in nodes.values())
+    for node in nodes.values():  # One more round once every peer is in sync
+        node.run_round()
+        while queue:
+            sender, target, message = queue.pop()
+            nodes[target].handle(sender, message)
+    steady_bytes = sum(node.bytes_sent for node in nodes.values()) - converged_bytes
+
+    entry_size = {name: len('{0}@{1}@{2}>'.format(name, *addresses[name])) for name in names}
+    known = {name: {name, names[0]} for name in names}
+    dump_size = {name: sum(entry_size[peer] for peer in known[name]) for name in names}
+    full_rounds = 0
+    full_bytes = 0
+    while full_rounds < max_rounds and any(len(peer_set) < peers for peer_set in known.values()):
+        full_rounds += 1
+        for name in names:
+            for target in random.sample(sorted(known[name] - {name}), min(fanout, len(known[name]) - 1)):
+                full_bytes += len('BUILTIN-PEERLIST-REQ') * 2 + len('BUILTIN-PEERLIST-UPD-') * 2
+                full_bytes += dump_size[name] + dump_size[target]
+                for receiver, sender in ((name, target), (target, name)):
+                    added = known[sender] - known[receiver]
+                    known[receiver] |= added
+                    dump_size[receiver] += sum(entry_size[peer] for peer in added)
+    full_steady = (len('BUILTIN-PEERLIST-REQ') * 2 + len('BUILTIN-PEERLIST-UPD-') * 2
+                   + 2 * sum(entry_size.values())) * peers * min(fanout, peers - 1)
+
+    return {'peers': peers, 'fanout': fanout, 'rounds': rounds, 'convergence_s': rounds * interval,
+            'bytes': converged_bytes, 'bytes_per_peer': converged_bytes / peers,
+            'steady_bytes_per_round': steady_bytes, 'full_rounds': full_rounds, 'full_bytes': full_bytes,
+            'full_steady_bytes_per_round': full_steady, 'simulation_s': simulation}
+
+
+def sample_messages(count: int) -> list:
+    """
+    Generates messages shaped like Saga traffic, peer lists, gossip deltas, timers and sensor readings.
+
+    :param count: Number of messages.
+    :return: List of messages.
+    """
+    rng = random.Random(count)
+    peers = ['peer{0}@10.0.{1}.{2}@12109'.format(i, i >> 8, i & 255) for i in range(200)]
+    messages = []
+    for i in range(count):
+        match i % 4:
+            case 0:
+                messages.append('BUILTIN-PEERLIST-UPD-' + '>'.join(rng.sample(peers, rng.randint(10, 60))))
+            case 1:
+                messages.append('BUILTIN-GOSSIP-DLT--' + '>'.join('{0}@{1}'.format(peer, 1700000000000000 + i)
+                                                                  for peer in rng.sample(peers, rng.randint(1, 8))))
+            case 2:
+                messages.append('TIME-TIMER-{0}-MINUTES'.format(rng.randint(1, 60)))
+            case _:
+                messages.append('SENSOR-READING-{0}'.format(';'.join(
+                    'sensor{0}=temperature:{1:.2f},humidity:{2:.1f},battery:{3}'.format(
+                        s, rng.uniform(15, 30), rng.uniform(20, 80), rng.randint(10, 100)) for s in range(8))))
+    return messages
+
+
+def bench_compression(algorithm: str, threshold: int, count: int) -> dict:
+    """
+    Measures the compression ratio and CPU time per message on Saga shaped traffic.
+    The zdict dictionary is trained on a separate sample of the same traffic.
+
+    :param algorithm: 'zlib', 'lzma' or 'zdict'.
+    :param threshold: Messages shorter than this many bytes are not compressed.
+    :param count: Number of messages.
+    :return: Dictionary of results.
+    """
+    dictionary = None
+    if algorithm == 'zdict':
+        dictionary = Compression.train_dictionary(sample_messages(count * 2)[count:])
+        algorithm = Compression.dictionary_id(dictionary)
+    compressor = Compression.Compressor(algorithm, threshold, dictionary)
+    messages = [message.encode('utf-8') for message in sample_messages(count)]
+
+    payloads = [compressor.compress(message) for message in messages]
+    for payload, message in zip(payloads, messages):
+        if compressor.decompress(payload) != message:
+            raise Exception('Round trip failed.')
+    result = compressor.stats()
+    result['dictionary_bytes'] = len(dictionary) if dictionary else 0
+    result['compress_us_per_message'] = result['compress_cpu_ms'] * 1000 / count
+    result['decompress_us_per_message'] = result['decompress_cpu_ms'] * 1000 / count
+    return result
+
+
+def sample_commands(count: int) -> list:
+    """
+    Generates messages of registered commands, peer lists, timers, alarms and camera commands.
+
+    :param count: Number of messages.
+    :return: List of parsed messages.
+    """
+    rng = random.Random(count)
+    peers = [('peer{0}'.format(i), '10.0.{0}.{1}'.format(i >> 8, i & 255), 12109) for i in range(200)]
+    messages = []
+    for i in range(count):
+        match i % 4:
+            case 0:
+                messages.append(PEERLIST_UPD(rng.sample(peers, rng.randint(10, 60))))
+            case 1:
+                messages.append(TIME_TIMER(rng.randint(1, 60), 'MINUTES'))
+            case 2:
+                messages.append(TIME_ALARM('{0}PM'.format(rng.randint(1, 12))))
+            case _:
+                messages.append(MONITORCAMERA(rng.choice(('123', '456', '789'))))
+    return messages
+
+
+def _split_parse(message: str):
+    """
+    Parses a message the way handlers did before the schema, splitting on '-' in every handler it passes.
+    """
+    args = message.split('-')
+    match args[0]:
+        case 'BUILTIN':
+            return [(peer_[0], peer_[1], int(peer_[2])) for peer_ in (peer.split('@') for peer in args[3].split('>'))]
+        case 'TIME':
+            match args[1]:
+                case 'TIMER':
+                    return args[2], args[3]
+                case 'ALARM':
+                    return args[2]
+        case 'MONITORCAMERA':
+            return args[1]
+    return None
+
+
+def bench_schema(count: int) -> dict:
+    """
+    Measures the cost of parsing messages through the split based path, the text fallback of the schema
+    and the binary envelope, and the size of the text and binary encodings.
+
+    :param count: Number of messages.
+    :return: Dictionary of results.
+    """
+    messages = sample_commands(count)
+    texts = [str(message) for message in messages]
+    envelopes = [bytes(SCHEMA.encode(message)) for message in messages]
+    for message, text, envelope in zip(messages, texts, envelopes):
+        if SCHEMA.parse_text(text) != message or SCHEMA.decode(envelope) != message:
+            raise Exception('Round trip failed.')
+
+    result = {'messages': count, 'text_bytes': sum(len(text.encode('utf-8')) for text in texts),
+              'binary_bytes': sum(len(envelope) for envelope in envelopes)}
+    for mode, parse, payloads in (('split', _split_parse, texts), ('text', SCHEMA.parse_text, texts),
+                                  ('binary', SCHEMA.decode, envelopes)):
+        start = time.perf_counter()
+        for payload in payloads:
+            parse(payload)
+        result['{0}_us_per_message'.format(mode)] = (time.perf_counter() - start) * 1e6 / count
+    start = time.perf_counter()
+    for message in messages:
+        SCHEMA.encode(message)
+    result['encode_us_per_message'] = (time.perf_counter() - start) * 1e6 / count
+    return result
+
+
+def bench_metrics(enabled: bool, count: int) -> dict:
+    """
+    Measures the cost per message of encrypting, decrypting and dispatching to a handler, with metrics on or off.
+    Both connections skip the handshake and share a key, so only the message path is timed.
+
+    :param enabled: If True connections and the peer record metrics.
+    :param count: Number of messages.
+    :return: Dictionary of results.
+    """
+    left, right = socket.socketpair()
+    sender = CommunicationProtocol(left, ('127.0.0.1', 0), 'sender', metrics=enabled)
+    receiver = CommunicationProtocol(right, ('127.0.0.1', 0), 'receiver', metrics=enabled)
+    for comm, initiator in ((sender, True), (receiver, False)):
+        comm.encryption_proto = EncryptionProtocol(12345, 1 + (not initiator), 1 + initiator, cipher='aes-gcm',
+                                                   initiator=initiator)
+        comm.framer = BinaryFraming()
+        comm.negotiated = {'framing': 'binary', 'cipher': 'aes-gcm'}
+    peer = Client('receiver', '', 0, metrics=enabled)
+    peer.set_message_handler(lambda name, message, handled: None)
+    messages = [str(message) for message in sample_commands(count)]
+
+    start = time.perf_counter()
+    for message in messages:
+        for received in receiver.process_received(b''.join(sender.framer.frame(sender.encode_payload(message)))):
+            peer.handle_received('sender', received)
+    elapsed = time.perf_counter() - start
+    left.close()
+    right.close()
+    return {'metrics': enabled, 'us_per_message': elapsed * 1e6 / count, 'messages_per_second': count / elapsed}
+
+
+def bench_group(members: int, size: int, count: int) -> dict:
+    """
+    Measures the encryption cost of sending one message to every member of a group, encrypted for each
+    connection as broadcast does, and sealed once with a group key as send_group does.
+
+    :param members: Number of members.
+    :param size: Message size in bytes.
+    :param count: Number of messages.
+    :return: Dictionary of results, microseconds per message sent to the whole group.
+    """
+    connections = [EncryptionProtocol(12345 + i, 1, 2, cipher='aes-gcm', initiator=True) for i in range(members)]
+    key = GroupKey('bench')
+    message = os.urandom(size)
+
+    start = time.perf_counter()
+    for _ in range(count):
+        for connection in connections:
+            connection.encode_bytes(message)
+    pairwise = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(count):
+        key.seal(message)
+    group = time.perf_counter() - start
+    return {'members': members, 'size': size, 'pairwise_us': pairwise * 1e6 / count,
+            'group_us': group * 1e6 / count, 'speedup': pairwise / group}
+
+
+def bench_timers(pending: int, probes: int, spread: float) -> dict:
+    """
+    Measures how late timers fire while many others are pending, and the cost of scheduling and cancelling.
+    The pending timers are due after the measurement, the probes are due at random times within spread.
+
+    :param pending: Number of timers pending throughout.
+    :param probes: Number of timers timed.
+    :param spread: Seconds the probes are spread over.
+    :return: Dictionary of results, lateness in milliseconds.
+    """
+    fired = {}
+    scheduler = Scheduler(lambda timer_id, due: fired.setdefault(timer_id, time.monotonic() - due), coalesce=0.0)
+    rng = random.Random(7)
+
+    start = time.perf_counter()
+    ids = [scheduler.schedule(spread + 3600 + rng.random() * 3600, persistent=False) for _ in range(pending)]
+    schedule_us = (time.perf_counter() - start) * 1e6 / pending
+    start = time.perf_counter()
+    for timer_id in ids[:pending // 10]:
+        scheduler.cancel(timer_id)
+    cancel_us = (time.perf_counter() - start) * 1e6 / max(1, pending // 10)
+    for _ in range(pending // 10):  # Back to pending timers, cancelled ones stay in the heap
+        scheduler.schedule(spread + 3600 + rng.random() * 3600, persistent=False)
+
+    scheduler.start()
+    for _ in range(probes):
+        delay = rng.random() * spread
+        scheduler.schedule(delay, time.monotonic() + delay, persistent=False)
+    deadline = time.monotonic() + spread + 5
+    while len(fired) < probes and time.monotonic() < deadline:
+        time.sleep(0.05)
+    scheduler.stop()
+
+    lateness = sorted(fired.values())
+    return {'pending': len(scheduler), 'probes': probes, 'fired': len(lateness), 'schedule_us': schedule_us,
+            'cancel_us': cancel_us, 'late_p50_ms': lateness[len(lateness) // 2] * 1000,
+            'late_p99_ms': lateness[int(0.99 * (len(lateness) - 1))] * 1000, 'late_max_ms': lateness[-1] * 1000,
+            'wakeups': scheduler.wakeups}
+
+
+def print_result(result: dict, as_json: bool = False):
+    """
+    Prints one result, as key=value pairs or as a JSON object per line.
+
+    :param result: Dictionary of results.
+    :param as_json: If True prints JSON, tagged with the Python version and machine so runs can be compared.
+    """
+    if as_json:
+        print(json.dumps(dict(result, python=platform.python_version(), machine=platform.machine(),
+                              cpus=os.cpu_count(), time=time.time())), flush=True)
+        return
+    print(' '.join('{0}={1:.3f}'.format(k, v) if isinstance(v, float) else '{0}={1}'.format(k, v)
+                   for k, v in result.items()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Saga benchmarks')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per result')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    suite_parser = subparsers.add_parser('suite', help='handshakes, latency and throughput of peers on localhost')
+    suite_parser.add_argument('-e', '--engine', choices=ENGINES.keys(), action='append',
+                              help='engine the peers run, may be repeated (default: all)')
+    suite_parser.add_argument('-n', '--peers', type=int, default=4)
+    suite_parser.add_argument('-p', '--port', type=int, default=13200)
+    suite_parser.add_argument('-c', '--connections', type=int, default=100)
+    suite_parser.add_argument('-m', '--messages', type=int, default=2000, help='messages sent to each peer')
+    suite_parser.add_argument('-s', '--size', type=int, default=64, help='message size in bytes')
+    suite_parser.add_argument('--pings', type=int, default=200)
+    suite_parser.add_argument('-w', '--workers', type=int, default=16)
+    suite_parser.add_argument('--cipher', choices=('cbc',) + tuple(EncryptionProtocol.aead_ciphers.keys()),
+                              default='cbc')
+
+    engine_parser = subparsers.add_parser('engine', help='connections/sec and memory/connection per peer engine')
+    engine_parser.add_argument('-e', '--engine', choices=ENGINES.keys(), action='append',
+                               help='engine to benchmark, may be repeated (default: all)')
+    engine_parser.add_argument('-c', '--connections', type=int, default=200)
+    engine_parser.add_argument('-p', '--port', type=int, default=13100)
+    engine_parser.add_argument('-w', '--workers', type=int, default=16)
+
+    accept_parser = subparsers.add_parser('accept', help='simultaneous connects storming one listening peer')
+    accept_parser.add_argument('-e', '--engine', choices=ENGINES.keys(), action='append',
+                               help='engine to benchmark, may be repeated (default: all)')
+    accept_parser.add_argument('-c', '--connections', type=int, default=1000)
+    accept_parser.add_argument('-p', '--port', type=int, default=13300)
+    accept_parser.add_argument('-b', '--backlog', type=int, action='append',
+                               help='backlog of the peer, may be repeated, paired in order with --workers '
+                                    '(default: 10, 128)')
+    accept_parser.add_argument('-w', '--workers', type=int, action='append',
+                               help='handshakes the peer runs at once, may be repeated (default: 1, 16)')
+    accept_parser.add_argument('-t', '--timeout', type=float, default=30.0, help='handshake timeout in seconds')
+    accept_parser.add_argument('--slow', type=int, default=0,
+                               help='slow clients dripping their hello a byte at a time, connected before the storm')
+
+    crypto_parser = subparsers.add_parser('crypto', help='messages/sec and bytes/sec per cipher and message size')
+    crypto_parser.add_argument('--cipher', choices=('cbc',) + tuple(EncryptionProtocol.aead_ciphers.keys()),
+                               action='append', help='cipher to benchmark, may be repeated (default: all)')
+    crypto_parser.add_argument('-s', '--size', type=int, action='append',
+                               help='message size in bytes, may be repeated (default: 16 B to 1 MiB)')
+    crypto_parser.add_argument('-t', '--duration', type=float, default=1.0, help='seconds per measurement')
+
+    pool_parser = subparsers.add_parser('cryptopool', help='messages/sec of many connections with and without '
+                                                           'the crypto process pool')
+    pool_parser.add_argument('-j', '--processes', type=int, action='append',
+                             help='processes of the pool, 0 encrypts on each connection, may be repeated '
+                                  '(default: 0, 1, 2, 4, ... up to the number of CPUs)')
+    pool_parser.add_argument('-n', '--connections', type=int, default=64)
+    pool_parser.add_argument('--cipher', choices=('cbc',) + tuple(EncryptionProtocol.aead_ciphers.keys()),
+                             default='aes-gcm')
+    pool_parser.add_argument('-s', '--size', type=int, default=1024)
+    pool_parser.add_argument('-c', '--count', type=int, default=500, help='messages per connection')
+    pool_parser.add_argument('-w', '--window', type=int, action='append',
+                             help='messages of a connection on the pool at once, may be repeated '
+                                  '(default: 1, then the window of send_pooled)')
+
+    handshake_parser = subparsers.add_parser('handshake', help='key exchange and handshake latency per EC backend')
+    handshake_parser.add_argument('-c', '--count', type=int, default=20)
+
+    pipeline_parser = subparsers.add_parser('pipeline', help='time to first message with and without pipelining')
+    pipeline_parser.add_argument('-r', '--rtt', type=float, default=100.0, help='round trip time to add, in ms')
+    pipeline_parser.add_argument('-c', '--count', type=int, default=10)
+
+    dispatch_parser = subparsers.add_parser('dispatch', help='message routing through the registry and the chain')
+    dispatch_parser.add_argument('-m', '--modules', type=int, action='append',
+                                 help='modules stacked on the peer, may be repeated (default: 3, 10, 50)')
+    dispatch_parser.add_argument('-c', '--count', type=int, default=100000)
+
+    gossip_parser = subparsers.add_parser('gossip', help='simulated peer list convergence time and bandwidth')
+    gossip_parser.add_argument('-n', '--peers', type=int, default=1000)
+    gossip_parser.add_argument('-f', '--fanout', type=int, action='append',
+                               help='peers gossiped with per round, may be repeated (default: 1, 3)')
+    gossip_parser.add_argument('-i', '--interval', type=float, default=5.0, help='seconds between rounds')
+
+    compression_parser = subparsers.add_parser('compression', help='compression ratio and CPU time per message')
+    compression_parser.add_argument('-a', '--algorithm', choices=('zlib', 'lzma', 'zdict'), action='append',
+                                    help='algorithm to benchmark, may be repeated (default: all)')
+    compression_parser.add_argument('-t', '--threshold', type=int, default=256)
+    compression_parser.add_argument('-c', '--count', type=int, default=2000)
+
+    schema_parser = subparsers.add_parser('schema', help='parse cost of split, text and binary messages')
+    schema_parser.add_argument('-c', '--count', type=int, default=100000)
+
+    group_parser = subparsers.add_parser('group', help='encryption cost per group message, pairwise and group key')
+    group_parser.add_argument('-m', '--members', type=int, action='append',
+                              help='members of the group, may be repeated (default: 2, 8, 32)')
+    group_parser.add_argument('-s', '--size', type=int, default=1024)
+    group_parser.add_argument('-c', '--count', type=int, default=2000)
+
+    timers_parser = subparsers.add_parser('timers', help='scheduling jitter with many timers pending')
+    timers_parser.add_argument('-n', '--pending', type=int, default=100000)
+    timers_parser.add_argument('-c', '--probes', type=int, default=2000)
+    timers_parser.add_argument('-t', '--spread', type=float, default=5.0, help='seconds the probes are spread over')
+
+    metrics_parser = subparsers.add_parser('metrics', help='message path cost with metrics disabled and enabled')
+    metrics_parser.add_argument('-c', '--count', type=int, default=100000)
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'suite':
+        for engine_ in args.engine or ENGINES.keys():
+            print_result(bench_suite(engine_, args.peers, args.port, args.connections, args.messages, args.size,
+                                     args.pings, args.workers, args.cipher), args.json)
+            args.port += args.peers
+
+    elif args.benchmark == 'engine':
+        for engine_ in args.engine or ENGINES.keys():
+            print_result(bench_engine(engine_, args.connections, args.port, args.workers), args.json)
+
+    elif args.benchmark == 'accept':
+        for engine_ in args.engine or ENGINES.keys():
+            # The first defaults match the old listener, one handshake at a time with a backlog of 10
+            for backlog_, workers_ in zip(args.backlog or (10, 128), args.workers or (1, 16)):
+                print_result(bench_accept(engine_, args.connections, args.port, backlog_, workers_, args.timeout,
+                                          args.slow), args.json)
+                args.port += 2
+
+    elif args.benchmark == 'crypto':
+        for cipher_ in args.cipher or ('cbc',) + tuple(EncryptionProtocol.aead_ciphers.keys()):
+            for size_ in args.size or (16, 256, 4096, 65536, 1048576):
+                print_result(bench_crypto(cipher_, size_, args.duration), args.json)
+
+    elif args.benchmark == 'cryptopool':
+        for processes_ in args.processes or [0] + [2 ** i for i in range((os.cpu_count() or 1).bit_length())]:
+            for window_ in args.window or (1, CommunicationProtocol.sealing_window):
+                print_result(bench_crypto_pool(processes_, args.connections, args.cipher, args.size, args.count,
+                                               window_), args.json)
+
+    elif args.benchmark == 'handshake':
+        for backend_ in (KeyExchange.TinyecBackend(), KeyExchange.BrainpoolBackend(), KeyExchange.P256Backend()):
+            print_result(bench_handshake(backend_, args.count), args.json)
+
+    elif args.benchmark == 'pipeline':
+        for pipeline_ in (False, True):
+            print_result(bench_first_message(args.rtt / 1000, args.count, pipeline_), args.json)
+
+    elif args.benchmark == 'dispatch':
+        for modules_ in args.modules or (3, 10, 50):
+            print_result(bench_dispatch(modules_, args.count), args.json)
+
+    elif args.benchmark == 'gossip':
+        for fanout_ in args.fanout or (1, 3):
+            print_result(bench_gossip(args.peers, fanout_, args.interval), args.json)
+
+    elif args.benchmark == 'compression':
+        for algorithm_ in args.algorithm or ('zlib', 'lzma', 'zdict'):
+            print_result(bench_compression(algorithm_, args.threshold, args.count), args.json)
+
+    elif args.benchmark == 'schema':
+        print_result(bench_schema(args.count), args.json)
+
+    elif args.benchmark == 'group':
+        for members_ in args.members or (2, 8, 32):
+            print_result(bench_group(members_, args.size, args.count), args.json)
+
+    elif args.benchmark == 'timers':
+        print_result(bench_timers(args.pending, args.probes, args.spread), args.json)
+
+    elif args.benchmark == 'metrics':
+        for enabled_ in (False, True, False, True):  # Twice each, the first run warms up caches
+            print_result(bench_metrics(enabled_, args.count), args.json)
@@ -0,0 +1,425 @@
+import collections
+import heapq
+import socket
+import threading
+import time
+
+IOV_MAX = 1024  # Buffers per sendmsg call, the POSIX minimum for IOV_MAX
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)  # Platforms without it have no sendmsg either
+RETRY_DELAY = 0.001  # Seconds before a queue that could not be flushed is retried, doubled up to MAX_RETRY_DELAY
+MAX_RETRY_DELAY = 0.05
+
+
+class FlushScheduler(object):
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self):
+        """
+        Initialise FlushScheduler, a single thread flushing every OutboundQueue whose flush latency has passed.
+        It never waits on a socket, a queue whose socket is full or that is busy on another thread is retried later.
+        """
+        self.deadlines = []  # heap of (deadline, sequence, OutboundQueue)
+        self.sequence = 0
+        self.condition = threading.Condition()
+        thread = threading.Thread(target=self.run, name='FlushScheduler')
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def shared(cls) -> 'FlushScheduler':
+        """
+        Gets the FlushScheduler shared by every queue in this process, starting it on first use.
+
+        :return: The shared FlushScheduler.
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def schedule(self, queue: 'OutboundQueue', deadline: float):
+        """
+        Flushes a queue at a time.
+
+        :param queue: Queue to flush.
+        :param deadline: time.monotonic() to flush at.
+        """
+        with self.condition:
+            self.sequence += 1
+            heapq.heappush(self.deadlines, (deadline, self.sequence, queue))
+            if self.deadlines[0][2] is queue:
+                self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.deadlines or self.deadlines[0][0] > time.monotonic():
+                    self.condition.wait(self.deadlines[0][0] - time.monotonic() if self.deadlines else None)
+                _, _, queue = heapq.heappop(self.deadlines)
+            try:
+                queue.flush_scheduled()
+            except OSError:
+                pass  # The connection closed, its receive loop reports it
+
+
+class OutboundQueue(object):
+
+    def __init__(self, connection: socket.socket, flush_latency: float = 0.0, flush_bytes: int = 65536):
+        """
+        Initialise OutboundQueue, coalesces frames sent on a socket into as few system calls as possible.
+        Pending buffers are written with a single scatter-gather sendmsg, looping until every byte is delivered.
+
+        :param connection: Socket to send on.
+        :param flush_latency: Seconds a frame may wait for more frames, 0 flushes on every push.
+        :param flush_bytes: Pending bytes that trigger a flush before flush_latency has passed.
+        """
+        self.connection = connection
+        self.flush_latency = flush_latency
+        self.flush_bytes = flush_bytes
+        self.lock = threading.RLock()  # Held while encrypting so frames are queued in nonce order
+
+        self.buffers = []
+        self.pending_bytes = 0
+        self.pending_frames = 0
+        self.scheduled = False
+        self.retry_delay = RETRY_DELAY
+
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.syscalls = 0
+
+    def push(self, *buffers):
+        """
+        Queues the buffers of one frame, flushing if the latency is 0 or enough bytes are pending.
+
+        :param buffers: Bytes-like objects making up the frame, sent back to back without being copied.
+        """
+        with self.lock:
+            self.buffers.extend(buffers)
+            self.pending_bytes += sum(len(buffer) for buffer in buffers)
+            self.pending_frames += 1
+            if self.flush_latency <= 0 or self.pending_bytes >= self.flush_bytes:
+                self.flush()
+            elif not self.scheduled:
+                self.scheduled = True
+                FlushScheduler.shared().schedule(self, time.monotonic() + self.flush_latency)
+
+    def push_deferred(self, *buffers):
+        """
+        Queues the buffers of one frame like push, but leaves the write to the FlushScheduler,
+        for threads that must not block on the socket of a slow peer, the FlushScheduler does not either.
+
+        :param buffers: Bytes-like objects making up the frame, sent back to back without being copied.
+        """
+        with self.lock:
+            self.buffers.extend(buffers)
+            self.pending_bytes += sum(len(buffer) for buffer in buffers)
+            self.pending_frames += 1
+            if not self.scheduled or self.pending_bytes >= self.flush_bytes:
+                self.scheduled = True
+                latency = self.flush_latency if self.pending_bytes < self.flush_bytes else 0.0
+                FlushScheduler.shared().schedule(self, time.monotonic() + max(latency, 0.0))
+
+    def flush(self):
+        """
+        Sends every pending buffer, returns once all of them have been handed to the kernel.
+        """
+        with self.lock:
+            self.scheduled = False
+            self._flush(0)
+
+    def flush_scheduled(self):
+        """
+        Flushes for the FlushScheduler without blocking it, so a slow peer does not hold up other connections.
+        Sends what the socket takes at once, the rest is retried after retry_delay, as is a queue held by another
+        thread.
+        """
+        if not self.lock.acquire(blocking=False):
+            FlushScheduler.shared().schedule(self, time.monotonic() + self.retry_delay)
+            return
+        try:
+            self.scheduled = False
+            sent = self.bytes_sent
+            done = self._flush(MSG_DONTWAIT)
+            if done or self.bytes_sent > sent:  # The peer is reading, retry soon
+                self.retry_delay = RETRY_DELAY
+            if not done:
+                self.scheduled = True
+                FlushScheduler.shared().schedule(self, time.monotonic() + self.retry_delay)
+                self.retry_delay = min(self.retry_delay * 2, MAX_RETRY_DELAY)
+        finally:
+            self.lock.release()
+
+    def _flush(self, flags: int) -> bool:
+        """
+        Sends pending buffers, the caller holds the lock.
+
+        :param flags: 0 to wait until every buffer is sent, MSG_DONTWAIT to stop once the socket is full.
+        :return: True if every buffer was sent; False if some are still pending.
+        """
+        if not self.buffers:
+            return True
+        buffers, frames, size = self.buffers, self.pending_frames, self.pending_bytes
+        self.buffers, self.pending_frames, self.pending_bytes = [], 0, 0
+        unsent = self._send_all(buffers, flags)
+        if unsent:
+            self.buffers, self.pending_frames = unsent, frames  # Frames count as sent once all of them are
+            self.pending_bytes = sum(len(buffer) for buffer in unsent)
+            self.bytes_sent += size - self.pending_bytes
+            return False
+        self.frames_sent += frames
+        self.bytes_sent += size
+        return True
+
+    def _send_all(self, buffers: list, flags: int = 0) -> list:
+        """
+        Writes buffers to the socket with as few system calls as possible.
+
+        :param buffers: Bytes-like objects to send back to back.
+        :param flags: Flags of sendmsg, with MSG_DONTWAIT it stops once the socket is full.
+        :return: The buffers left unsent, empty if every byte was sent.
+        """
+        if not hasattr(self.connection, 'sendmsg'):
+            self.connection.sendall(b''.join(buffers))
+            self.syscalls += 1
+            return []
+
+        buffers = [memoryview(buffer).cast('B') for buffer in buffers if len(buffer)]
+        start = 0
+        while start < len(buffers):
+            try:
+                sent = self.connection.sendmsg(buffers[start:start + IOV_MAX], [], flags)
+            except BlockingIOError:
+                return buffers[start:]
+            self.syscalls += 1
+            while start < len(buffers) and sent >= len(buffers[start]):  # Skip fully sent buffers
+                sent -= len(buffers[start])
+                start += 1
+            if sent:
+                buffers[start] = buffers[start][sent:]  # Partially sent buffer
+        return []
+
+    def stats(self) -> dict:
+        """
+        Gets send counters.
+
+        :return: Dictionary of frames_sent, bytes_sent, syscalls and frames_per_syscall.
+        """
+        return {'frames_sent': self.frames_sent, 'bytes_sent': self.bytes_sent, 'syscalls': self.syscalls,
+                'frames_per_syscall': self.frames_sent / self.syscalls if self.syscalls else 0.0}
+
+
+class ReceiveBuffer(object):
+
+    def __init__(self, initial_size: int = 4096, min_read: int = 4096, max_read: int = 2 ** 20):
+        """
+        Initialise ReceiveBuffer, a preallocated buffer filled with recv_into and read through memoryviews.
+        Unread bytes are moved to the front when space runs out, and the buffer only grows when the frame
+        being received, or the average frame size, needs more room.
+
+        :param initial_size: Bytes allocated up front.
+        :param min_read: Smallest number of bytes each read asks for.
+        :param max_read: Largest number of bytes each read asks for, unless a single frame needs more.
+        """
+        self.data = bytearray(initial_size)
+        self.start = 0  # First unread byte
+        self.end = 0  # One past the last unread byte
+        self.min_read = min_read
+        self.max_read = max_read
+        self.average_frame = min_read / 2
+        self.expected = 0  # Size of the frame being received, if its header said so
+
+        self.reads = 0
+        self.bytes_received = 0
+        self.resizes = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def read_size(self) -> int:
+        """
+        Gets how many bytes the next read should ask for, twice the average frame within [min_read, max_read].
+
+        :return: Number of bytes.
+        """
+        return int(min(max(2 * self.average_frame, self.min_read), self.max_read))
+
+    def reserve(self, size: int):
+        """
+        Makes sure a frame of size bytes, starting at the first unread byte, fits in the buffer.
+
+        :param size: Total size of the frame being received.
+        """
+        self.expected = size
+        if self.start + size > len(self.data):
+            self._make_room(size - len(self), exact=True)
+
+    def _make_room(self, free: int, exact: bool = False):
+        unread = len(self)
+        needed = unread + free
+        if needed > len(self.data):
+            size = needed if exact else max(needed, 2 * len(self.data))  # Unknown sizes grow geometrically
+        elif len(self.data) > 4 * max(needed, self.min_read):
+            size = max(needed, self.min_read)  # Shrink after a burst of large frames
+        else:
+            size = None
+        if size is not None:
+            data = bytearray(size)
+            data[:unread] = self.data[self.start:self.end]
+            self.data = data
+            self.resizes += 1
+        else:
+            self.data[:unread] = self.data[self.start:self.end]
+        self.start, self.end = 0, unread
+
+    def recv_into(self, connection) -> int:
+        """
+        Reads from a socket straight into the free space at the end of the buffer.
+
+        :param connection: Socket to read from.
+        :return: Number of bytes read, 0 if the peer closed the connection.
+        """
+        remaining = self.expected - len(self)
+        if remaining > 0:  # reserve() made room for the rest of the frame, read exactly that much or less
+            size = min(remaining, self.read_size())
+        else:
+            size = self.read_size()
+        if len(self.data) - self.end < size:
+            self._make_room(size)
+        with memoryview(self.data) as view:
+            received = connection.recv_into(view[self.end:])
+        self.end += received
+        self.reads += 1
+        self.bytes_received += received
+        return received
+
+    def write(self, received: bytes):
+        """
+        Appends bytes read by other means, such as an asyncio stream.
+
+        :param received: Bytes received.
+        """
+        if len(self.data) - self.end < len(received):
+            self._make_room(len(received))
+        self.data[self.end:self.end + len(received)] = received
+        self.end += len(received)
+        self.reads += 1
+        self.bytes_received += len(received)
+
+    def take(self, size: int) -> bytes:
+        """
+        Removes bytes from the front of the buffer.
+
+        :param size: Number of bytes to remove.
+        :return: The bytes removed.
+        """
+        with memoryview(self.data) as view:
+            taken = bytes(view[self.start:self.start + size])
+        self.consume(size)
+        return taken
+
+    def consume(self, size: int):
+        """
+        Marks bytes at the front of the buffer as read.
+
+        :param size: Number of bytes read.
+        """
+        self.start += size
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def observe(self, size: int):
+        """
+        Records the size of a complete frame, reads are sized from the moving average.
+
+        :param size: Size of the frame in bytes.
+        """
+        self.average_frame += (size - self.average_frame) / 8
+        self.expected = 0
+
+    def stats(self) -> dict:
+        """
+        Gets receive counters.
+
+        :return: Dictionary of reads, bytes_received, resizes, capacity and average_frame.
+        """
+        return {'reads': self.reads, 'bytes_received': self.bytes_received, 'resizes': self.resizes,
+                'capacity': len(self.data), 'average_frame': self.average_frame}
+
+
+class ChannelScheduler(object):
+
+    def __init__(self, fragment_size: int = 16384):
+        """
+        Initialise ChannelScheduler, splits messages of logical channels into fragments and hands them out
+        in priority order. Lower priorities go first, channels of equal priority take turns fragment by fragment,
+        so a large message on one channel only delays another channel by a single fragment.
+
+        :param fragment_size: Largest fragment in bytes.
+        """
+        self.fragment_size = fragment_size
+        self.lock = threading.Lock()
+        self.sent = threading.Condition(self.lock)  # Notified when a channel has no fragments left or draining stops
+        self.queues = {}  # channel: deque of (fragment, last, flags), only channels with fragments waiting
+        self.priorities = {}  # channel: priority, the channel id if never set
+        self.order = []  # heap of (priority, sequence, channel), one entry per channel in queues
+        self.sequence = 0
+        self.draining = False  # True while a sender is taking fragments, other senders only queue
+
+    def set_priority(self, channel: int, priority: int):
+        """
+        Sets the priority of a channel, applied from its next fragment.
+
+        :param channel: Channel id.
+        :param priority: Priority, lower is sent first.
+        """
+        with self.lock:
+            self.priorities[channel] = priority
+
+    def _schedule(self, channel: int):
+        self.sequence += 1
+        heapq.heappush(self.order, (self.priorities.get(channel, channel), self.sequence, channel))
+
+    def enqueue(self, channel: int, payload, last: bool = True, flags: int = 0):
+        """
+        Queues a message on a channel, must be called with lock held.
+
+        :param channel: Channel id.
+        :param payload: Bytes-like message to send.
+        :param last: If False the final fragment is not marked last, for parts of a stream.
+        :param flags: Flags carried by every fragment.
+        """
+        view = memoryview(payload)
+        queue = self.queues.get(channel)
+        if queue is None:
+            queue = self.queues[channel] = collections.deque()
+            self._schedule(channel)
+        for start in range(0, max(len(view), 1), self.fragment_size):
+            end = start + self.fragment_size >= len(view)
+            queue.append((view[start:start + self.fragment_size], last and end, flags))
+
+    def next(self) -> tuple:
+        """
+        Takes the next fragment to send, must be called with lock held.
+
+        :return: Tuple of (channel, fragment, last fragment of the message, flags), None if nothing is queued.
+        """
+        if not self.order:
+            return None
+        _, _, channel = heapq.heappop(self.order)
+        queue = self.queues[channel]
+        fragment, last, flags = queue.popleft()
+        if queue:
+            self._schedule(channel)  # Behind channels of equal priority that are waiting
+        else:
+            del self.queues[channel]
+            self.sent.notify_all()
+        return channel, fragment, last, flags
+
+    def stop_draining(self):
+        """
+        Releases the sender role, must be called with lock held.
+        """
+        self.draining = False
+        self.sent.notify_all()
@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
-from Peer import Peer, Client
+from Peer import BACKLOG, Peer, Client
+from AsyncPeer import AsyncClient
 from Modules import MicrophoneModule, TimeModule, MonitorModule, PeerModule
+from Schema import SCHEMA
+from Shards import Shard, ShardedServer
 import argparse
+import functools
 import sys
 from typing import Callable
 
@@ -26,12 +30,12 @@ class Singleton(object):
 class ClientBuilder(Singleton):  # Decorator Factory Singleton
     _client: Peer = None
 
-    def init(self, name, host, port, _debug):
-        self._client = Client(name, host, port, _debug)
+    def init(self, name, host, port, _debug, engine: Callable[..., Peer] = Client, **options):
+        self._client = engine(name, host, port, _debug, **options)
 
     def __add__(self, module: Callable[[Peer], PeerModule]):
-        self._client = module(self._client)
-        self._client.set_message_handler(self._client.process_message)
+        self._client = module(self._client)  # Registers the modules prefix with the innermost peer
+        self._client.set_message_handler(self._client.dispatch_message)
         return self
 
     def start(self):
@@ -41,20 +45,153 @@ class ClientBuilder(Singleton):  # Decorator Factory Singleton
         self._client.stop()
 
 
+def parse_target(text: str) -> tuple:
+    """
+    Parses a microphone target, NAME@IP:PORT=MESSAGE. Messages of registered commands are sent typed.
+
+    :param text: The target.
+    :return: Tuple of (peer_name, (ip, port), message) for MicrophoneModule.
+    """
+    peer, _, rest = text.partition('@')
+    address, _, message = rest.partition('=')
+    ip, _, port = address.rpartition(':')
+    if not peer or not ip or not port.isdigit() or not message:
+        raise argparse.ArgumentTypeError('expected NAME@IP:PORT=MESSAGE, got {0}'.format(text))
+    parsed = SCHEMA.parse_text(message)
+    return peer, (ip, int(port)), parsed if parsed is not None else message
+
+
+def shard_options(options: dict, index: int) -> dict:
+    """
+    Gets the options of a worker of a sharded peer. The first worker runs with the options as given, the others
+    do not announce the peer and serve metrics on the next ports, or on the socket path suffixed with their index.
+
+    :param options: Keyword arguments of the engine.
+    :param index: Index of the worker.
+    :return: Keyword arguments of the engine for the worker.
+    """
+    options = dict(options)
+    if index:
+        options['discovery'] = False
+        endpoint = options.get('metrics_endpoint')
+        if isinstance(endpoint, int):
+            options['metrics_endpoint'] = endpoint + index
+        elif endpoint is not None:
+            options['metrics_endpoint'] = '{0}.{1}'.format(endpoint, index)
+    return options
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='This is Saga...')
     parser.add_argument('-n', '--name', help='name of this peer', type=str)
     parser.add_argument('--host', help='interface to listen to for incoming connections', type=str)
     parser.add_argument('-p', '--port', help='the port to accept connections', type=int)
     parser.add_argument('-d', '--debug', help='enables debug mode', action='store_true')
+    parser.add_argument('--asyncio', help='runs every connection on a single asyncio event loop', action='store_true')
+    parser.add_argument('--framing', help='framing offered to peers, binary requires upgraded peers',
+                        choices=('eom', 'binary'), default='eom')
+    parser.add_argument('--cipher', help='cipher offered to peers, AEAD ciphers require upgraded peers',
+                        choices=('cbc', 'aes-gcm', 'chacha20-poly1305'), default='cbc')
+    parser.add_argument('--curve', help='curve offered for the key exchange, P-256 requires upgraded peers',
+                        choices=('brainpoolP256r1', 'P-256'), default='brainpoolP256r1')
+    parser.add_argument('--resumption', help='resume cached sessions on reconnect, requires upgraded peers',
+                        action='store_true')
+    parser.add_argument('--flush-latency', help='seconds outgoing messages may wait to be sent together',
+                        type=float, default=0.0)
+    parser.add_argument('--mux', help='carry prioritised channels over one connection, requires an AEAD cipher',
+                        action='store_true')
+    parser.add_argument('--compress', help='compression offered to peers, requires an AEAD cipher',
+                        choices=('zlib', 'lzma'))
+    parser.add_argument('--compress-threshold', help='messages shorter than this many bytes are not compressed',
+                        type=int, default=256)
+    parser.add_argument('--compress-dict', help='file holding a preset zlib dictionary shared with peers', type=str)
+    parser.add_argument('--schema', help='send registered commands as binary messages, requires an AEAD cipher',
+                        action='store_true')
+    parser.add_argument('--pipeline', help='send messages one round trip sooner on new connections, '
+                                           'requires upgraded peers', action='store_true')
+    parser.add_argument('--metrics', help='records handshake, encryption and handler latency, answers '
+                                          'BUILTIN-STATS-REQ from peers', action='store_true')
+    parser.add_argument('--metrics-endpoint', help='port on 127.0.0.1, or Unix socket path, serving metrics as JSON',
+                        type=str)
+    parser.add_argument('--target', help='peer the microphone messages, NAME@IP:PORT=MESSAGE, may be repeated '
+                                         '(default: the targets of this peers name)', type=parse_target,
+                        action='append')
+    parser.add_argument('--target-interval', help='seconds between microphone messages', type=float, default=5.0)
+    parser.add_argument('--group', help='offer group messages encrypted once for every member, requires upgraded '
+                                        'peers', action='store_true')
+    parser.add_argument('--discovery', help='announce this peer and find others by UDP multicast on the LAN',
+                        action='store_true')
+    parser.add_argument('--discovery-interval', help='seconds between announcements', type=float, default=30.0)
+    parser.add_argument('--discovery-secret', help='shared secret authenticating announcements', type=str)
+    parser.add_argument('--reconnect-base', help='seconds before reconnecting to a target whose connection closed, '
+                                                 'doubled after every failed attempt', type=float, default=0.5)
+    parser.add_argument('--reconnect-cap', help='largest number of seconds between reconnect attempts',
+                        type=float, default=60.0)
+    parser.add_argument('--backlog', help='incoming connections that may wait to be accepted', type=int,
+                        default=BACKLOG)
+    parser.add_argument('--handshake-workers', help='handshakes of incoming connections running at the same time',
+                        type=int, default=16)
+    parser.add_argument('--handshake-timeout', help='seconds an incoming connection may take to complete the '
+                                                    'handshake', type=float, default=10.0)
+    parser.add_argument('--crypto-processes', help='processes encrypting messages for every connection, 0 encrypts '
+                                                   'on each connection, ignored with --asyncio', type=int, default=0)
+    parser.add_argument('--shards', help='worker processes sharing the port, each owning part of the connections, '
+                                         '0 runs a single process', type=int, default=0)
+    parser.add_argument('--timers', help='file saving pending timers and alarms across restarts', type=str)
+    parser.add_argument('--keys', help='directory to save the identity key and peer keys in', type=str)
+    parser.add_argument('--handler-workers', help='threads running message handlers, 0 runs them inline',
+                        type=int, default=0)
+    parser.add_argument('--handler-queue', help='received messages that may wait for a handler thread',
+                        type=int, default=1024)
+    parser.add_argument('--handler-policy', help='what to do with messages when the handler queue is full',
+                        choices=('block', 'drop'), default='block')
+    parser.add_argument('--gossip-interval', help='seconds between rounds exchanging changed peer list entries, '
+                                                  '0 requests full peer lists at start up', type=float, default=0.0)
+    parser.add_argument('--gossip-fanout', help='peers gossiped with per round', type=int, default=3)
     args_ = parser.parse_args()
 
     name_ = args_.name if args_.name else NAME
     host_ = args_.host if args_.host else HOST
     port_ = args_.port if args_.port else PORT
 
-    client = ClientBuilder(name_, host_, port_, _debug=args_.debug)
-    client = client + MicrophoneModule + TimeModule + MonitorModule
+    options_ = {'framing': args_.framing, 'cipher': args_.cipher, 'curve': args_.curve,
+                'resumption': args_.resumption, 'mux': args_.mux, 'key_directory': args_.keys,
+                'handler_workers': args_.handler_workers, 'handler_queue': args_.handler_queue,
+                'handler_policy': args_.handler_policy, 'gossip_interval': args_.gossip_interval,
+                'gossip_fanout': args_.gossip_fanout, 'compression': args_.compress,
+                'compression_threshold': args_.compress_threshold, 'schema': args_.schema,
+                'pipeline': args_.pipeline, 'metrics': args_.metrics, 'group': args_.group,
+                'discovery': args_.discovery, 'discovery_interval': args_.discovery_interval,
+                'reconnect_base': args_.reconnect_base, 'reconnect_cap': args_.reconnect_cap,
+                'backlog': args_.backlog, 'handshake_workers': args_.handshake_workers,
+                'handshake_timeout': args_.handshake_timeout}
+    if args_.discovery_secret:
+        options_['discovery_secret'] = args_.discovery_secret.encode('utf-8')
+    if args_.metrics_endpoint:
+        endpoint_ = args_.metrics_endpoint
+        options_['metrics_endpoint'] = int(endpoint_) if endpoint_.isdigit() else endpoint_
+    if args_.compress_dict:
+        with open(args_.compress_dict, 'rb') as dictionary_file:
+            options_['compression_dictionary'] = dictionary_file.read()
+    if not args_.asyncio:  # asyncio transports already coalesce writes, and asyncio peers encrypt on the loop
+        options_['flush_latency'] = args_.flush_latency
+        options_['crypto_processes'] = args_.crypto_processes
+
+    def build(shard: Shard = None) -> ClientBuilder:
+        # Only the first worker messages the microphone targets, every worker keeps its own timers
+        index = shard.index if shard is not None else 0
+        timers = '{0}.{1}'.format(args_.timers, index) if args_.timers and index else args_.timers
+        engine_ = AsyncClient if args_.asyncio else Client
+        builder = ClientBuilder(name_, host_, port_, _debug=args_.debug, engine=engine_, shard=shard,
+                                **shard_options(options_, index))
+        microphone = functools.partial(MicrophoneModule, targets=[] if index else args_.target,
+                                       interval=args_.target_interval)
+        return builder + microphone + functools.partial(TimeModule, timers_path=timers) + MonitorModule
+
+    if args_.shards > 1:
+        client = ShardedServer(build, args_.shards, name_, args_.keys, _debug=args_.debug)
+    else:
+        client = build()
     try:
         client.start()
 
@@ -1,29 +1,61 @@
+import asyncio
 import random
 import base64
+import collections
 import hashlib
 import socket
+import struct
+import time
+from typing import Callable
 
 from Crypto import Random
-from Crypto.Cipher import AES
-from tinyec.ec import Point
-from tinyec import registry
-import secrets
+from Crypto.Cipher import AES, ChaCha20_Poly1305
+from Buffers import ChannelScheduler, OutboundQueue, ReceiveBuffer
+from Compression import Compressor, dictionary_id
+from CryptoPool import CryptoPool
+from Groups import GroupFrame
+from KeyExchange import backends
+from KeyStore import KeyStore
+from Metrics import ConnectionMetrics
+from Schema import ENVELOPE, SCHEMA
+from Sessions import SessionCache
+from Streams import iter_chunks
+
+
+DEFAULT_CURVE = 'brainpoolP256r1'
+HELLO_LIMIT = 2 ** 13  # Largest framed hello or ack accepted, in bytes, the peer is not authenticated yet
 
 
 class EncryptionProtocol(object):
+    aead_ciphers = {
+        'aes-gcm': lambda key, nonce: AES.new(key, AES.MODE_GCM, nonce=nonce),
+        'chacha20-poly1305': lambda key, nonce: ChaCha20_Poly1305.new(key=key, nonce=nonce),
+    }
+    tag_size = 16
 
-    def __init__(self, key, nonce1, nonce2):
+    def __init__(self, key, nonce1, nonce2, cipher: str = 'cbc', initiator: bool = False):
         """
         Initialise EncryptionProtocol Object.
 
         :param key: Master Key for communication between two peers.
         :param nonce1: Number-Used-Once, used for encryption to prevent replay attacks.
         :param nonce2: Number-Used-Once, used for decryption to prevent replay attacks.
+        :param cipher: 'cbc' for AES-CBC with a separate sha256 mac, or one of aead_ciphers.
+        :param initiator: True if this side opened the connection, keeps the AEAD nonces of both directions apart.
         """
         self.key = hashlib.sha256(repr(key).encode()).digest()
         self.prefix = 'SAGA'
         self.nonce_1 = nonce1
         self.nonce_2 = nonce2
+        self.cipher = cipher
+
+        if cipher != 'cbc':
+            # Bind the key to this session's nonces, the counters alone are not unique across sessions.
+            first, second = (nonce2, nonce1) if initiator else (nonce1, nonce2)
+            self.key = hashlib.sha256(self.key + struct.pack('!QQ', first, second)).digest()
+            self.new_aead = self.aead_ciphers[cipher]
+            self.send_direction = b'\x01\x00\x00\x00' if initiator else b'\x02\x00\x00\x00'
+            self.receive_direction = b'\x02\x00\x00\x00' if initiator else b'\x01\x00\x00\x00'
 
     def encrypt(self, raw):
         """
@@ -62,6 +94,62 @@ class EncryptionProtocol(object):
         cipher = AES.new(self.key, AES.MODE_CBC, iv)
         return self._unpad(cipher.decrypt(enc[AES.block_size:])).decode('utf-8')
 
+    def encode_bytes(self, raw: bytes) -> bytes:
+        """
+        Encrypts and authenticates bytes in a single AEAD pass, ciphertext + tag.
+        The nonce is the direction followed by the 64 bit message counter.
+
+        :param raw: Plaintext to be encoded.
+        :return: Ciphertext
+        """
+        if self.cipher == 'cbc':
+            return self.encode_message(raw.decode('utf-8'))
+        cipher = self.new_aead(self.key, self.send_direction + self.nonce_1.to_bytes(8, 'big'))
+        enc, tag = cipher.encrypt_and_digest(raw)
+        self.nonce_1 += 1
+        return enc + tag
+
+    def encode_parts(self, *parts) -> bytearray:
+        """
+        Encrypts several buffers as one AEAD message, the same ciphertext encode_bytes produces for them joined.
+        Each part is encrypted straight into the output, so large memoryviews are never copied into a plaintext.
+
+        :param parts: Bytes-like plaintexts, encrypted back to back.
+        :return: Ciphertext
+        """
+        if self.cipher == 'cbc':
+            raise Exception('Encrypting bytes requires an AEAD cipher.')
+        cipher = self.new_aead(self.key, self.send_direction + self.nonce_1.to_bytes(8, 'big'))
+        size = sum(len(part) for part in parts)
+        encoded = bytearray(size + self.tag_size)
+        view = memoryview(encoded)
+        start = 0
+        for part in parts:
+            if len(part):
+                cipher.encrypt(part, output=view[start:start + len(part)])
+                start += len(part)
+        view[size:] = cipher.digest()
+        self.nonce_1 += 1
+        return encoded
+
+    def decode_bytes(self, encoded: bytes) -> bytes:
+        """
+        Decrypts and verifies bytes encoded by encode_bytes.
+
+        :param encoded: Ciphertext to be decrypted.
+        :return: Plaintext of original message.
+        """
+        if self.cipher == 'cbc':
+            return self.decode_message(encoded).encode('utf-8')
+        cipher = self.new_aead(self.key, self.receive_direction + self.nonce_2.to_bytes(8, 'big'))
+        encoded = memoryview(encoded)
+        try:
+            raw = cipher.decrypt_and_verify(encoded[:-self.tag_size], encoded[-self.tag_size:])
+        except ValueError:
+            raise Exception('Invalid Message.')
+        self.nonce_2 += 1
+        return raw
+
     def encode_message(self, raw):
         """
         Encodes the plaintext, encrypt(raw) + mac(raw+nonce)
@@ -69,6 +157,8 @@ class EncryptionProtocol(object):
         :param raw: Plaintext to be encoded.
         :return: Ciphertext
         """
+        if self.cipher != 'cbc':
+            return self.encode_bytes(raw.encode('utf-8'))
         raw = self.prefix + raw
         enc = self.encrypt(raw)
         mac = self.mac(raw, self.nonce_1)
@@ -82,6 +172,8 @@ class EncryptionProtocol(object):
         :param encoded: Ciphertext to be decrypted.
         :return: Plaintext of original message.
         """
+        if self.cipher != 'cbc':
+            return self.decode_bytes(encoded).decode('utf-8')
         enc = encoded[:-44]
         mac_received = encoded[-44:]
 
@@ -97,6 +189,75 @@ class EncryptionProtocol(object):
         else:
             raise Exception('Invalid Message.')
 
+    def seal_job(self, raw: bytes) -> tuple:
+        """
+        Reserves the next send nonce for a message encrypted elsewhere by seal, e.g. on a CryptoPool.
+        Messages must be sent in the order their jobs were created.
+
+        :param raw: Plaintext.
+        :return: Job for seal.
+        """
+        if self.cipher == 'cbc':
+            job = (self.cipher, self.key, self.nonce_1, self.prefix, raw)
+        else:
+            job = (self.cipher, self.key, self.send_direction + self.nonce_1.to_bytes(8, 'big'), None, raw)
+        self.nonce_1 += 1
+        return job
+
+    def open_job(self, encoded: bytes) -> tuple:
+        """
+        Reserves the next receive nonce for a message decrypted elsewhere by open.
+        Messages must be handled in the order their jobs were created.
+
+        :param encoded: Ciphertext, bytes so it can be sent to another process.
+        :return: Job for open.
+        """
+        if self.cipher == 'cbc':
+            job = (self.cipher, self.key, self.nonce_2, self.prefix, encoded)
+        else:
+            job = (self.cipher, self.key, self.receive_direction + self.nonce_2.to_bytes(8, 'big'), None, encoded)
+        self.nonce_2 += 1
+        return job
+
+    @classmethod
+    def seal(cls, job: tuple) -> bytes:
+        """
+        Encrypts a message reserved by seal_job, produces the ciphertext encode_bytes would have.
+
+        :param job: Returned by seal_job.
+        :return: Ciphertext
+        """
+        cipher, key, nonce, prefix, raw = job
+        if cipher != 'cbc':
+            enc, tag = cls.aead_ciphers[cipher](key, nonce).encrypt_and_digest(raw)
+            return enc + tag
+        raw = prefix + raw.decode('utf-8')
+        iv = Random.new().read(AES.block_size)
+        enc = base64.b64encode(iv + AES.new(key, AES.MODE_CBC, iv).encrypt(cls._pad(raw).encode()))
+        return enc + cls.mac(raw, nonce)
+
+    @classmethod
+    def open(cls, job: tuple) -> bytes:
+        """
+        Decrypts and verifies a message reserved by open_job.
+
+        :param job: Returned by open_job.
+        :return: Plaintext, as decode_bytes returns it.
+        """
+        cipher, key, nonce, prefix, encoded = job
+        if cipher != 'cbc':
+            try:
+                return cls.aead_ciphers[cipher](key, nonce).decrypt_and_verify(encoded[:-cls.tag_size],
+                                                                                encoded[-cls.tag_size:])
+            except ValueError:
+                raise Exception('Invalid Message.')
+        enc = base64.b64decode(encoded[:-44])
+        message = cls._unpad(AES.new(key, AES.MODE_CBC, enc[:AES.block_size]).decrypt(enc[AES.block_size:]))
+        message = message.decode('utf-8')
+        if cls.mac(message, nonce) != encoded[-44:] or message[:len(prefix)] != prefix:
+            raise Exception('Invalid Message.')
+        return message[len(prefix):].encode('utf-8')
+
     @staticmethod
     def _pad(s):
         """
@@ -118,19 +279,156 @@ class EncryptionProtocol(object):
         return s[:-ord(s[len(s) - 1:])]
 
 
+class EomFraming(object):
+
+    def __init__(self, eom: str = '\x00'):
+        """
+        Initialise EomFraming, the original wire format where messages are separated by an End-Of-Message byte.
+
+        :param eom: End-Of-Message Character used to separate different messages from one another.
+        """
+        self.eom = eom.encode('utf-8')
+        self.scanned = 0  # Unread bytes already searched for eom
+
+    def frame(self, payload: bytes) -> tuple:
+        """
+        Frames a payload for sending.
+
+        :param payload: Ciphertext to be framed.
+        :return: Tuple of buffers to send back to back.
+        """
+        return payload, self.eom
+
+    def split(self, buffer: ReceiveBuffer, limit: int = None) -> list:
+        """
+        Removes every complete frame from a receive buffer.
+
+        :param buffer: ReceiveBuffer holding the bytes received.
+        :param limit: Maximum number of frames to remove, None for all of them.
+        :return: List of complete payloads received.
+        """
+        frames = []
+        end = buffer.data.find(self.eom, buffer.start + self.scanned, buffer.end)
+        while end != -1 and (limit is None or len(frames) < limit):
+            size = end - buffer.start
+            frames.append(buffer.take(size))
+            buffer.consume(len(self.eom))
+            buffer.observe(size + len(self.eom))
+            end = buffer.data.find(self.eom, buffer.start, buffer.end)
+
+        self.scanned = max(len(buffer) - len(self.eom) + 1, 0) if end == -1 else 0
+        return frames
+
+
+class BinaryFraming(object):
+    header = struct.Struct('!I')
+    GROUP_FRAME = 0x80000000  # Length bit of frames sealed with a group key, split returns them as GroupFrames
+
+    def __init__(self, max_frame_size: int = 2 ** 24):
+        """
+        Initialise BinaryFraming, each frame is a 4 byte big-endian length followed by the raw payload.
+
+        :param max_frame_size: Largest payload accepted from the peer, in bytes.
+        """
+        self.max_frame_size = max_frame_size
+        self.groups = False  # True once group frames were negotiated, they are rejected as oversized otherwise
+
+    def frame(self, payload: bytes) -> tuple:
+        """
+        Frames a payload for sending.
+
+        :param payload: Ciphertext to be framed.
+        :return: Tuple of buffers to send back to back.
+        """
+        return self.header.pack(len(payload)), payload
+
+    @classmethod
+    def frame_group(cls, payload: bytes) -> tuple:
+        """
+        Frames a payload sealed with a group key, the same buffers are sent to every member.
+
+        :param payload: Sealed message, see Groups.GroupKey.seal.
+        :return: Tuple of buffers to send back to back.
+        """
+        return cls.header.pack(len(payload) | cls.GROUP_FRAME), payload
+
+    def split(self, buffer: ReceiveBuffer, limit: int = None) -> list:
+        """
+        Removes every complete frame from a receive buffer.
+        When a frame is incomplete the buffer is grown to fit it, so the rest arrives in as few reads as possible.
+
+        :param buffer: ReceiveBuffer holding the bytes received.
+        :param limit: Maximum number of frames to remove, None for all of them.
+        :return: List of complete payloads received.
+        """
+        frames = []
+        while len(buffer) >= self.header.size and (limit is None or len(frames) < limit):
+            length, = self.header.unpack_from(buffer.data, buffer.start)
+            group = False
+            if length > self.max_frame_size:  # Flagged group frames have huge lengths too, checked only here
+                group = self.groups and length & self.GROUP_FRAME and length ^ self.GROUP_FRAME <= self.max_frame_size
+                if not group:
+                    raise Exception('Frame of {0} bytes exceeds limit of {1} bytes.'.format(length,
+                                                                                          self.max_frame_size))
+                length ^= self.GROUP_FRAME
+            size = self.header.size + length
+            if size > len(buffer):
+                buffer.reserve(size)
+                break
+            buffer.consume(self.header.size)
+            frames.append(GroupFrame(buffer.take(length)) if group else buffer.take(length))
+            buffer.observe(size)
+        return frames
+
+
 class CommunicationProtocol(object):
+    framings = {'binary': BinaryFraming, 'eom': EomFraming}
+    mux_header = struct.Struct('!HB')  # channel, flags
+    MUX_LAST = 1  # Flag of the last fragment of a message
+    MUX_STREAM = 2  # Flag of stream fragments, written to a sink as they arrive instead of reassembled
+    sealing_window = 64  # Messages of a connection on the crypto pool before its senders wait
+    MUX_OPEN = 4  # Flag of the first fragment of a stream, carries the stream name
+    MUX_ABORT = 8  # Flag of the fragment ending a stream the sender failed to read
+    max_message_size = 2 ** 26  # Largest message reassembled from fragments, in bytes
+
     def __init__(self, connection: socket.socket, address: tuple, name: str,
-                 private_key=None, public_key=None, file_prefix='', _eom='\x00', _debug: bool = False):
+                 private_key=None, public_key=None, file_prefix='', _eom='\x00', framing: str = 'eom',
+                 cipher: str = 'cbc', curve: str = DEFAULT_CURVE, session_cache: SessionCache = None,
+                 resume_peer: str = None, keystore: KeyStore = None, flush_latency: float = 0.0,
+                 flush_bytes: int = 65536, mux: bool = False, stream_handler: Callable = None,
+                 compression: str = None, compression_threshold: int = 256, compression_dictionary: bytes = None,
+                 schema: bool = False, pipeline: bool = False, group: bool = False, metrics: bool = False,
+                 crypto_pool: CryptoPool = None, _debug: bool = False):
         """
         Initialise CommunicationProtocol.
 
         :param connection: Socket object for the connection between two peers.
         :param address: Tuple of (ip, port) to connect to
         :param name: Name of this peer
-        :param private_key: Private key of this client.
-        :param public_key: Public key of this client.
+        :param private_key: Private identity key of this client, key shares are generated for every connection.
+        :param public_key: Public identity key of this client.
         :param file_prefix: File prefix for saving and loading keys.
         :param _eom: End-Of-Message Character used to separate different messages from one another.
+        :param framing: Preferred framing, 'eom' sends the original hello, 'binary' offers length-prefixed frames.
+        :param cipher: Preferred cipher, 'cbc' or an AEAD cipher which also offers binary framing.
+        :param curve: Preferred curve for the key exchange, any other than brainpoolP256r1 requires upgraded peers.
+        :param session_cache: Cache of resumable sessions, offering resumption requires upgraded peers.
+        :param resume_peer: Name of the peer expected at address, its cached ticket is offered in our hello.
+        :param keystore: KeyStore holding our identity keys, saving peer identity keys and caching validated points.
+        :param flush_latency: Seconds outgoing messages may wait to be coalesced with others, 0 sends immediately.
+        :param flush_bytes: Pending outgoing bytes that are sent without waiting for flush_latency.
+        :param mux: If True offers logical channels, requires an AEAD cipher and upgraded peers.
+        :param stream_handler: Called with (peer_name, stream_name) for every incoming stream, returns the sink the
+                               stream is written to, an object with write(data) and close(), None discards it.
+        :param compression: Preferred compression, 'zlib' or 'lzma', requires an AEAD cipher and upgraded peers.
+        :param compression_threshold: Messages shorter than this many bytes are sent uncompressed.
+        :param compression_dictionary: Preset zlib dictionary shared with peers, offered before compression.
+        :param schema: If True offers binary messages of registered commands, requires an AEAD cipher.
+        :param pipeline: If True offers the pipelined handshake, the client may send messages one round trip sooner.
+        :param group: If True offers frames sealed once with a group key for every member, requires binary framing.
+        :param metrics: If True records handshake time, encryption time and message counters, see stats.
+        :param crypto_pool: Pool messages sent and received without channels are encrypted and decrypted on,
+                            None encrypts them on the calling thread.
         :param _debug: If True prints debug information to the console; otherwise no debug information is printed.
         """
         self.my_name = name
@@ -141,22 +439,78 @@ class CommunicationProtocol(object):
         self._debug = _debug
 
         self.connection = connection
+        self.outbound = OutboundQueue(connection, flush_latency=flush_latency, flush_bytes=flush_bytes)
+        self.keystore = keystore
 
+        self.identities = {}  # curve: (private_key, public_key) of our identity, loaded by identity_keys when needed
         if private_key is not None and public_key is not None:
-            self.my_private_key = private_key
-            self.my_public_key = public_key
-        elif private_key is None and public_key is None:
-            self.my_private_key, self.my_public_key = self.generate_keys()
-        else:
+            self.identities[DEFAULT_CURVE] = (private_key, public_key)
+        elif private_key is not None or public_key is not None:
             raise Exception('Must provide either both keys or no keys.')
-
-        self.their_public_key = None
+        self.keys = {}  # curve: (private_key, public_key) of our key share, generated for this connection only
+        self.my_private_key, self.my_public_key = None, None
+        self.my_curve = DEFAULT_CURVE
+
+        self.their_public_key = None  # Key share of the peer
+        self.their_identity = None  # Identity key of the peer, presented by upgraded peers with their key share
+        self.identity_offered = False  # True if the client presented its identity, the server then presents its own
+        self.their_nonce = None
+        self.key_share_curve = None  # Curve of the key share in our last hello
         self.master_key = None
         self.my_nonce = random.randrange(2 ** 29)  # Prevent replay attacks
+        self.session_cache = session_cache
+        self.resume_peer = resume_peer
+        self.offered_session = None
+        self.resumed = None
         self.open = True
+        self.initiator = False
         self.encryption_proto = None
-        self.buffer = b''
-        self.log = ''
+        self.framer = EomFraming(_eom)
+        self.inbound = ReceiveBuffer()  # Shared by the handshake and the framer, bytes after the ack are kept
+        self.framed_handshake = None  # True if handshake messages carry a length, decided by the clients hello
+        self.handshake_deadline = None  # time.monotonic() the handshake must complete by, None only times each read
+        self.channels = ChannelScheduler()
+        self.reassembly = {}  # channel: list of fragments received so far
+        self.stream_handler = stream_handler
+        self.streams = {}  # channel: sink of the stream being received, None if it is discarded
+        self.streaming = set()  # Channels a stream is being sent on
+        self.compression_threshold = compression_threshold
+        self.compression_dictionary = compression_dictionary
+        self.compressor: Compressor = None  # Set when compression was negotiated
+        self.schema = SCHEMA
+        self.hellos = []  # Hello messages in the order they were sent and received, the log of original peers
+        self.transcript = hashlib.sha256()  # Running hash of the hellos, compared in acks of pipelined handshakes
+        self.metrics = ConnectionMetrics() if metrics else None  # None skips every measurement
+        self.crypto_pool = crypto_pool
+        self.sealing = collections.deque()  # (future, start) of messages on the crypto pool, in nonce order
+        self.seal_error = None  # Exception of a message the crypto pool failed to encrypt, the connection is closed
+
+        self.offers = {}  # feature: preferred options, sent in our hello when non-empty
+        self.negotiated = {}  # feature: option agreed with the peer
+        if framing != 'eom' or cipher != 'cbc' or group:  # AEAD ciphertext and group frames need binary framing
+            self.offers['framing'] = ['binary', 'eom']
+        if cipher != 'cbc':
+            self.offers['cipher'] = [cipher, 'cbc']
+        if curve != DEFAULT_CURVE:
+            self.offers['curve'] = [curve, DEFAULT_CURVE]
+        if mux:
+            if cipher == 'cbc':
+                raise Exception('Channels require an AEAD cipher.')
+            self.offers['mux'] = ['v1']
+        if compression is not None:
+            if cipher == 'cbc':
+                raise Exception('Compression requires an AEAD cipher.')
+            self.offers['compress'] = [compression]
+            if compression_dictionary is not None:
+                self.offers['compress'].insert(0, dictionary_id(compression_dictionary))
+        if schema:
+            if cipher == 'cbc':
+                raise Exception('Binary messages require an AEAD cipher.')
+            self.offers['schema'] = ['v1']
+        if pipeline:
+            self.offers['pipeline'] = ['v1']
+        if group:
+            self.offers['group'] = ['v1']
 
     @staticmethod
     def generate_keys():
@@ -165,11 +519,7 @@ class CommunicationProtocol(object):
 
         :return: Tuple of generated Private and Public keys.
         """
-        curve = registry.get_curve('brainpoolP256r1')
-        private_key = secrets.randbelow(curve.field.n)
-        public_key = private_key * curve.g
-
-        return private_key, public_key
+        return backends[DEFAULT_CURVE].generate_keys()
 
     @staticmethod
     def generate_nonce():
@@ -181,43 +531,408 @@ class CommunicationProtocol(object):
         return random.randrange(2 ** 29)
 
     def store_local_keys(self):
-        pass
+        """
+        Saves our identity key-pairs as the identity for file_prefix.
+        """
+        if self.keystore is not None:
+            for curve, keys in self.identities.items():
+                self.keystore.store_local_keys(self.key_prefix, *keys, backends[curve])
 
     def store_peer_keys(self):
-        pass
+        """
+        Saves the identity key the peer presented during the handshake.
+        """
+        if self.keystore is not None and self.their_identity is not None:
+            self.keystore.store_peer_key(self.key_prefix, self.peer_name, self.their_identity,
+                                         backends[self.negotiated.get('curve', DEFAULT_CURVE)])
+
+    def ensure_keys(self, curve: str = DEFAULT_CURVE):
+        """
+        Selects our key share for a curve, a key-pair generated for this connection so every session key is new.
+        Only full handshakes need one.
 
-    def send_hello(self):  # TODO: Revisit this later, sending nonce as plaintext seems irresponsible.
+        :param curve: Name of the curve.
+        """
+        if curve not in self.keys:
+            self.keys[curve] = backends[curve].generate_keys()
+        self.my_private_key, self.my_public_key = self.keys[curve]
+        self.my_curve = curve
+
+    def identity_keys(self, curve: str = DEFAULT_CURVE) -> tuple:
+        """
+        Gets our identity key-pair for a curve, loading or generating it if none was provided.
+
+        :param curve: Name of the curve.
+        :return: Tuple of Private and Public keys.
+        """
+        if curve not in self.identities:
+            if self.keystore is not None:
+                self.identities[curve] = self.keystore.load_local_keys(self.key_prefix, backends[curve])
+            else:
+                self.identities[curve] = backends[curve].generate_keys()
+        return self.identities[curve]
+
+    def sends_identity(self) -> bool:
+        """
+        Checks if our hellos present our identity key, the client does whenever it offers features,
+        the server when the client presented its own.
+
+        :return: True if our identity is sent with our key share; False otherwise.
+        """
+        return bool(self.offers) if self.initiator else self.identity_offered
+
+    def mix_identities(self, backend, secret) -> bytes:
+        """
+        Binds the master key to the identity keys of both peers.
+        Each side adds the Diffie-Hellman of its identity and the peers key share, and of its key share and the
+        peers identity, so only the holders of both identity keys agree on the key. The key shares are new for
+        every connection, so recorded sessions stay secret even if an identity key is later compromised.
+
+        :param backend: ECBackend of the negotiated curve.
+        :param secret: Diffie-Hellman of both key shares.
+        :return: The master key.
+        """
+        private_key = self.identity_keys(backend.name)[0]
+        first = backend.shared_secret(private_key, self.their_public_key)
+        second = backend.shared_secret(self.my_private_key, self.their_identity)
+        client, server = (first, second) if self.initiator else (second, first)
+        return hashlib.sha256(b'SAGA-IDENTITY' + repr(secret).encode() + repr(client).encode() +
+                              repr(server).encode()).digest()
+
+    def hello_curve(self) -> str:
+        """
+        Gets the curve of the key share in our next hello.
+        Before the server answered the client uses its preferred curve, afterwards the negotiated one.
+
+        :return: Name of the curve.
+        """
+        if self.initiator and not self.negotiated:
+            return self.offers.get('curve', [DEFAULT_CURVE])[0]
+        return self.negotiated.get('curve', DEFAULT_CURVE)
+
+    def needs_key_share(self) -> bool:
+        """
+        Checks if the client must send another hello, after its ticket was rejected or it guessed the wrong curve.
+
+        :return: True if the server cannot use our last key share; False otherwise.
+        """
+        return not self.resumed and self.key_share_curve != self.negotiated.get('curve', DEFAULT_CURVE)
+
+    def pipelined(self) -> bool:
+        """
+        Checks if the server sends its ack with its hello, when negotiated or on every resumed session,
+        so the client may send messages after a single round trip.
+
+        :return: True if the acks are pipelined; False otherwise.
+        """
+        return 'pipeline' in self.negotiated or self.resumed is not None
+
+    def send_hello(self, ack: bool = False):  # TODO: Revisit this later, sending nonce as plaintext is irresponsible.
         """
         Sends a hello message to a peer.
-        Hello - my_nonce, public_key.x, public_key.y
+        Hello - my_nonce, public_key.x, public_key.y[, features]
+
+        :param ack: If True our ack follows the hello in the same write, for pipelined handshakes.
+        """
+        message = self.frame_handshake(self.create_hello())
+        if ack:
+            message += self.frame_handshake(self.create_ack())
+        self.check_deadline()
+        self.connection.sendall(message)
+
+    def create_hello(self) -> bytes:
         """
-        message = ','.join((repr(self.my_nonce), repr(self.my_public_key.x), repr(self.my_public_key.y)))
-        self.connection.send(message.encode())
-        self.log += message
+        Creates a hello message and records it in the message log.
+        The public key is left empty when the client offers a resumption ticket or the server accepted one.
+
+        :return: The encoded hello message.
+        """
+        if self.initiator and self.session_cache is not None and not self.negotiated:
+            self.offered_session = self.session_cache.get(self.resume_peer) if self.resume_peer else None
+            self.offers['resume'] = [self.offered_session.ticket if self.offered_session else 'new']
+        if self.initiator and self.framed_handshake is None:
+            self.framed_handshake = bool(self.offers)  # Only upgraded peers understand offers, so length prefixes
+
+        features = {k: [v] for k, v in self.negotiated.items()} if self.negotiated else dict(self.offers)
+        if self.resumed or self.offered_session and not self.negotiated:
+            fields = [repr(self.my_nonce), '', '']
+        else:
+            self.key_share_curve = self.hello_curve()
+            self.ensure_keys(self.key_share_curve)
+            fields = [repr(self.my_nonce)] + [repr(xy) for xy in backends[self.key_share_curve].encode_public(
+                self.my_public_key)]
+        if self.sends_identity() and (self.initiator or len(fields[1])):  # The server presents it with key shares
+            backend = backends[self.hello_curve()]
+            features['identity'] = ['{0:x}.{1:x}'.format(*backend.encode_public(
+                self.identity_keys(backend.name)[1]))]
+
+        if features:
+            fields.append(self.encode_features(features))
+        message = ','.join(fields).encode()
+        self.record_hello(message)
+        return message
+
+    def record_hello(self, message: bytes):
+        """
+        Adds a hello message to the transcript of the handshake.
+
+        :param message: Bytes of the hello message.
+        """
+        self.hellos.append(message)
+        self.transcript.update(message)
+
+    def handshake_log(self) -> str:
+        """
+        Gets what the acks of both peers must agree on.
+        Pipelined handshakes compare the hash of the hellos, original peers compare the hellos themselves.
+
+        :return: The hex digest of the transcript, or the hellos joined together.
+        """
+        if 'pipeline' in self.negotiated:
+            return self.transcript.hexdigest()
+        return b''.join(self.hellos).decode()
 
     def receive_hello(self):
         """
         Receives a hello message from peer.
-        Hello - their_nonce, public_key.x, public_key.y
-        Stores their nonce and public key.
-        Uses their public key and our private key to generate a master key.
         """
-        response = self.connection.recv(1024)
-        nonce, pub_x, pub_y = response.decode().split(',')
-        self.their_public_key = Point(registry.get_curve('brainpoolP256r1'), int(pub_x), int(pub_y))
-        their_nonce = int(nonce)
+        self.process_hello(self.read_handshake())
+
+    def frame_handshake(self, message: bytes) -> bytes:
+        """
+        Frames a handshake message, prefixing its length when both peers understand framed handshakes.
+
+        :param message: Hello or ack to send.
+        :return: Bytes to send.
+        """
+        if self.framed_handshake:
+            return BinaryFraming.header.pack(len(message)) + message
+        return message
+
+    def read_handshake(self) -> bytes:
+        """
+        Reads one handshake message.
+        Framed handshakes are read until the whole message arrived, bytes after it stay buffered for later messages.
+        Original peers send no length, their messages are taken from a single read.
+        The server recognises a framed hello by its first byte, a length below 2 ** 24 starts with 0
+        where an original hello starts with a digit of the nonce.
+
+        :return: Bytes of the handshake message.
+        """
+        message = self.buffered_handshake()
+        while message is None:
+            self.check_deadline()
+            if self.inbound.recv_into(self.connection) == 0:
+                raise ConnectionError('Connection closed during handshake')
+            message = self.buffered_handshake()
+        return message
+
+    def check_deadline(self):
+        """
+        Limits the next blocking read or write of the handshake to the time left before handshake_deadline,
+        so a peer sending a byte at a time cannot stretch the handshake over many socket timeouts.
+        """
+        if self.handshake_deadline is not None:
+            remaining = self.handshake_deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout('Handshake timed out')
+            self.connection.settimeout(remaining)
+
+    def buffered_handshake(self) -> bytes:
+        """
+        Takes one handshake message from the receive buffer.
+        Framed handshake messages are limited to HELLO_LIMIT bytes, the session limit only applies once the peer
+        is authenticated.
+
+        :return: Bytes of the handshake message, None if it has not fully arrived.
+        """
+        if not len(self.inbound):
+            return None
+        if self.framed_handshake is None:
+            self.framed_handshake = self.inbound.data[self.inbound.start] == 0
+        if not self.framed_handshake:
+            return self.inbound.take(len(self.inbound))
+        message = BinaryFraming(max_frame_size=HELLO_LIMIT).split(self.inbound, limit=1)
+        return message[0] if message else None
+
+    def process_hello(self, response: bytes):
+        """
+        Processes a hello message from peer.
+        Hello - their_nonce, public_key.x, public_key.y[, features]
+        Stores their nonce, key share and, from upgraded peers, identity key.
+        Uses their key share and ours to generate a master key, bound to both identities when they were presented,
+        or the cached secret when a session is resumed.
+
+        :param response: Bytes of the hello message received.
+        """
+        self.record_hello(bytes(response))
+        nonce, pub_x, pub_y, *features = response.decode().split(',')
+        self.their_nonce = int(nonce)
+        their_curve = DEFAULT_CURVE
+        identity = None
+        if features:
+            features = self.decode_features(features[0])
+            their_curve = features.get('curve', [DEFAULT_CURVE])[0]
+            resume = features.pop('resume', None)
+            identity = features.pop('identity', None)
+            self.apply_features(features)
+            if resume is not None:
+                self.apply_resume(resume[0])
+        curve = self.negotiated.get('curve', DEFAULT_CURVE)
+        if identity is not None and not self.initiator:
+            self.identity_offered = True
+
+        if pub_x and their_curve == curve:
+            backend = backends[curve]
+            self.ensure_keys(curve)
+            self.their_public_key = backend.decode_public(int(pub_x), int(pub_y))
+            self.master_key = backend.shared_secret(self.my_private_key, self.their_public_key)
+            if self.sends_identity():
+                if identity is None:
+                    raise Exception('Peer did not present its identity.')
+                x, _, y = identity[0].partition('.')
+                if self.keystore is not None:
+                    self.their_identity = self.keystore.point(backend, int(x, 16), int(y, 16))
+                else:
+                    self.their_identity = backend.decode_public(int(x, 16), int(y, 16))
+                self.master_key = self.mix_identities(backend, self.master_key)
+        elif self.resumed:
+            client_nonce, server_nonce = (self.my_nonce, self.their_nonce) if self.initiator else \
+                (self.their_nonce, self.my_nonce)
+            self.master_key = hashlib.sha256(b'SAGA-RESUME' + self.resumed.secret +
+                                             struct.pack('!QQ', client_nonce, server_nonce)).digest()
+        else:
+            return  # Unknown ticket or a key share on another curve, the clients key share follows in a second hello
+
+        self.encryption_proto = EncryptionProtocol(self.master_key, self.their_nonce, self.my_nonce,
+                                                   cipher=self.negotiated.get('cipher', 'cbc'),
+                                                   initiator=self.initiator)
+
+    def apply_resume(self, option: str):
+        """
+        Handles the resume feature of a hello.
+        The server looks the offered ticket up, the client learns if the server accepted it.
+
+        :param option: A ticket or 'new' from the client, 'ok' or 'new' from the server.
+        """
+        if not self.initiator:
+            if self.session_cache is None:
+                return
+            self.resumed = self.session_cache.pop_ticket(option) if option != 'new' else None
+            self.negotiated['resume'] = 'ok' if self.resumed else 'new'
+        else:
+            if 'resume' not in self.offers:
+                raise Exception('Peer chose unsupported resume {0}'.format(option))
+            if option == 'ok' and self.offered_session:
+                self.resumed = self.offered_session
+            elif self.offered_session:
+                self.session_cache.remove(self.resume_peer)
+            self.negotiated['resume'] = option
+
+    def store_session(self):
+        """
+        Caches a resumption secret for the peer once the handshake has been verified.
+        """
+        if self.session_cache is not None and 'resume' in self.negotiated:
+            if self.resumed and self.resumed.peer_name != self.peer_name and not self.initiator:
+                raise Exception('Under Attack')
+            secret = hashlib.sha256(b'SAGA-RESUMPTION' + self.encryption_proto.key +
+                                    self.handshake_log().encode()).digest()
+            self.session_cache.store(self.peer_name, secret)
+
+    @staticmethod
+    def encode_features(features: dict) -> str:
+        """
+        Encodes features for a hello message.
+
+        :param features: Dictionary of feature: list of options, most preferred first.
+        :return: Features as 'feature=option|option;feature=option'.
+        """
+        return ';'.join('{0}={1}'.format(feature, '|'.join(options)) for feature, options in features.items())
+
+    @staticmethod
+    def decode_features(features: str) -> dict:
+        """
+        Decodes features from a hello message.
 
-        self.master_key = self.my_private_key * self.their_public_key
-        self.encryption_proto = EncryptionProtocol(self.master_key, their_nonce, self.my_nonce)
+        :param features: Features as 'feature=option|option;feature=option'.
+        :return: Dictionary of feature: list of options.
+        """
+        decoded = {}
+        for feature in filter(None, features.split(';')):
+            name, _, options = feature.partition('=')
+            decoded[name] = options.split('|')
+        return decoded
+
+    def supported(self, feature: str) -> tuple:
+        """
+        Gets the options this side supports for a feature.
 
-        self.log += response.decode()
+        :param feature: Name of the feature.
+        :return: Tuple of supported options.
+        """
+        if feature == 'framing':
+            return tuple(self.framings.keys())
+        if feature == 'cipher':
+            return tuple(EncryptionProtocol.aead_ciphers.keys()) + ('cbc',)
+        if feature == 'curve':
+            return tuple(backends.keys())
+        if feature in ('mux', 'schema', 'pipeline', 'group'):
+            return 'v1',
+        if feature == 'compress':
+            presets = (dictionary_id(self.compression_dictionary),) if self.compression_dictionary else ()
+            return presets + ('zlib', 'lzma')
+        return ()
+
+    def apply_features(self, features: dict):
+        """
+        Agrees features with the peer.
+        The server picks the first option offered it supports.
+        The client receives the servers choices, which must be among the options it offered.
+
+        :param features: Dictionary of feature: list of options from the peers hello.
+        """
+        if not self.initiator:
+            for feature, options in features.items():
+                for option in options:
+                    if option in self.supported(feature):
+                        self.negotiated[feature] = option
+                        break
+            if self.negotiated.get('framing') != 'binary':
+                self.negotiated.pop('cipher', None)
+                self.negotiated.pop('group', None)
+            if self.negotiated.get('cipher', 'cbc') == 'cbc':
+                self.negotiated.pop('mux', None)  # Fragments are bytes, the CBC api encrypts text
+                self.negotiated.pop('compress', None)
+                self.negotiated.pop('schema', None)
+        else:
+            for feature, options in features.items():
+                if feature not in self.offers or options[0] not in self.offers[feature]:
+                    raise Exception('Peer chose unsupported {0} {1}'.format(feature, options[0]))
+                self.negotiated[feature] = options[0]
+
+        if self.negotiated.get('framing', 'eom') == 'binary':
+            self.framer = BinaryFraming()
+            self.framer.groups = 'group' in self.negotiated
+        if 'compress' in self.negotiated:
+            self.compressor = Compressor(self.negotiated['compress'], self.compression_threshold,
+                                         self.compression_dictionary, max_size=self.max_message_size)
 
     def send_ack(self):
         """
         Sends entire message log to peer.
         """
-        ack = ','.join((self.log, self.my_name))
-        self.connection.send(self.encryption_proto.encode_message(ack))
+        self.check_deadline()
+        self.connection.sendall(self.frame_handshake(self.create_ack()))
+
+    def create_ack(self) -> bytes:
+        """
+        Creates an encrypted ack containing the entire message log.
+
+        :return: The encrypted ack.
+        """
+        ack = ','.join((self.handshake_log(), self.my_name))
+        return self.encryption_proto.encode_message(ack)
 
     def receive_ack(self):
         """
@@ -225,46 +940,405 @@ class CommunicationProtocol(object):
 
         :return: The peers log.
         """
-        bytes_ack = self.connection.recv(1024)
+        return self.process_ack(self.read_handshake())
+
+    def process_ack(self, bytes_ack: bytes) -> list:
+        """
+        Decrypts an ack received from the peer.
+
+        :param bytes_ack: The encrypted ack.
+        :return: List of [peer log, peer name].
+        """
         ack = self.encryption_proto.decode_message(bytes_ack)
         ack = ack.split(',')
         ack = [','.join(ack[:-1]), ack[-1]]
         return ack
 
-    def send_message(self, message):
+    def send_message(self, message, channel: int = 0):
         """
         Encrypts plaintext and sends the ciphertext to the peer.
+        With channels, the message is queued on its channel and sent fragment by fragment in priority order,
+        by this thread unless another one is already sending.
 
         :param message: Plaintext message to send to the peer
+        :param channel: Channel to send the message on, ignored unless channels were negotiated.
+        """
+        if 'mux' not in self.negotiated:
+            if self.crypto_pool is not None:
+                self.send_pooled(message)
+                return
+            with self.outbound.lock:  # Frames must be queued in the order their nonces were used
+                message = self.encode_payload(message)
+                self.outbound.push(*self.framer.frame(message))
+            return
+
+        with self.channels.lock:
+            self.channels.enqueue(channel, self.compress_message(message))
+        self.drain_channels()
+
+    def send_pooled(self, message):
         """
-        message = self.encryption_proto.encode_message(message)
-        self.connection.send(message + bytes(self._eom, 'utf-8'))
+        Encrypts a message on the crypto pool and returns without waiting for it.
+        Nonces are reserved in order under the outbound lock, and the callback of each message queues it once it
+        and every message before it are encrypted, so frames are sent in nonce order however the pool completes
+        them, and a single connection keeps several messages on the pool. The sender only waits once
+        sealing_window messages of the connection are on the pool.
 
-    def buffer_split_received(self, received):
+        :param message: Plaintext message, or a message created by a command of the schema.
         """
-        Splits and buffers messages as needed.
-        If a message is too long for the size of the socket buffer, the socket buffer is emptied into a buffer variable.
-        If multiple messages are received, the messages are split up and returned in a list.
-        Does both if multiple messages are sent where at least one message is shorter than the socket buffer size.
+        if self.seal_error is not None:
+            raise self.seal_error
+        start = time.perf_counter() if self.metrics is not None else 0.0
+        with self.outbound.lock:
+            if self.compressor is None and 'schema' not in self.negotiated:
+                raw = str(message).encode('utf-8')
+            else:
+                raw = self.compress_message(message)
+            future = self.crypto_pool.submit(EncryptionProtocol.seal, self.encryption_proto.seal_job(raw))
+            self.sealing.append((future, start))
+            oldest = self.sealing[0][0] if len(self.sealing) > self.sealing_window else None
+        future.add_done_callback(self.queue_sealed)
+        if oldest is not None:
+            oldest.exception()  # Waits for room on the pool
+
+    def queue_sealed(self, _future=None):
+        """
+        Queues the oldest messages encrypted on the crypto pool, in nonce order.
+        Runs on the thread of the pool completing them, so frames are written by the FlushScheduler, which only
+        sends what the socket takes without waiting.
+        A message that fails to encrypt leaves a gap in the nonces, the connection is shut down and the error is
+        raised by the next send.
+        """
+        with self.outbound.lock:
+            while self.sealing and self.sealing[0][0].done():
+                future, start = self.sealing.popleft()
+                if self.seal_error is not None:
+                    continue
+                if future.exception() is not None:
+                    self.seal_error = future.exception()
+                    if self._debug:
+                        print('[ERROR] Encrypting for {0}: {1}'.format(self.peer_name, self.seal_error))
+                    try:
+                        self.connection.shutdown(socket.SHUT_RDWR)  # The receive loop closes the connection
+                    except OSError:
+                        pass
+                    continue
+                encoded = future.result()
+                self.outbound.push_deferred(*self.framer.frame(encoded))
+                if self.metrics is not None:
+                    self.metrics.sent(len(encoded), time.perf_counter() - start)
+
+    def wait_sealed(self):
+        """
+        Waits until every message on the crypto pool is queued, e.g. before the connection is closed.
+        """
+        while True:
+            with self.outbound.lock:
+                if not self.sealing or self.seal_error is not None:
+                    return
+                future = self.sealing[0][0]
+            future.exception()  # Outside the lock, the callback queueing it takes the lock
+            self.queue_sealed()
+
+    def send_frame(self, buffers: tuple):
+        """
+        Sends a frame that was encrypted once for several connections, e.g. by BinaryFraming.frame_group,
+        in order with the messages of this connection.
 
-        :param received: Bytes received by socket.
-        :return: List of messages received.
+        :param buffers: Tuple of buffers to send back to back.
         """
-        received = received.decode('utf-8')  # Convert received ciphertext to utf-8
-        messages = []
-        x = 0  # Start of message position
-        for i in range(0, len(received), 1):
-            if received[i] == self._eom:
-                messages.append(bytes(received[x:i], 'utf-8'))
-                x = i+1
+        with self.outbound.lock:
+            self.outbound.push(*buffers)
 
-        if len(messages) > 0:  # If an eom was received, complete the first message from buffer
-            messages[0] = self.buffer + messages[0]
-            self.buffer = b''
+    def compress_message(self, message) -> bytes:
+        """
+        Encodes a message, compressed if compression was negotiated.
+        Messages of registered commands are sent in the binary envelope if the peer agreed to the schema,
+        as their text form otherwise.
 
-        self.buffer = self.buffer + bytes(received[x:], 'utf-8')  # Update Buffer
+        :param message: Plaintext message, or a message created by a command of the schema.
+        :return: Bytes to encrypt.
+        """
+        if isinstance(message, str):
+            raw = message.encode('utf-8')
+        elif 'schema' in self.negotiated:
+            raw = self.schema.encode(message)
+        else:
+            raw = str(message).encode('utf-8')
+        return raw if self.compressor is None else self.compressor.compress(raw)
 
-        return messages  # return List of messages received
+    def decompress_message(self, payload):
+        """
+        Decodes a message encoded by compress_message on the peer.
+
+        :param payload: Decrypted bytes.
+        :return: Plaintext message, the parsed message if it was sent in the binary envelope,
+                 None if its command is not registered here or the message is malformed.
+        """
+        if self.compressor is not None:
+            payload = self.compressor.decompress(payload)
+        if payload[:1] == ENVELOPE and 'schema' in self.negotiated:
+            message = self.schema.decode(payload)
+            if message is None and self._debug:
+                print('[UNKNOWN COMMAND] Unregistered or malformed FROM {0}'.format(self.peer_name))
+            return message
+        return str(payload, 'utf-8')
+
+    def encode_payload(self, message):
+        """
+        Compresses and encrypts a message sent without channels.
+
+        :param message: Plaintext message, or a message created by a command of the schema.
+        :return: Ciphertext
+        """
+        start = time.perf_counter() if self.metrics is not None else 0.0
+        if self.compressor is None and 'schema' not in self.negotiated:
+            encoded = self.encryption_proto.encode_message(str(message))
+        else:
+            encoded = self.encryption_proto.encode_bytes(self.compress_message(message))
+        if self.metrics is not None:
+            self.metrics.sent(len(encoded), time.perf_counter() - start)
+        return encoded
+
+    def decode_payload(self, response):
+        """
+        Decrypts and decompresses a message received without channels.
+
+        :param response: Ciphertext
+        :return: Plaintext or parsed message, see decompress_message.
+        """
+        if self.compressor is None and 'schema' not in self.negotiated:
+            return self.encryption_proto.decode_message(response)
+        return self.decompress_message(self.encryption_proto.decode_bytes(response))
+
+    def compression_stats(self) -> dict:
+        """
+        Gets the compression ratio and CPU time of this connection.
+
+        :return: Dictionary of statistics, empty if compression was not negotiated.
+        """
+        return self.compressor.stats() if self.compressor is not None else {}
+
+    def stats(self) -> dict:
+        """
+        Gets the counters of this connection, buffer sizes and the negotiated features,
+        with handshake time, encryption time and message rates if metrics are enabled.
+
+        :return: Dictionary of statistics.
+        """
+        result = {'address': '{0}:{1}'.format(*self.address[:2]), 'negotiated': dict(self.negotiated),
+                  'outbound': self.outbound.stats(), 'inbound': self.inbound.stats(),
+                  'pending_bytes': self.outbound.pending_bytes,
+                  'channels_queued': sum(len(queue) for queue in list(self.channels.queues.values()))}
+        if self.compressor is not None:
+            result['compression'] = self.compressor.stats()
+        if self.metrics is not None:
+            result.update(self.metrics.snapshot())
+        return result
+
+    def drain_channels(self):
+        """
+        Sends queued fragments in priority order until every channel is empty.
+        Returns at once if another thread is already sending them.
+        """
+        with self.channels.lock:
+            if self.channels.draining:
+                return
+            self.channels.draining = True
+        try:
+            while True:
+                with self.outbound.lock:
+                    with self.channels.lock:
+                        fragment = self.channels.next()
+                        if fragment is None:
+                            self.channels.stop_draining()
+                            return
+                    self.outbound.push(*self.encode_fragment(*fragment))
+        except BaseException:
+            with self.channels.lock:
+                self.channels.stop_draining()
+            raise
+
+    def send_stream(self, source, name: str = '', channel: int = 1, chunk_size: int = None) -> int:
+        """
+        Streams a file or other large payload to the peer, chunk by chunk, on a channel.
+        Each chunk is encrypted straight from a memory mapping or memoryview and the next one is only read once
+        it has been sent, so memory use does not depend on the size of the payload.
+        Messages on other channels are sent in between chunks by priority.
+
+        :param source: File path, binary file object, bytes-like object or iterable of bytes-like objects.
+        :param name: Name of the stream, passed to the peers stream handler, e.g. a file name.
+        :param channel: Channel to send on, one stream per channel at a time.
+        :param chunk_size: Bytes per chunk, the fragment size of the channels if None.
+        :return: Number of bytes streamed.
+        """
+        name = self.open_stream(name, channel)
+        sent = 0
+        try:
+            self.send_stream_fragment(channel, name, self.MUX_OPEN)
+            for chunk in iter_chunks(source, chunk_size or self.channels.fragment_size):
+                self.send_stream_fragment(channel, chunk)
+                sent += len(chunk)
+        except BaseException:
+            if self.open:
+                try:
+                    self.send_stream_fragment(channel, b'', self.MUX_ABORT, last=True)
+                except OSError:
+                    pass  # The connection failed, the peer aborts the stream when it closes
+            raise
+        else:
+            self.send_stream_fragment(channel, b'', last=True)
+        finally:
+            with self.channels.lock:
+                self.streaming.discard(channel)
+        return sent
+
+    def open_stream(self, name: str, channel: int) -> bytes:
+        """
+        Claims a channel for an outgoing stream.
+
+        :param name: Name of the stream.
+        :param channel: Channel to send on.
+        :return: Encoded name of the stream.
+        """
+        if 'mux' not in self.negotiated:
+            raise Exception('Streams require channels.')
+        name = name.encode('utf-8')
+        if len(name) > self.channels.fragment_size:
+            raise Exception('Stream name exceeds {0} bytes.'.format(self.channels.fragment_size))
+        with self.channels.lock:
+            if channel in self.streaming:
+                raise Exception('Channel {0} is already streaming.'.format(channel))
+            self.streaming.add(channel)
+        return name
+
+    def send_stream_fragment(self, channel: int, data, flags: int = 0, last: bool = False):
+        """
+        Queues one chunk of a stream and returns once it has been sent, by this thread or the one draining.
+
+        :param channel: Channel of the stream.
+        :param data: Bytes-like chunk.
+        :param flags: Flags besides MUX_STREAM.
+        :param last: True for the fragment ending the stream.
+        """
+        with self.channels.lock:
+            self.channels.enqueue(channel, data, last, self.MUX_STREAM | flags)
+        while True:
+            self.drain_channels()
+            with self.channels.lock:
+                while channel in self.channels.queues and self.channels.draining:
+                    self.channels.sent.wait()
+                if channel not in self.channels.queues:
+                    return
+
+    def set_channel_priority(self, channel: int, priority: int):
+        """
+        Sets the priority of a channel, by default a channels priority is its id so channel 0 goes first.
+
+        :param channel: Channel id.
+        :param priority: Priority, lower is sent first.
+        """
+        self.channels.set_priority(channel, priority)
+
+    def encode_fragment(self, channel: int, fragment, last: bool, flags: int = 0) -> tuple:
+        """
+        Encrypts and frames one fragment of a message, the channel header is encrypted with it.
+
+        :param channel: Channel id.
+        :param fragment: Bytes-like part of the message.
+        :param last: True if this is the last fragment of the message.
+        :param flags: Other flags of the fragment.
+        :return: Tuple of buffers to send back to back.
+        """
+        start = time.perf_counter() if self.metrics is not None else 0.0
+        header = self.mux_header.pack(channel, flags | self.MUX_LAST if last else flags)
+        encoded = self.encryption_proto.encode_parts(header, fragment)
+        if self.metrics is not None:
+            self.metrics.sent(len(encoded), time.perf_counter() - start, last)
+        return self.framer.frame(encoded)
+
+    def decode_fragment(self, response: bytes):
+        """
+        Decrypts one fragment and reassembles the message of its channel.
+
+        :param response: Ciphertext of the fragment.
+        :return: The message once its last fragment arrived, None otherwise.
+        """
+        raw = memoryview(self.encryption_proto.decode_bytes(response))
+        channel, flags = self.mux_header.unpack_from(raw)
+        if flags & self.MUX_STREAM:
+            self.receive_stream_fragment(channel, flags, raw[self.mux_header.size:])
+            return None
+        fragments = self.reassembly.setdefault(channel, [])
+        fragments.append(raw[self.mux_header.size:])
+        if not flags & self.MUX_LAST:
+            if len(fragments) * self.channels.fragment_size > self.max_message_size:
+                raise Exception('Message on channel {0} exceeds limit of {1} bytes.'.format(channel,
+                                                                                       self.max_message_size))
+            return None
+        del self.reassembly[channel]
+        return self.decompress_message(b''.join(fragments))
+
+    def receive_stream_fragment(self, channel: int, flags: int, data: memoryview):
+        """
+        Writes one fragment of an incoming stream to its sink, opening the sink on the first fragment.
+
+        :param channel: Channel of the stream.
+        :param flags: Flags of the fragment.
+        :param data: Decrypted chunk.
+        """
+        if flags & self.MUX_OPEN:
+            name = bytes(data).decode('utf-8')
+            self.streams[channel] = self.stream_handler(self.peer_name, name) if self.stream_handler else None
+            if self._debug:
+                print('[STREAM] \"{0}\" FROM {1} on channel {2}'.format(name, self.peer_name, channel))
+            return
+        if channel not in self.streams:
+            raise Exception('Stream fragment on channel {0} without an open stream.'.format(channel))
+        sink = self.streams[channel]
+        if flags & self.MUX_ABORT:
+            del self.streams[channel]
+            self.abort_sink(sink)
+            return
+        if sink is not None and len(data):
+            sink.write(data)
+        if flags & self.MUX_LAST:
+            del self.streams[channel]
+            if sink is not None:
+                sink.close()
+
+    @staticmethod
+    def abort_sink(sink):
+        if sink is None:
+            return
+        if hasattr(sink, 'abort'):
+            sink.abort()
+        else:
+            sink.close()
+
+    def abort_streams(self):
+        """
+        Aborts every incoming stream, called when the connection closes.
+        """
+        streams, self.streams = self.streams, {}
+        for sink in streams.values():
+            try:
+                self.abort_sink(sink)
+            except Exception as e:
+                print(str(e))
+
+    def buffer_split_received(self, received):
+        """
+        Splits and buffers messages as needed using the negotiated framing.
+        Incomplete messages stay in the receive buffer until the rest arrives.
+        If multiple messages are received, the messages are split up and returned in a list.
+
+        :param received: Bytes received by socket, None if they were already read into the receive buffer.
+        :return: List of messages received.
+        """
+        if received:
+            self.inbound.write(received)
+        return self.framer.split(self.inbound)
 
     def receive_message(self) -> list:
         """
@@ -273,51 +1347,136 @@ class CommunicationProtocol(object):
         :return: The message receives.
         """
         try:
-            byte_string = self.connection.recv(1024)
+            if len(self.inbound):  # Messages that arrived together with the handshake
+                messages = self.process_received()
+                if messages:
+                    return messages
 
-            if len(byte_string) == 0:  # Received emptystring from peer, connection was terminated unexpectedly
+            if self.inbound.recv_into(self.connection) == 0:  # Peer closed, connection was terminated unexpectedly
                 self.close_connection()  # Make sure sockets are closed
                 return []
 
-            responses = self.buffer_split_received(byte_string)
-            messages = []
-
-            if responses:
-                for response in responses:
-                    message = self.encryption_proto.decode_message(response)
-                    messages.append(message)
-
-            return messages
+            return self.process_received()
 
         except ConnectionError:
             self.open = False
             return ['END']
 
+    def process_received(self, byte_string: bytes = None) -> list:
+        """
+        Buffers received bytes and decrypts every complete message.
+
+        :param byte_string: Bytes received from the peer, None if they were already read into the receive buffer.
+        :return: List of decrypted messages.
+        """
+        responses = self.buffer_split_received(byte_string)
+        messages = []
+
+        if responses and self.crypto_pool is not None and 'mux' not in self.negotiated:
+            return self.process_pooled(responses)
+        if responses:
+            metrics = self.metrics
+            groups = 'group' in self.negotiated
+            for response in responses:
+                if groups and response.__class__ is GroupFrame:  # Opened by the peer, which holds the group keys
+                    messages.append(response)
+                    continue
+                start = time.perf_counter() if metrics is not None else 0.0
+                if 'mux' in self.negotiated:
+                    message = self.decode_fragment(response)
+                else:
+                    message = self.decode_payload(response)
+                if metrics is not None:
+                    metrics.received(len(response), time.perf_counter() - start, message is not None)
+                if message is None:
+                    continue
+                messages.append(message)
+
+        return messages
+
+    def process_pooled(self, responses: list) -> list:
+        """
+        Decrypts messages received without channels on the crypto pool, all of them at once.
+
+        :param responses: Frames received.
+        :return: List of decrypted messages, in the order they were received.
+        """
+        start = time.perf_counter() if self.metrics is not None else 0.0
+        text = self.compressor is None and 'schema' not in self.negotiated
+        pending = []
+        for response in responses:
+            if response.__class__ is GroupFrame:  # Opened by the peer, which holds the group keys
+                pending.append(response)
+            else:
+                pending.append(self.crypto_pool.submit(EncryptionProtocol.open,
+                                                       self.encryption_proto.open_job(bytes(response))))
+        messages = []
+        for response, future in zip(responses, pending):
+            if future.__class__ is GroupFrame:
+                messages.append(future)
+                continue
+            raw = future.result()
+            message = str(raw, 'utf-8') if text else self.decompress_message(raw)
+            if self.metrics is not None:
+                self.metrics.received(len(response), (time.perf_counter() - start) / len(responses))
+            if message is not None:
+                messages.append(message)
+        return messages
+
     def close_connection(self):
         """
         Closes the connection to the peer.
         """
         if self.open:
             try:
+                self.wait_sealed()
+                self.outbound.flush()
                 self.connection.shutdown(socket.SHUT_RDWR)
             except OSError:
                 pass
             self.connection.close()
             self.open = False
+            self.abort_streams()
             if self._debug:
                 print('[TERMINATED] Connection {0}@{1}:{2}'.format(self.peer_name, self.address[0], self.address[1]))
 
-    def establish_encrypted_connection_ss(self):
+    def establish_encrypted_connection_ss(self, timeout: float = None):
         """
         Establishes an encrypted connection from the Server-Side.
+        Pipelined handshakes send our ack with our hello, the client then acks and may send messages at once.
+
+        :param timeout: Seconds the whole handshake may take, the socket is left blocking once it completes.
+                        None leaves the timeout of the socket as it is.
+        """
+        if timeout is not None:
+            self.handshake_deadline = time.monotonic() + timeout
+        try:
+            self.handshake_ss()
+        finally:
+            self.handshake_deadline = None
+        if timeout is not None:
+            self.connection.settimeout(None)
+
+    def handshake_ss(self):
+        """
+        Runs the messages of the Server-Side handshake.
         """
         self.receive_hello()
-        self.send_hello()
+        pipelined = self.pipelined()
+        self.send_hello(ack=pipelined and self.encryption_proto is not None)
+        if self.encryption_proto is None:  # Unknown ticket, fall back to a full handshake
+            self.receive_hello()
+            if pipelined:
+                self.send_ack()
         ack = self.receive_ack()
         self.peer_name = ack[1]
-        self.send_ack()
-        if ack[0] != self.log:
-            raise Exception('Under Attack')
+        self.verify_ack(ack)
+        if not pipelined:
+            self.send_ack()
+        self.store_session()
+        self.store_peer_keys()
+        if self.metrics is not None:
+            self.metrics.handshake_done()
         if self._debug:
             print('[ESTABLISHED] Connection FROM {0}@{1}:{2}'.format(self.peer_name, self.address[0], self.address[1]))
 
@@ -326,16 +1485,52 @@ class CommunicationProtocol(object):
         Establishes an encrypted connection from the Client-Side.
         """
         self.open = True
+        self.initiator = True
         self.send_hello()
         self.receive_hello()
-        self.send_ack()
-        ack = self.receive_ack()
-        self.peer_name = ack[1]
-        if ack[0] != self.log:
-            raise Exception('UnderAttack')
+        if self.needs_key_share():  # Ticket rejected or server chose another curve, send our key share
+            self.send_hello()
+        if self.pipelined():  # The servers ack is already on its way, ours is followed by messages
+            ack = self.receive_ack()
+            self.peer_name = ack[1]
+            self.verify_ack(ack)
+            self.set_nodelay()
+            self.send_ack()
+        else:
+            self.send_ack()
+            ack = self.receive_ack()
+            self.peer_name = ack[1]
+            self.verify_ack(ack)
+        self.store_session()
+        self.store_peer_keys()
+        if self.metrics is not None:
+            self.metrics.handshake_done()
         if self._debug:
             print('[ESTABLISHED] Connection TO {0}@{1}:{2}'.format(self.peer_name, self.address[0], self.address[1]))
 
+    def set_nodelay(self):
+        """
+        Disables Nagle's algorithm, so messages sent right behind our ack do not wait for the peer to acknowledge it.
+        """
+        try:
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass  # Not a TCP socket
+
+    def verify_ack(self, ack: list):
+        """
+        Checks the peers log matches our own, and that a peer we know presented the identity it did before.
+
+        :param ack: List of [peer log, peer name] as returned by process_ack.
+        """
+        if ack[0] != self.handshake_log():
+            raise Exception('Under Attack')
+        if self.keystore is not None and self.their_identity is not None:
+            backend = backends[self.negotiated.get('curve', DEFAULT_CURVE)]
+            known = self.keystore.get_peer_key(self.key_prefix, ack[1], backend)
+            if known is not None and backend.encode_public(known) != backend.encode_public(self.their_identity):
+                raise Exception('Identity of {0} changed.'.format(ack[1]))
+
     def get_peer_name(self):
         """
         Gets name of peer.
@@ -381,7 +1576,285 @@ class CommunicationProtocol(object):
         if type(other) is tuple:
             if other[0] == self.address[0] and other[1] == self.address[1]:
                 result = True
-        elif type(other) is CommunicationProtocol:
+        elif isinstance(other, CommunicationProtocol):
             if other.get_address()[0] == self.address[0] and other.get_address()[1] == self.address[1]:
                 result = True
         return result
+
+
+class AsyncCommunicationProtocol(CommunicationProtocol):
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, address: tuple, name: str,
+                 private_key=None, public_key=None, file_prefix='', _eom='\x00', framing: str = 'eom',
+                 cipher: str = 'cbc', curve: str = DEFAULT_CURVE, session_cache: SessionCache = None,
+                 resume_peer: str = None, keystore: KeyStore = None, mux: bool = False,
+                 stream_handler: Callable = None, compression: str = None, compression_threshold: int = 256,
+                 compression_dictionary: bytes = None, schema: bool = False, pipeline: bool = False,
+                 group: bool = False, metrics: bool = False, _debug: bool = False):
+        """
+        Initialise AsyncCommunicationProtocol, a CommunicationProtocol running on asyncio streams.
+        The wire format is identical to CommunicationProtocol so both can talk to each other.
+
+        :param reader: StreamReader for the connection between two peers.
+        :param writer: StreamWriter for the connection between two peers.
+        :param address: Tuple of (ip, port) to connect to
+        :param name: Name of this peer
+        :param private_key: Private identity key of this client, key shares are generated for every connection.
+        :param public_key: Public identity key of this client.
+        :param file_prefix: File prefix for saving and loading keys.
+        :param _eom: End-Of-Message Character used to separate different messages from one another.
+        :param framing: Preferred framing, 'eom' sends the original hello, 'binary' offers length-prefixed frames.
+        :param cipher: Preferred cipher, 'cbc' or an AEAD cipher which also offers binary framing.
+        :param curve: Preferred curve for the key exchange, any other than brainpoolP256r1 requires upgraded peers.
+        :param session_cache: Cache of resumable sessions, offering resumption requires upgraded peers.
+        :param resume_peer: Name of the peer expected at address, its cached ticket is offered in our hello.
+        :param keystore: KeyStore holding our identity keys, saving peer identity keys and caching validated points.
+        :param mux: If True offers logical channels, requires an AEAD cipher and upgraded peers.
+        :param stream_handler: Called with (peer_name, stream_name) for every incoming stream, returns its sink.
+        :param compression: Preferred compression, 'zlib' or 'lzma', requires an AEAD cipher and upgraded peers.
+        :param compression_threshold: Messages shorter than this many bytes are sent uncompressed.
+        :param compression_dictionary: Preset zlib dictionary shared with peers, offered before compression.
+        :param schema: If True offers binary messages of registered commands, requires an AEAD cipher.
+        :param pipeline: If True offers the pipelined handshake, the client may send messages one round trip sooner.
+        :param group: If True offers frames sealed once with a group key for every member, requires binary framing.
+        :param metrics: If True records handshake time, encryption time and message counters, see stats.
+        :param _debug: If True prints debug information to the console; otherwise no debug information is printed.
+        """
+        super().__init__(writer.get_extra_info('socket'), address, name, private_key=private_key,
+                         public_key=public_key, file_prefix=file_prefix, _eom=_eom, framing=framing, cipher=cipher,
+                         curve=curve, session_cache=session_cache, resume_peer=resume_peer, keystore=keystore,
+                         mux=mux, stream_handler=stream_handler, compression=compression,
+                         compression_threshold=compression_threshold,
+                         compression_dictionary=compression_dictionary, schema=schema, pipeline=pipeline,
+                         group=group, metrics=metrics, _debug=_debug)
+        self.reader = reader
+        self.writer = writer
+        self.drain_task: asyncio.Task = None
+
+    async def send_hello(self, ack: bool = False):
+        """
+        Sends a hello message to a peer, any key generation is run in the default executor.
+
+        :param ack: If True our ack follows the hello in the same write, for pipelined handshakes.
+        """
+        hello = await asyncio.get_running_loop().run_in_executor(None, self.create_hello)
+        message = self.frame_handshake(hello)
+        if ack:
+            message += self.frame_handshake(self.create_ack())
+        self.writer.write(message)
+        await self.writer.drain()
+
+    async def receive_hello(self):
+        """
+        Receives a hello message from peer, the key agreement is run in the default executor.
+        """
+        response = await self.read_handshake()
+        await asyncio.get_running_loop().run_in_executor(None, self.process_hello, response)
+
+    async def read_handshake(self) -> bytes:
+        """
+        Reads one handshake message, see CommunicationProtocol.read_handshake.
+
+        :return: Bytes of the handshake message.
+        """
+        message = self.buffered_handshake()
+        while message is None:
+            received = await self.reader.read(self.inbound.read_size())
+            if not received:
+                raise ConnectionError('Connection closed during handshake')
+            self.inbound.write(received)
+            message = self.buffered_handshake()
+        return message
+
+    async def send_ack(self):
+        """
+        Sends entire message log to peer.
+        """
+        self.writer.write(self.frame_handshake(self.create_ack()))
+        await self.writer.drain()
+
+    async def receive_ack(self):
+        """
+        Receives the entire message log of the peer.
+
+        :return: The peers log.
+        """
+        return self.process_ack(await self.read_handshake())
+
+    def send_message(self, message, channel: int = 0):
+        """
+        Encrypts plaintext and queues the ciphertext on the stream, must be called from the event loop.
+        With channels, fragments are written by a task that waits whenever the transport buffer is full,
+        so fragments of higher priority channels can overtake.
+
+        :param message: Plaintext message to send to the peer
+        :param channel: Channel to send the message on, ignored unless channels were negotiated.
+        """
+        if 'mux' not in self.negotiated:
+            message = self.encode_payload(message)
+            self.writer.writelines(self.framer.frame(message))
+            return
+
+        with self.channels.lock:
+            self.channels.enqueue(channel, self.compress_message(message))
+        if self.drain_task is None:
+            self.drain_task = asyncio.get_running_loop().create_task(self.drain_channels())
+
+    def send_frame(self, buffers: tuple):
+        """
+        Queues a frame that was encrypted once for several connections, must be called from the event loop.
+
+        :param buffers: Tuple of buffers to send back to back.
+        """
+        self.writer.writelines(buffers)
+
+    async def send_stream(self, source, name: str = '', channel: int = 1, chunk_size: int = None) -> int:
+        """
+        Streams a file or other large payload to the peer, see CommunicationProtocol.send_stream.
+
+        :param source: File path, binary file object, bytes-like object or iterable of bytes-like objects.
+        :param name: Name of the stream, passed to the peers stream handler, e.g. a file name.
+        :param channel: Channel to send on, one stream per channel at a time.
+        :param chunk_size: Bytes per chunk, the fragment size of the channels if None.
+        :return: Number of bytes streamed.
+        """
+        name = self.open_stream(name, channel)
+        sent = 0
+        try:
+            await self.send_stream_fragment(channel, name, self.MUX_OPEN)
+            for chunk in iter_chunks(source, chunk_size or self.channels.fragment_size):
+                await self.send_stream_fragment(channel, chunk)
+                sent += len(chunk)
+        except BaseException:
+            if self.open:
+                try:
+                    await self.send_stream_fragment(channel, b'', self.MUX_ABORT, last=True)
+                except OSError:
+                    pass  # The connection failed, the peer aborts the stream when it closes
+            raise
+        else:
+            await self.send_stream_fragment(channel, b'', last=True)
+        finally:
+            with self.channels.lock:
+                self.streaming.discard(channel)
+        return sent
+
+    async def send_stream_fragment(self, channel: int, data, flags: int = 0, last: bool = False):
+        """
+        Queues one chunk of a stream and waits until the drain task has written it.
+
+        :param channel: Channel of the stream.
+        :param data: Bytes-like chunk.
+        :param flags: Flags besides MUX_STREAM.
+        :param last: True for the fragment ending the stream.
+        """
+        with self.channels.lock:
+            self.channels.enqueue(channel, data, last, self.MUX_STREAM | flags)
+        while channel in self.channels.queues:
+            if not self.open:
+                raise ConnectionError('Connection closed while streaming')
+            if self.drain_task is None:
+                self.drain_task = asyncio.get_running_loop().create_task(self.drain_channels())
+            await asyncio.shield(self.drain_task)
+
+    async def drain_channels(self):
+        """
+        Writes queued fragments in priority order until every channel is empty.
+        """
+        try:
+            while True:
+                with self.channels.lock:
+                    fragment = self.channels.next()
+                if fragment is None:
+                    return
+                self.writer.writelines(self.encode_fragment(*fragment))
+                if self.writer.transport.get_write_buffer_size() >= self.channels.fragment_size:
+                    await self.writer.drain()
+        except ConnectionError:
+            self.close_connection()
+        finally:
+            self.drain_task = None
+
+    async def receive_message(self) -> list:
+        """
+        Receive a message from the peer.
+
+        :return: The message receives.
+        """
+        try:
+            if len(self.inbound):  # Messages that arrived together with the handshake
+                messages = self.process_received()
+                if messages:
+                    return messages
+
+            byte_string = await self.reader.read(self.inbound.read_size())
+
+            if len(byte_string) == 0:  # Received emptystring from peer, connection was terminated unexpectedly
+                self.close_connection()
+                return []
+
+            return self.process_received(byte_string)
+
+        except ConnectionError:
+            self.open = False
+            return ['END']
+
+    def close_connection(self):
+        """
+        Closes the connection to the peer.
+        """
+        if self.open:
+            self.writer.close()
+            self.open = False
+            self.abort_streams()
+            if self._debug:
+                print('[TERMINATED] Connection {0}@{1}:{2}'.format(self.peer_name, self.address[0], self.address[1]))
+
+    async def establish_encrypted_connection_ss(self):
+        """
+        Establishes an encrypted connection from the Server-Side.
+        """
+        await self.receive_hello()
+        pipelined = self.pipelined()
+        await self.send_hello(ack=pipelined and self.encryption_proto is not None)
+        if self.encryption_proto is None:  # Unknown ticket, fall back to a full handshake
+            await self.receive_hello()
+            if pipelined:
+                await self.send_ack()
+        ack = await self.receive_ack()
+        self.peer_name = ack[1]
+        self.verify_ack(ack)
+        if not pipelined:
+            await self.send_ack()
+        self.store_session()
+        self.store_peer_keys()
+        if self.metrics is not None:
+            self.metrics.handshake_done()
+        if self._debug:
+            print('[ESTABLISHED] Connection FROM {0}@{1}:{2}'.format(self.peer_name, self.address[0], self.address[1]))
+
+    async def establish_encrypted_connection_cs(self):
+        """
+        Establishes an encrypted connection from the Client-Side.
+        """
+        self.open = True
+        self.initiator = True
+        await self.send_hello()
+        await self.receive_hello()
+        if self.needs_key_share():  # Ticket rejected or server chose another curve, send our key share
+            await self.send_hello()
+        if self.pipelined():  # The servers ack is already on its way, ours is followed by messages
+            ack = await self.receive_ack()
+            self.peer_name = ack[1]
+            self.verify_ack(ack)
+            await self.send_ack()
+        else:
+            await self.send_ack()
+            ack = await self.receive_ack()
+            self.peer_name = ack[1]
+            self.verify_ack(ack)
+        self.store_session()
+        self.store_peer_keys()
+        if self.metrics is not None:
+            self.metrics.handshake_done()
+        if self._debug:
+            print('[ESTABLISHED] Connection TO {0}@{1}:{2}'.format(self.peer_name, self.address[0], self.address[1]))
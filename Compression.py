@@ -0,0 +1,155 @@
+import collections
+import hashlib
+import lzma
+import threading
+import time
+import zlib
+
+RAW = b'\x00'
+COMPRESSED = b'\x01'
+
+
+def dictionary_id(dictionary: bytes) -> str:
+    """
+    Names a preset dictionary, peers only agree on it if both hold the same bytes.
+
+    :param dictionary: Preset dictionary.
+    :return: Option name 'zdict-' followed by 8 hex digits of its sha256.
+    """
+    return 'zdict-' + hashlib.sha256(dictionary).hexdigest()[:8]
+
+
+def train_dictionary(samples, size: int = 32768) -> bytes:
+    """
+    Builds a zlib preset dictionary from sample messages.
+    Deflate finds matches closest to the end of the dictionary cheapest, so the most frequent samples go last.
+
+    :param samples: Iterable of sample messages, str or bytes.
+    :param size: Largest dictionary in bytes, deflate uses at most the last 32 KiB.
+    :return: The dictionary.
+    """
+    counts = collections.Counter(sample.encode('utf-8') if isinstance(sample, str) else bytes(sample)
+                                 for sample in samples)
+    dictionary = b''
+    for sample, _ in counts.most_common():
+        if len(dictionary) + len(sample) > size:
+            break
+        dictionary = sample + dictionary
+    return dictionary
+
+
+class Compressor(object):
+
+    def __init__(self, algorithm: str, threshold: int = 256, dictionary: bytes = None, level: int = None,
+                 max_size: int = 2 ** 26):
+        """
+        Initialise Compressor, compresses each message on its own before it is encrypted.
+        Every payload starts with one byte, RAW or COMPRESSED, messages below the threshold or that do not shrink
+        are sent raw so small messages cost a single byte.
+
+        :param algorithm: 'zlib', 'lzma' or a zdict option, zlib with the preset dictionary.
+        :param threshold: Messages shorter than this many bytes are not compressed.
+        :param dictionary: Preset dictionary, required by zdict options.
+        :param level: Compression level, the algorithms default if None.
+        :param max_size: Largest decompressed message accepted, in bytes.
+        """
+        self.algorithm = algorithm
+        self.threshold = threshold
+        self.max_size = max_size
+        self.level = 6 if level is None else level
+        self.dictionary = None
+        if algorithm == 'lzma':
+            self.filters = [{'id': lzma.FILTER_LZMA2, 'preset': self.level}]
+        elif algorithm.startswith('zdict-'):
+            if dictionary is None or dictionary_id(dictionary) != algorithm:
+                raise Exception('Preset dictionary {0} is not available.'.format(algorithm))
+            self.dictionary = dictionary
+        elif algorithm != 'zlib':
+            raise Exception('Unknown compression {0}'.format(algorithm))
+
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.compress_time = 0.0
+        self.decompress_time = 0.0
+
+    def _compress(self, raw) -> bytes:
+        if self.algorithm == 'lzma':
+            return lzma.compress(raw, format=lzma.FORMAT_RAW, filters=self.filters)
+        if self.dictionary is None:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        else:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, zdict=self.dictionary)
+        return compressor.compress(raw) + compressor.flush()
+
+    def _decompress(self, compressed) -> bytes:
+        if self.algorithm == 'lzma':
+            decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_RAW, filters=self.filters)
+            raw = decompressor.decompress(compressed, self.max_size)
+            exceeded = not decompressor.eof and not decompressor.needs_input
+        else:
+            if self.dictionary is None:
+                decompressor = zlib.decompressobj(-15)
+            else:
+                decompressor = zlib.decompressobj(-15, zdict=self.dictionary)
+            raw = decompressor.decompress(compressed, self.max_size)
+            exceeded = bool(decompressor.unconsumed_tail)
+        if exceeded:
+            raise Exception('Compressed message exceeds limit of {0} bytes.'.format(self.max_size))
+        return raw
+
+    def compress(self, raw: bytes) -> bytes:
+        """
+        Compresses a message if it is large enough and shrinks.
+
+        :param raw: Plaintext message.
+        :return: Payload, RAW or COMPRESSED followed by the message.
+        """
+        if len(raw) < self.threshold:
+            payload = RAW + raw
+            cpu = 0.0
+        else:
+            start = time.thread_time()
+            compressed = self._compress(raw)
+            cpu = time.thread_time() - start
+            payload = COMPRESSED + compressed if len(compressed) < len(raw) else RAW + raw
+        with self.lock:
+            self.messages += 1
+            self.compressed += payload[:1] == COMPRESSED
+            self.bytes_in += len(raw)
+            self.bytes_out += len(payload)
+            self.compress_time += cpu
+        return payload
+
+    def decompress(self, payload) -> bytes:
+        """
+        Restores a message produced by compress on the peer.
+
+        :param payload: RAW or COMPRESSED followed by the message.
+        :return: Plaintext message.
+        """
+        payload = memoryview(payload)
+        if payload[:1] == RAW:
+            return bytes(payload[1:])
+        if payload[:1] != COMPRESSED:
+            raise Exception('Invalid Message.')
+        start = time.thread_time()
+        raw = self._decompress(payload[1:])
+        with self.lock:
+            self.decompress_time += time.thread_time() - start
+        return raw
+
+    def stats(self) -> dict:
+        """
+        Gets compression counters of the messages sent, and the CPU time spent both ways.
+
+        :return: Dictionary of algorithm, messages, compressed, bytes_in, bytes_out, ratio,
+                 compress_cpu_ms and decompress_cpu_ms.
+        """
+        with self.lock:
+            return {'algorithm': self.algorithm, 'messages': self.messages, 'compressed': self.compressed,
+                    'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out,
+                    'ratio': self.bytes_out / self.bytes_in if self.bytes_in else 1.0,
+                    'compress_cpu_ms': self.compress_time * 1000, 'decompress_cpu_ms': self.decompress_time * 1000}
@@ -0,0 +1,250 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Awaitable, Callable
+
+from CommunicationProtocols import CommunicationProtocol
+
+
+class ConnectionRegistry(object):
+
+    def __init__(self):
+        """
+        Initialise ConnectionRegistry, the open connections and known peers of a Peer.
+        Connections are indexed by peer name and by (ip, port), known peers by name and by (ip, port),
+        every lookup is a dictionary lookup and every change is made under one lock.
+        """
+        self.lock = threading.RLock()
+        self.by_name = {}  # peer_name: CommunicationProtocol
+        self.by_address = {}  # (ip, port): CommunicationProtocol
+        self.addresses = {}  # id(CommunicationProtocol): (ip, port) it is indexed under
+        self.pending = {}  # (ip, port): Future of the connect in progress
+        self.peers = {}  # peer_name: (ip, port)
+        self.peer_names = {}  # (ip, port): peer_name
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.by_name
+
+    def __len__(self):
+        return len(self.by_name)
+
+    def get(self, name: str) -> CommunicationProtocol:
+        """
+        Gets the connection to a peer by name.
+
+        :param name: Name of the peer.
+        :return: The connection, None if not connected.
+        """
+        return self.by_name.get(name)
+
+    def get_by_address(self, address: tuple) -> CommunicationProtocol:
+        """
+        Gets the connection to a peer by address.
+
+        :param address: Tuple of (ip, port).
+        :return: The connection, None if not connected.
+        """
+        return self.by_address.get(tuple(address[:2]))
+
+    def is_connected(self, name: str) -> bool:
+        """
+        Gets connection status to a peer.
+
+        :param name: Name of the peer.
+        :return: True if connection to the peer is open; False otherwise.
+        """
+        comm = self.by_name.get(name)
+        return comm is not None and comm.is_open()
+
+    def names(self) -> list:
+        """
+        Gets the names of every connected peer.
+
+        :return: List of peer names.
+        """
+        with self.lock:
+            return list(self.by_name.keys())
+
+    def values(self) -> list:
+        """
+        Gets every connection.
+
+        :return: List of connections.
+        """
+        with self.lock:
+            return list(self.by_name.values())
+
+    def add(self, comm: CommunicationProtocol, address: tuple = None):
+        """
+        Registers an established connection, replacing any previous connection to the same peer.
+
+        :param comm: The connection.
+        :param address: Tuple of (ip, port) to index it under, the address of the connection if None.
+        """
+        address = tuple((address or comm.get_address())[:2])
+        with self.lock:
+            previous = self.by_name.get(comm.get_peer_name())
+            if previous is not None and previous is not comm:
+                self._unindex(previous)
+            self._unindex(comm)
+            self.by_name[comm.get_peer_name()] = comm
+            self.by_address[address] = comm
+            self.addresses[id(comm)] = address
+
+    def remove(self, comm: CommunicationProtocol) -> bool:
+        """
+        Unregisters a connection, a newer connection to the same peer is left in place.
+
+        :param comm: The connection.
+        :return: True if the connection was registered; False otherwise.
+        """
+        with self.lock:
+            return self._unindex(comm)
+
+    def _unindex(self, comm: CommunicationProtocol) -> bool:
+        removed = False
+        if self.by_name.get(comm.get_peer_name()) is comm:
+            del self.by_name[comm.get_peer_name()]
+            removed = True
+        address = self.addresses.pop(id(comm), None)
+        if address is not None and self.by_address.get(address) is comm:
+            del self.by_address[address]
+            removed = True
+        return removed
+
+    def _open_connection(self, address: tuple) -> CommunicationProtocol:
+        comm = self.by_address.get(address)
+        if comm is None and address in self.peer_names:  # The peer may have connected to us first
+            comm = self.by_name.get(self.peer_names[address])
+        return comm if comm is not None and comm.is_open() else None
+
+    def _claim(self, address: tuple) -> tuple:
+        """
+        Finds an open connection or a connect in progress to an address, or claims the connect for the caller.
+
+        :param address: Tuple of (ip, port).
+        :return: Tuple of (open connection, Future to wait on, True if the caller must connect).
+        """
+        with self.lock:
+            comm = self._open_connection(address)
+            if comm is not None:
+                return comm, None, False
+            future = self.pending.get(address)
+            if future is not None:
+                return None, future, False
+            future = self.pending[address] = Future()
+            return None, future, True
+
+    def _connected(self, address: tuple, future: Future, comm: CommunicationProtocol,
+                   on_connected: Callable[[CommunicationProtocol], None]):
+        try:
+            self.add(comm, address)
+            if on_connected is not None:
+                on_connected(comm)
+        except BaseException as error:
+            self._failed(address, future, error)
+            raise
+        with self.lock:
+            del self.pending[address]
+        future.set_result(comm)
+
+    def _failed(self, address: tuple, future: Future, error: BaseException):
+        with self.lock:
+            del self.pending[address]
+        future.set_exception(error)
+
+    def get_or_connect(self, address: tuple, connect: Callable[[], CommunicationProtocol],
+                       on_connected: Callable[[CommunicationProtocol], None] = None) -> CommunicationProtocol:
+        """
+        Gets the open connection to an address, connecting if there is none.
+        Concurrent calls for the same address wait for a single connect and handshake.
+
+        :param address: Tuple of (ip, port).
+        :param connect: Opens and establishes the connection, only called by one caller per address at a time.
+        :param on_connected: Called with the connection once it is registered, before waiting callers return.
+        :return: The connection.
+        """
+        address = tuple(address[:2])
+        comm, future, owner = self._claim(address)
+        if comm is not None:
+            return comm
+        if not owner:
+            return future.result()
+        try:
+            comm = connect()
+        except BaseException as error:
+            self._failed(address, future, error)
+            raise
+        self._connected(address, future, comm, on_connected)
+        return comm
+
+    async def get_or_connect_async(self, address: tuple, connect: Callable[[], Awaitable[CommunicationProtocol]],
+                                   on_connected: Callable[[CommunicationProtocol], None] = None) \
+            -> CommunicationProtocol:
+        """
+        Gets the open connection to an address, connecting if there is none, see get_or_connect.
+
+        :param address: Tuple of (ip, port).
+        :param connect: Coroutine function opening and establishing the connection.
+        :param on_connected: Called with the connection once it is registered, before waiting callers return.
+        :return: The connection.
+        """
+        address = tuple(address[:2])
+        comm, future, owner = self._claim(address)
+        if comm is not None:
+            return comm
+        if not owner:
+            return await asyncio.wrap_future(future)
+        try:
+            comm = await connect()
+        except BaseException as error:
+            self._failed(address, future, error)
+            raise
+        self._connected(address, future, comm, on_connected)
+        return comm
+
+    def add_known_peer(self, name: str, address: tuple) -> str:
+        """
+        Records the address a peer listens on.
+
+        :param name: Name of the peer.
+        :param address: Tuple of (ip, port).
+        :return: 'ADDED', 'UPDATED' or 'KNOWN'.
+        """
+        address = tuple(address[:2])
+        with self.lock:
+            previous = self.peers.get(name)
+            if previous == address:
+                return 'KNOWN'
+            if previous is not None and self.peer_names.get(previous) == name:
+                del self.peer_names[previous]
+            self.peers[name] = address
+            self.peer_names[address] = name
+            return 'ADDED' if previous is None else 'UPDATED'
+
+    def get_known_peer(self, name: str) -> tuple:
+        """
+        Gets the address a peer listens on.
+
+        :param name: Name of the peer.
+        :return: Tuple of (ip, port), None if the peer is unknown.
+        """
+        return self.peers.get(name)
+
+    def known_peer_name(self, address: tuple) -> str:
+        """
+        Gets the name of the peer listening on an address.
+
+        :param address: Tuple of (ip, port).
+        :return: Name of the peer, None if unknown.
+        """
+        return self.peer_names.get(tuple(address[:2]))
+
+    def known_peers(self) -> dict:
+        """
+        Gets every known peer.
+
+        :return: Dictionary of peer_name: (ip, port).
+        """
+        with self.lock:
+            return dict(self.peers)
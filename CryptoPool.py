@@ -0,0 +1,126 @@
+import os
+import threading
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor
+from typing import Callable
+
+
+def _run_batch(calls: list) -> list:
+    """
+    Runs a batch of jobs in a worker process.
+
+    :param calls: List of (function, job).
+    :return: List of (True, result) or (False, exception), in the order of calls.
+    """
+    results = []
+    for function, job in calls:
+        try:
+            results.append((True, function(job)))
+        except Exception as e:
+            results.append((False, e))
+    return results
+
+
+class CryptoPool(object):
+
+    def __init__(self, processes: int = None, batch_size: int = 256, _debug: bool = False):
+        """
+        Initialise CryptoPool, runs encryption jobs of every connection on a pool of processes.
+        Jobs are pure functions of the key, nonce and data, so they can run anywhere and in any order,
+        connections reserve nonces and queue the results in order themselves.
+        Jobs are sent in batches: at most two batches per process are in flight, jobs submitted meanwhile
+        join the next batch, so batches grow with the load and a lone job is sent at once.
+
+        :param processes: Worker processes, the number of CPUs if None.
+        :param batch_size: Largest number of jobs sent to a worker at once.
+        :param _debug: If True prints debug information to the console; otherwise no debug information is printed.
+        """
+        self.processes = processes or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self._debug = _debug
+        self.executor = ProcessPoolExecutor(max_workers=self.processes)
+
+        self.lock = threading.Lock()
+        self.submitted = threading.Condition(self.lock)  # Notified when jobs are queued, or on close
+        self.queue = []  # (function, job, future) waiting for a batch
+        self.slots = threading.BoundedSemaphore(2 * self.processes)  # Batches in flight
+        self.running = True
+        self.jobs = 0
+        self.batches = 0
+        self.thread = threading.Thread(target=self.run, name='CryptoPool')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, function: Callable, job) -> Future:
+        """
+        Queues a job.
+
+        :param function: Module or class level function run with the job, must be picklable.
+        :param job: Argument of the function, must be picklable.
+        :return: Future of the result.
+        """
+        future = Future()
+        with self.lock:
+            if not self.running:
+                raise Exception('CryptoPool is closed.')
+            self.queue.append((function, job, future))
+            if len(self.queue) == 1:
+                self.submitted.notify()
+        return future
+
+    def run(self):
+        while True:
+            self.slots.acquire()
+            with self.lock:
+                while self.running and not self.queue:
+                    self.submitted.wait()
+                if not self.running:
+                    return
+                batch, self.queue = self.queue[:self.batch_size], self.queue[self.batch_size:]
+                self.jobs += len(batch)
+                self.batches += 1
+            futures = [future for _, _, future in batch]
+            try:
+                done = self.executor.submit(_run_batch, [(function, job) for function, job, _ in batch])
+            except Exception as e:
+                self.slots.release()
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            done.add_done_callback(lambda done_, futures_=futures: self._done(done_, futures_))
+
+    def _done(self, done: Future, futures: list):
+        self.slots.release()
+        try:
+            results = done.result()
+        except (Exception, CancelledError) as e:  # A worker died or the pool closed
+            if self._debug:
+                print('[CRYPTO POOL] {0}'.format(e))
+            for future in futures:
+                future.set_exception(e)
+            return
+        for future, (ok, result) in zip(futures, results):
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+
+    def close(self):
+        """
+        Fails the queued jobs, waits for the batches in flight and stops the workers.
+        """
+        with self.lock:
+            self.running = False
+            self.submitted.notify()
+            queue, self.queue = self.queue, []
+        for _, _, future in queue:
+            future.set_exception(Exception('CryptoPool is closed.'))
+        self.executor.shutdown(cancel_futures=True)
+
+    def stats(self) -> dict:
+        """
+        Gets pool counters.
+
+        :return: Dictionary of processes, jobs, batches and jobs_per_batch.
+        """
+        return {'processes': self.processes, 'jobs': self.jobs, 'batches': self.batches,
+                'jobs_per_batch': self.jobs / self.batches if self.batches else 0.0}
@@ -0,0 +1,193 @@
+import hashlib
+import hmac
+import random
+import os
+import socket
+import struct
+import threading
+import time
+from typing import Callable
+
+
+class Discovery(object):
+    mac_size = 32
+    trailer = struct.Struct('!d16s4s')  # Authenticated with the text: send time, random nonce, IPv4 of the sender
+
+    def __init__(self, name: str, port: int, on_peer: Callable[[str, tuple], None],
+                 on_message: Callable[[tuple, str], None] = None, group: str = '239.255.83.65',
+                 group_port: int = 12108, interval: float = 30.0, secret: bytes = None, ttl: int = 1,
+                 address: str = None, max_age: float = 60.0, _debug: bool = False):
+        """
+        Initialise Discovery, announces this peer on a UDP multicast group of the LAN and listens for others.
+        Datagrams are small text messages, ANNOUNCE-port-name for announcements. They are not encrypted,
+        with a secret each one carries an HMAC and peers without the secret are ignored. The HMAC also covers
+        the send time, a random nonce and the address of the sender, so datagrams older than max_age or seen
+        before are rejected, and a recorded announcement replayed from elsewhere still names the real peer.
+
+        :param name: Name of this peer, announcements of it are ignored.
+        :param port: Port this peer accepts connections on, announced with its name.
+        :param on_peer: Called with (name, (ip, port)) for every announcement of another peer.
+        :param on_message: Called with ((ip, port), message) for other datagrams, None ignores them.
+        :param group: Multicast group address.
+        :param group_port: UDP port of the group.
+        :param interval: Seconds between announcements, with jitter, 0 only announces at start.
+        :param secret: Shared key authenticating datagrams, None accepts every datagram.
+        :param ttl: Multicast hops, 1 stays on the local network.
+        :param address: IPv4 address announced with a secret, None uses the one of the interface routing to the group.
+        :param max_age: Seconds an authenticated datagram is accepted after it was sent, bounds the clock skew too.
+        :param _debug: If True prints debug information to the console; otherwise no debug information is printed.
+        """
+        self.name = name
+        self.port = port
+        self.on_peer = on_peer
+        self.on_message = on_message
+        self.group = (group, group_port)
+        self.interval = interval
+        self.secret = secret
+        self.ttl = ttl
+        self.address = address
+        self.max_age = max_age
+        self.seen = {}  # nonce: time it was sent, authenticated nonces younger than max_age
+        self._debug = _debug
+        self.socket: socket.socket = None
+        self.stopped = threading.Event()
+        self.sent = 0
+        self.received = 0
+        self.rejected = 0
+
+    def start(self):
+        """
+        Joins the group and starts the announcing and receiving threads.
+        """
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):  # Several peers on one machine share the group port
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket.bind(('', self.group[1]))
+        membership = struct.pack('4s4s', socket.inet_aton(self.group[0]), socket.inet_aton('0.0.0.0'))
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.ttl)
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        self.socket.settimeout(1.0)  # Checks for stop every second, closing does not wake recvfrom
+        if self.secret is not None and self.address is None:
+            self.address = self.local_address()
+        self.stopped.clear()
+        for target, name in ((self.receive, 'Discovery'), (self.run, 'Discovery-announce')):
+            thread = threading.Thread(target=target, name=name)
+            thread.daemon = True
+            thread.start()
+
+    def run(self):
+        self.announce()
+        while self.interval > 0 and not self.stopped.wait(self.interval * random.uniform(0.5, 1.5)):
+            self.announce()
+
+    def local_address(self) -> str:
+        """
+        Gets the address of the interface sending to the group, connecting a UDP socket sends nothing.
+
+        :return: IPv4 address.
+        """
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            probe.connect(self.group)
+            return probe.getsockname()[0]
+        finally:
+            probe.close()
+
+    def announce(self):
+        self.send('ANNOUNCE-{0}-{1}'.format(self.port, self.name))
+
+    def send(self, message: str):
+        """
+        Sends a datagram to every peer in the group.
+
+        :param message: Text, should fit in one datagram.
+        """
+        data = message.encode('utf-8')
+        if self.secret is not None:
+            data += self.trailer.pack(time.time(), os.urandom(16), socket.inet_aton(self.address))
+            data += hmac.new(self.secret, data, hashlib.sha256).digest()
+        try:
+            self.socket.sendto(data, self.group)
+            self.sent += 1
+        except OSError as e:
+            if self._debug:
+                print('[DISCOVERY] {0}'.format(e))
+
+    def receive(self):
+        while not self.stopped.is_set():
+            try:
+                data, address = self.socket.recvfrom(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            verified = self.verify(data)
+            if verified is None:
+                self.rejected += 1
+                continue
+            self.received += 1
+            message, ip = verified
+            command, _, rest = message.partition('-')
+            if command == 'ANNOUNCE':
+                port, _, name = rest.partition('-')
+                if name and name != self.name and port.isdigit():
+                    self.on_peer(name, (ip or address[0], int(port)))
+            elif self.on_message is not None:
+                self.on_message(address, message)
+
+    def verify(self, data: bytes) -> tuple:
+        """
+        Checks the HMAC, age and nonce of a datagram.
+
+        :param data: Datagram received.
+        :return: Tuple of (text, address of the sender), the address is None without a secret.
+                 None if it is not authentic, stale, replayed or not text.
+        """
+        ip = None
+        if self.secret is not None:
+            if len(data) < self.trailer.size + self.mac_size:
+                return None
+            data, mac = data[:-self.mac_size], data[-self.mac_size:]
+            if not hmac.compare_digest(mac, hmac.new(self.secret, data, hashlib.sha256).digest()):
+                return None
+            data, trailer = data[:-self.trailer.size], data[-self.trailer.size:]
+            sent, nonce, packed = self.trailer.unpack(trailer)
+            if not self.fresh(sent, nonce):
+                return None
+            ip = socket.inet_ntoa(packed)
+        try:
+            return data.decode('utf-8'), ip
+        except UnicodeDecodeError:
+            return None
+
+    def fresh(self, sent: float, nonce: bytes) -> bool:
+        """
+        Checks an authenticated datagram was sent within max_age and its nonce was not seen before.
+        Nonces are only kept while their datagram is young enough to be accepted.
+
+        :param sent: Time the datagram was sent.
+        :param nonce: Nonce of the datagram.
+        :return: True if the datagram is new; False otherwise.
+        """
+        now = time.time()
+        if abs(now - sent) > self.max_age or nonce in self.seen:
+            return False
+        if len(self.seen) >= 1024:
+            self.seen = {seen: at for seen, at in self.seen.items() if now - at <= self.max_age}
+        self.seen[nonce] = sent
+        return True
+
+    def stop(self):
+        self.stopped.set()
+        if self.socket is not None:
+            self.socket.close()
+
+    def stats(self) -> dict:
+        """
+        Gets datagram counters.
+
+        :return: Dictionary of sent, received and rejected.
+        """
+        return {'sent': self.sent, 'received': self.received, 'rejected': self.rejected}
@@ -0,0 +1,318 @@
+import base64
+import hashlib
+import random
+import threading
+import time
+from typing import Callable
+
+
+class BloomFilter(object):
+
+    def __init__(self, size: int, hashes: int = 4, salt: int = 0, bits: bytearray = None):
+        """
+        Initialise BloomFilter, a set membership summary with false positives but no false negatives.
+
+        :param size: Number of bits, rounded up to a whole byte.
+        :param hashes: Number of bits set per item.
+        :param salt: Changes which bits an item sets, so false positives differ from round to round.
+        :param bits: Bits of an existing filter, as produced by encode.
+        """
+        self.size = (size + 7) // 8 * 8
+        self.hashes = hashes
+        self.salt = salt
+        self.bits = bits if bits is not None else bytearray(self.size // 8)
+
+    @staticmethod
+    def hash(item: str) -> int:
+        """
+        Hashes an item once, the salt is mixed in per filter so the hash can be kept with the item.
+
+        :param item: The item.
+        :return: 128 bit hash.
+        """
+        return int.from_bytes(hashlib.blake2b(item.encode(), digest_size=16).digest(), 'big')
+
+    def _indexes(self, item: int):
+        h1 = (item >> 64) ^ self.salt
+        h2 = ((item & 0xFFFFFFFFFFFFFFFF) ^ (self.salt >> 7)) | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item: int):
+        for index in self._indexes(item):
+            self.bits[index >> 3] |= 1 << (index & 7)
+
+    def __contains__(self, item: int) -> bool:
+        return all(self.bits[index >> 3] & (1 << (index & 7)) for index in self._indexes(item))
+
+    def encode(self) -> str:
+        """
+        Encodes the filter for a message.
+
+        :return: Filter as 'salt@hashes@base64 bits'.
+        """
+        return '{0}@{1}@{2}'.format(self.salt, self.hashes, base64.b64encode(self.bits).decode())
+
+    @classmethod
+    def decode(cls, encoded: str) -> 'BloomFilter':
+        """
+        Decodes a filter encoded by encode.
+
+        :param encoded: Filter as 'salt@hashes@base64 bits'.
+        :return: The filter.
+        :raises ValueError: If the filter is malformed.
+        """
+        salt, hashes, bits = encoded.split('@')
+        bits = bytearray(base64.b64decode(bits, validate=True))
+        if not bits or not 0 < int(hashes) <= 64:
+            raise ValueError('Invalid bloom filter')
+        return cls(len(bits) * 8, int(hashes), int(salt), bits)
+
+
+class Gossip(object):
+
+    def __init__(self, name: str, send: Callable[[str, str], None], peers: Callable[[], dict],
+                 on_update: Callable[[str, tuple], None] = None, fanout: int = 3, interval: float = 5.0,
+                 bits_per_entry: int = 16, hashes: int = 8, _debug: bool = False):
+        """
+        Initialise Gossip, spreads the peer list by exchanging only the entries the other side is missing.
+        Entries are (address, version), the newest version of a name wins. An exchange starts with DIG,
+        our entry count and a hash of every entry, which is all that is sent when both peers are in sync.
+        Otherwise the peer answers SUM, a Bloom filter of its entries, we answer DLT, the entries missing
+        from the filter plus our own filter, and the peer answers a final DLT with the entries we miss.
+
+        :param name: Name of this peer, entries about ourselves are not passed to on_update.
+        :param send: Called with (peer_name, message) to send a message.
+        :param peers: Returns the known peers, dictionary of peer_name: (ip, port), to pick gossip targets from.
+        :param on_update: Called with (peer_name, (ip, port)) for every entry learned from another peer.
+        :param fanout: Peers gossiped with per round.
+        :param interval: Seconds between rounds.
+        :param bits_per_entry: Bloom filter bits per entry, more bits hide fewer entries behind false positives.
+        :param hashes: Bloom filter bits set per entry.
+        :param _debug: If True prints debug information to the console; otherwise no debug information is printed.
+        """
+        self.name = name
+        self.send = send
+        self.peers = peers
+        self.on_update = on_update
+        self.fanout = fanout
+        self.interval = interval
+        self.bits_per_entry = bits_per_entry
+        self.hashes_per_entry = hashes
+        self._debug = _debug
+
+        self.entries = {}  # peer_name: (address, version)
+        self.hashes = {}  # peer_name: hash of 'peer_name@version'
+        self.root = 0  # xor of the hash of every entry, equal on peers with equal entries
+        self.digest: str = None  # Reused until the entries change or the next round
+        self.lock = threading.RLock()
+        self.stopped = threading.Event()
+        self.thread: threading.Thread = None
+
+        self.rounds = 0
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.entries_sent = 0
+
+    def _set(self, name: str, address: tuple, version: int):
+        item = BloomFilter.hash('{0}@{1}'.format(name, version))
+        self.root ^= self.hashes.get(name, 0) ^ item
+        self.entries[name] = (address, version)
+        self.hashes[name] = item
+        self.digest = None
+
+    def observe(self, name: str, address: tuple):
+        """
+        Records an address seen first hand, a new or changed address gets a new version.
+
+        :param name: Name of the peer.
+        :param address: Tuple of (ip, port) the peer listens on.
+        """
+        address = tuple(address[:2])
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None or entry[0] != address:
+                version = max(time.time_ns() // 1000, entry[1] + 1 if entry else 0)
+                self._set(name, address, version)
+
+    def merge(self, name: str, address: tuple, version: int) -> bool:
+        """
+        Applies an entry received from another peer, keeping the newest version.
+        A newer entry about ourselves with a different address is refuted with a newer version of our own.
+
+        :param name: Name of the peer.
+        :param address: Tuple of (ip, port).
+        :param version: Version of the entry.
+        :return: True if the entry was new to us; False otherwise.
+        """
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is not None and entry[1] >= version:
+                return False
+            if name == self.name and entry is not None and entry[0] != address:
+                self._set(name, entry[0], version + 1)
+                return False
+            self._set(name, address, version)
+        if self.on_update is not None and name != self.name:
+            self.on_update(name, address)
+        return True
+
+    def create_summary(self) -> str:
+        """
+        Summarises our entries in a few bytes.
+
+        :return: Summary as 'count@root'.
+        """
+        with self.lock:
+            return '{0}@{1}'.format(len(self.entries), self.root)
+
+    def in_sync(self, summary: str) -> bool:
+        """
+        Checks if a peer holds the same entries as us.
+
+        :param summary: Summary or digest of the other peer.
+        :return: True if the entry count and hash match ours; False otherwise.
+        """
+        count, root = summary.split('@')[:2]
+        with self.lock:
+            return int(count) == len(self.entries) and int(root) == self.root
+
+    def create_digest(self, count: int = 0) -> str:
+        """
+        Summarises our entries with a Bloom filter.
+        The filter is tested against the other peers entries, so it is sized for the larger of the two.
+
+        :param count: Entry count of the peer the digest is for.
+        :return: Digest as 'count@root@salt@hashes@base64 bits'.
+        """
+        with self.lock:
+            if count > len(self.hashes):
+                return self._create_digest(count)
+            if self.digest is None:
+                self.digest = self._create_digest(len(self.hashes))
+            return self.digest
+
+    def _create_digest(self, count: int) -> str:
+        bloom = BloomFilter(max(64, count * self.bits_per_entry), self.hashes_per_entry, random.getrandbits(64))
+        for item in self.hashes.values():
+            bloom.add(item)
+        return '{0}@{1}@{2}'.format(len(self.hashes), self.root, bloom.encode())
+
+    def missing(self, digest: str) -> list:
+        """
+        Finds our entries a digest does not contain.
+
+        :param digest: Digest of the other peer.
+        :return: List of (name, address, version), empty if both sides hold the same entries.
+        """
+        if self.in_sync(digest):
+            return []
+        with self.lock:
+            entries = [(name, address, version, self.hashes[name])
+                       for name, (address, version) in self.entries.items()]
+        bloom = BloomFilter.decode(digest.split('@', 2)[2])
+        return [(name, address, version) for name, address, version, item in entries if item not in bloom]
+
+    @staticmethod
+    def encode_entries(entries: list) -> str:
+        return '>'.join('{0}@{1}@{2}@{3}'.format(name, address[0], address[1], version)
+                        for name, address, version in entries)
+
+    @staticmethod
+    def decode_entries(encoded: str) -> list:
+        entries = []
+        for entry in filter(None, encoded.split('>')):
+            name, ip, port, version = entry.split('@')
+            entries.append((name, (ip, int(port)), int(version)))
+        return entries
+
+    def _send(self, name: str, message: str, entries: int = 0):
+        self.messages_sent += 1
+        self.bytes_sent += len(message)
+        self.entries_sent += entries
+        self.send(name, message)
+
+    def gossip_with(self, name: str):
+        """
+        Starts an exchange with a peer by sending our summary.
+
+        :param name: Name of the peer.
+        """
+        self._send(name, 'BUILTIN-GOSSIP-DIG-{0}'.format(self.create_summary()))
+
+    def handle(self, name: str, message: str) -> bool:
+        """
+        Handles a BUILTIN-GOSSIP message.
+
+        :param name: Name of peer the message originated from.
+        :param message: Message received from peer.
+        :return: True if the message was a gossip message; False otherwise.
+        """
+        args = message.split('-', 4)
+        if len(args) < 4:
+            return False
+        try:
+            match args[2]:
+                case 'DIG':
+                    if not self.in_sync(args[3]):
+                        digest = self.create_digest(int(args[3].split('@')[0]))
+                        self._send(name, 'BUILTIN-GOSSIP-SUM-{0}'.format(digest))
+                case 'SUM':
+                    delta = self.missing(args[3])
+                    digest = self.create_digest(int(args[3].split('@')[0]))
+                    self._send(name, 'BUILTIN-GOSSIP-DLT-{0}-{1}'.format(digest, self.encode_entries(delta)),
+                               len(delta))
+                case 'DLT':
+                    for entry in self.decode_entries(args[4] if len(args) > 4 else ''):
+                        self.merge(*entry)
+                    if args[3]:  # Reply to our digest, send what the peer is missing
+                        delta = self.missing(args[3])
+                        if delta:
+                            self._send(name, 'BUILTIN-GOSSIP-DLT--{0}'.format(self.encode_entries(delta)),
+                                       len(delta))
+                case _:
+                    return False
+        except (IndexError, ValueError) as e:  # Malformed summary, digest or entries
+            if self._debug:
+                print('[GOSSIP] Malformed message from {0}: {1}'.format(name, e))
+            return False
+        return True
+
+    def run_round(self):
+        """
+        Gossips with up to fanout known peers chosen at random.
+        """
+        candidates = [name for name in self.peers() if name != self.name]
+        self.rounds += 1
+        with self.lock:
+            self.digest = None  # A new salt each round, so entries hidden by a false positive are found next round
+        for name in random.sample(candidates, min(self.fanout, len(candidates))):
+            try:
+                self.gossip_with(name)
+            except Exception as e:
+                if self._debug:
+                    print('[GOSSIP] {0} unreachable: {1}'.format(name, e))
+
+    def start(self):
+        """
+        Starts a thread running a round every interval seconds.
+        """
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='Gossip')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval * random.uniform(0.5, 1.5)):  # Jitter keeps peers out of step
+            self.run_round()
+
+    def stop(self):
+        self.stopped.set()
+
+    def stats(self) -> dict:
+        """
+        Gets gossip counters.
+
+        :return: Dictionary of entries, rounds, messages_sent, bytes_sent and entries_sent.
+        """
+        return {'entries': len(self.entries), 'rounds': self.rounds, 'messages_sent': self.messages_sent,
+                'bytes_sent': self.bytes_sent, 'entries_sent': self.entries_sent}
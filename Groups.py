@@ -0,0 +1,199 @@
+import os
+import random
+import struct
+import threading
+from Crypto.Cipher import AES
+from Schema import ENVELOPE, SCHEMA
+
+GROUP_KEY = SCHEMA.register(5, 'BUILTIN-GROUP-KEY', ('group', 'str'), ('key_id', 'u32'), ('key', 'bytes'))
+
+
+class GroupFrame(object):
+    __slots__ = ('payload',)
+
+    def __init__(self, payload: bytes):
+        """
+        Initialise GroupFrame, a received frame sealed with a group key instead of the key of its connection.
+        Connections pass it on as is, the peer opens it with the key the sender gave it.
+
+        :param payload: Sealed message, see GroupKey.seal.
+        """
+        self.payload = payload
+
+
+class GroupKey(object):
+    header = struct.Struct('!IQ')  # key id, counter, together the AES-GCM nonce
+    tag_size = 16
+    window = 64  # Counters this far behind the highest one received may still arrive, once
+
+    def __init__(self, group: str, key_id: int = None, key: bytes = None):
+        """
+        Initialise GroupKey, the AES-GCM key one sender seals messages to a group with.
+        Every sender has its own key, handed to each member over their pairwise encrypted connection, so a message
+        is encrypted once for the whole group and receivers know which member a key belongs to.
+
+        :param group: Name of the group.
+        :param key_id: Id sent with every message, random if None.
+        :param key: 32 byte key, random if None.
+        """
+        self.group = group
+        self.key_id = key_id if key_id is not None else random.getrandbits(32)
+        self.key = key if key is not None else os.urandom(32)
+        self.counter = 0  # Next counter sealed with
+        self.highest = -1  # Highest counter opened
+        self.seen = 0  # Bit i set if counter highest - i was opened
+        self.lock = threading.Lock()
+
+    def seal(self, raw: bytes) -> bytes:
+        """
+        Encrypts and authenticates a message.
+
+        :param raw: Plaintext.
+        :return: Key id, counter, ciphertext and tag.
+        """
+        with self.lock:
+            counter = self.counter
+            self.counter += 1
+        header = self.header.pack(self.key_id, counter)
+        enc, tag = AES.new(self.key, AES.MODE_GCM, nonce=header).encrypt_and_digest(raw)
+        return header + enc + tag
+
+    def open(self, sealed) -> bytes:
+        """
+        Decrypts and verifies a message, replays are rejected by a sliding window over the counters.
+        The window lets messages sealed by concurrent senders arrive slightly out of order.
+
+        :param sealed: Message produced by seal.
+        :return: Plaintext, None if it fails to verify or was already opened.
+        """
+        sealed = memoryview(sealed)
+        if len(sealed) < self.header.size + self.tag_size:
+            return None
+        counter = self.header.unpack_from(sealed)[1]
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=bytes(sealed[:self.header.size]))
+        try:
+            raw = cipher.decrypt_and_verify(sealed[self.header.size:-self.tag_size], sealed[-self.tag_size:])
+        except ValueError:
+            return None
+        with self.lock:
+            if counter > self.highest:
+                shift = counter - self.highest
+                self.seen = (self.seen << shift | 1) & ((1 << self.window) - 1) if shift < self.window else 1
+                self.highest = counter
+            elif self.highest - counter >= self.window or self.seen >> (self.highest - counter) & 1:
+                return None
+            else:
+                self.seen |= 1 << (self.highest - counter)
+        return raw
+
+
+class Groups(object):
+
+    def __init__(self):
+        """
+        Initialise Groups, the groups this peer sends to and the group keys other peers gave it.
+        """
+        self.lock = threading.Lock()
+        self.members = {}  # group: set of peer names
+        self.keys = {}  # group: our GroupKey
+        self.received = {}  # (peer name, key id): GroupKey of that peer
+
+    def create(self, group: str, members) -> GroupKey:
+        """
+        Creates a group, or replaces its members and key.
+
+        :param group: Name of the group.
+        :param members: Names of the peers in the group.
+        :return: Our key for the group.
+        """
+        with self.lock:
+            self.members[group] = set(members)
+            key = self.keys[group] = GroupKey(group)
+            return key
+
+    def add(self, group: str, name: str) -> GroupKey:
+        """
+        Adds a member, it receives our current key.
+
+        :return: Our key for the group.
+        """
+        with self.lock:
+            if group not in self.keys:
+                raise Exception('Unknown group {0}'.format(group))
+            self.members[group].add(name)
+            return self.keys[group]
+
+    def remove(self, group: str, name: str) -> GroupKey:
+        """
+        Removes a member and replaces our key, so it cannot read what is sent afterwards.
+
+        :return: Our new key for the group, to hand to the remaining members.
+        """
+        with self.lock:
+            if group not in self.keys:
+                raise Exception('Unknown group {0}'.format(group))
+            self.members[group].discard(name)
+            key = self.keys[group] = GroupKey(group)
+            return key
+
+    def delete(self, group: str):
+        with self.lock:
+            self.members.pop(group, None)
+            self.keys.pop(group, None)
+
+    def members_of(self, group: str) -> list:
+        with self.lock:
+            return list(self.members.get(group, ()))
+
+    def key(self, group: str) -> GroupKey:
+        with self.lock:
+            return self.keys.get(group)
+
+    def seal(self, group: str, message) -> bytes:
+        """
+        Seals a message with our key for a group.
+
+        :param group: Name of the group.
+        :param message: Text, or a message created by a command of the schema.
+        :return: Sealed message.
+        """
+        key = self.key(group)
+        if key is None:
+            raise Exception('Unknown group {0}'.format(group))
+        return key.seal(message.encode('utf-8') if isinstance(message, str) else SCHEMA.encode(message))
+
+    def store(self, name: str, message) -> GroupKey:
+        """
+        Keeps the key a peer sent with BUILTIN-GROUP-KEY.
+
+        :param name: Name of the peer, only frames from it are opened with the key.
+        :param message: The GROUP_KEY message.
+        :return: The key.
+        """
+        if len(message.key) != 32:
+            raise Exception('Invalid group key from {0}'.format(name))
+        key = GroupKey(message.group, message.key_id, message.key)
+        with self.lock:
+            for stored in [stored for stored in self.received if stored[0] == name]:
+                if self.received[stored].group == message.group:  # Replaced, e.g. after a member was removed
+                    del self.received[stored]
+            self.received[(name, message.key_id)] = key
+        return key
+
+    def open(self, name: str, frame: GroupFrame):
+        """
+        Opens a group frame received from a peer.
+
+        :param name: Name of the peer the frame arrived from.
+        :param frame: The frame.
+        :return: Text or the parsed message, None if the key is unknown or the frame is short or does not verify.
+        """
+        if len(frame.payload) < GroupKey.header.size:
+            return None
+        key = self.received.get((name, GroupKey.header.unpack_from(frame.payload)[0]))
+        raw = key.open(frame.payload) if key is not None else None
+        if raw is None:
+            return None
+        if raw[:1] == ENVELOPE:
+            return SCHEMA.decode(raw)
+        return str(raw, 'utf-8')
@@ -0,0 +1,244 @@
+import secrets
+
+from Crypto.PublicKey import ECC
+from tinyec.ec import Point
+from tinyec import registry
+
+
+class ECBackend(object):
+    name: str = None
+
+    def generate_keys(self) -> tuple:
+        """
+        Generates a random key-pair.
+
+        :return: Tuple of generated Private and Public keys.
+        """
+        raise NotImplementedError
+
+    def shared_secret(self, private_key: int, public_key):
+        """
+        Runs Diffie-Hellman between our private key and the peers public key.
+
+        :param private_key: Our private key.
+        :param public_key: The peers public key.
+        :return: The master key, equal on both sides.
+        """
+        raise NotImplementedError
+
+    def decode_public(self, x: int, y: int):
+        """
+        Creates a public key from its coordinates, rejecting points that are not on the curve.
+
+        :param x: x coordinate.
+        :param y: y coordinate.
+        :return: The public key.
+        """
+        raise NotImplementedError
+
+    def encode_public(self, public_key) -> tuple:
+        """
+        Gets the coordinates of a public key.
+
+        :param public_key: The public key.
+        :return: Tuple of (x, y).
+        """
+        return public_key.x, public_key.y
+
+
+class TinyecBackend(ECBackend):
+    name = 'brainpoolP256r1'
+
+    def __init__(self):
+        """
+        Initialise TinyecBackend, the original pure-Python tinyec double-and-add implementation.
+        """
+        self.curve = registry.get_curve(self.name)
+
+    def generate_keys(self) -> tuple:
+        private_key = secrets.randbelow(self.curve.field.n)
+        return private_key, private_key * self.curve.g
+
+    def shared_secret(self, private_key: int, public_key: Point) -> Point:
+        return private_key * public_key
+
+    def decode_public(self, x: int, y: int) -> Point:
+        if not self.curve.on_curve(x, y):
+            raise Exception('Public key is not on curve {0}'.format(self.name))
+        return Point(self.curve, x, y)
+
+
+class BrainpoolBackend(TinyecBackend):
+
+    def __init__(self, window: int = 4):
+        """
+        Initialise BrainpoolBackend, brainpoolP256r1 in Jacobian coordinates.
+        Generator multiples use a fixed-base table, other points a fixed window, keys match TinyecBackend exactly.
+
+        :param window: Bits per window, the generator table holds (2 ** window - 1) * (256 / window) points.
+        """
+        super().__init__()
+        self.window = window
+        self.p = self.curve.field.p
+        self.a = self.curve.a
+        self.n = self.curve.field.n
+        self.table = None  # Built on first use
+
+    def _double(self, point: tuple) -> tuple:
+        x1, y1, z1 = point
+        if not z1 or not y1:
+            return 0, 1, 0
+        p = self.p
+        xx = x1 * x1 % p
+        yy = y1 * y1 % p
+        yyyy = yy * yy % p
+        zz = z1 * z1 % p
+        s = 2 * ((x1 + yy) ** 2 - xx - yyyy) % p
+        m = (3 * xx + self.a * zz * zz) % p
+        x3 = (m * m - 2 * s) % p
+        y3 = (m * (s - x3) - 8 * yyyy) % p
+        z3 = ((y1 + z1) ** 2 - yy - zz) % p
+        return x3, y3, z3
+
+    def _add(self, point1: tuple, point2: tuple) -> tuple:
+        x1, y1, z1 = point1
+        x2, y2, z2 = point2
+        if not z1:
+            return point2
+        if not z2:
+            return point1
+        p = self.p
+        z1z1 = z1 * z1 % p
+        z2z2 = z2 * z2 % p
+        u1 = x1 * z2z2 % p
+        u2 = x2 * z1z1 % p
+        s1 = y1 * z2 * z2z2 % p
+        s2 = y2 * z1 * z1z1 % p
+        h = (u2 - u1) % p
+        r = 2 * (s2 - s1) % p
+        if not h:
+            return self._double(point1) if not r else (0, 1, 0)
+        i = 4 * h * h % p
+        j = h * i % p
+        v = u1 * i % p
+        x3 = (r * r - j - 2 * v) % p
+        y3 = (r * (v - x3) - 2 * s1 * j) % p
+        z3 = ((z1 + z2) ** 2 - z1z1 - z2z2) * h % p
+        return x3, y3, z3
+
+    def _add_affine(self, point1: tuple, point2: tuple) -> tuple:
+        x1, y1, z1 = point1
+        x2, y2 = point2
+        if not z1:
+            return x2, y2, 1
+        p = self.p
+        z1z1 = z1 * z1 % p
+        u2 = x2 * z1z1 % p
+        s2 = y2 * z1 * z1z1 % p
+        h = (u2 - x1) % p
+        r = 2 * (s2 - y1) % p
+        if not h:
+            return self._double(point1) if not r else (0, 1, 0)
+        hh = h * h % p
+        i = 4 * hh
+        j = h * i % p
+        v = x1 * i % p
+        x3 = (r * r - j - 2 * v) % p
+        y3 = (r * (v - x3) - 2 * y1 * j) % p
+        z3 = ((z1 + h) ** 2 - z1z1 - hh) % p
+        return x3, y3, z3
+
+    def _to_affine(self, point: tuple) -> tuple:
+        x, y, z = point
+        z_inv = pow(z, -1, self.p)
+        z_inv2 = z_inv * z_inv % self.p
+        return x * z_inv2 % self.p, y * z_inv2 * z_inv % self.p
+
+    def _build_table(self) -> list:
+        """
+        Precomputes j * 2 ** (window * i) * G for every window position i and digit j, in affine coordinates.
+
+        :return: List per window position of the 2 ** window - 1 multiples.
+        """
+        table = []
+        base = (self.curve.g.x, self.curve.g.y, 1)
+        for _ in range(0, self.n.bit_length(), self.window):
+            row = [base]
+            for _ in range(2 ** self.window - 2):
+                row.append(self._add(row[-1], base))
+            table.append([self._to_affine(point) for point in row])
+            for _ in range(self.window):
+                base = self._double(base)
+        return table
+
+    def multiply_generator(self, scalar: int) -> tuple:
+        """
+        Multiplies the generator using the fixed-base table, one mixed addition per window and no doublings.
+
+        :param scalar: Scalar below the curve order.
+        :return: Affine coordinates of scalar * G.
+        """
+        if self.table is None:
+            self.table = self._build_table()
+        mask = 2 ** self.window - 1
+        result = (0, 1, 0)
+        for row in self.table:
+            digit = scalar & mask
+            if digit:
+                result = self._add_affine(result, row[digit - 1])
+            scalar >>= self.window
+        return self._to_affine(result)
+
+    def multiply(self, scalar: int, x: int, y: int) -> tuple:
+        """
+        Multiplies an arbitrary point using a fixed window.
+
+        :param scalar: Scalar below the curve order.
+        :param x: x coordinate of the point.
+        :param y: y coordinate of the point.
+        :return: Affine coordinates of scalar * point.
+        """
+        multiples = [(x, y, 1)]
+        for _ in range(2 ** self.window - 2):
+            multiples.append(self._add(multiples[-1], multiples[0]))
+
+        mask = 2 ** self.window - 1
+        result = (0, 1, 0)
+        for shift in range(scalar.bit_length() - scalar.bit_length() % -self.window - self.window, -1,
+                           -self.window):
+            for _ in range(self.window):
+                result = self._double(result)
+            digit = (scalar >> shift) & mask
+            if digit:
+                result = self._add(result, multiples[digit - 1])
+        return self._to_affine(result)
+
+    def generate_keys(self) -> tuple:
+        private_key = secrets.randbelow(self.n - 1) + 1
+        return private_key, Point(self.curve, *self.multiply_generator(private_key))
+
+    def shared_secret(self, private_key: int, public_key: Point) -> Point:
+        return Point(self.curve, *self.multiply(private_key % self.n, public_key.x, public_key.y))
+
+
+class P256Backend(ECBackend):
+    name = 'P-256'
+
+    def generate_keys(self) -> tuple:
+        key = ECC.generate(curve=self.name)
+        return int(key.d), key.pointQ
+
+    def shared_secret(self, private_key: int, public_key: ECC.EccPoint) -> tuple:
+        return self.encode_public(public_key * private_key)
+
+    def decode_public(self, x: int, y: int) -> ECC.EccPoint:
+        try:
+            return ECC.EccPoint(x, y, curve=self.name)
+        except ValueError:
+            raise Exception('Public key is not on curve {0}'.format(self.name))
+
+    def encode_public(self, public_key: ECC.EccPoint) -> tuple:
+        return int(public_key.x), int(public_key.y)
+
+
+backends = {backend.name: backend for backend in (BrainpoolBackend(), P256Backend())}
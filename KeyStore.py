@@ -0,0 +1,158 @@
+import json
+import os
+import tempfile
+import threading
+
+from KeyExchange import ECBackend
+
+
+class KeyStore(object):
+
+    def __init__(self, directory: str = None, max_cached: int = 4096):
+        """
+        Initialise KeyStore, long-term identity keys and trusted peer keys with an in-memory cache.
+
+        :param directory: Directory keys are saved in, if None keys are only kept in memory.
+        :param max_cached: Maximum number of validated peer points kept in memory.
+        """
+        self.directory = directory
+        self.max_cached = max_cached
+        self.local_keys = {}  # (file_prefix, curve): (private_key, public_key)
+        self.peer_keys = {}  # file_prefix: {peer_name: {curve: [x, y]}}
+        self.points = {}  # (curve, x, y): validated public key
+        self.lock = threading.RLock()
+
+        if directory is not None:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def _path(self, file_prefix: str, name: str) -> str:
+        return os.path.join(self.directory, '{0}{1}'.format(file_prefix, name))
+
+    @staticmethod
+    def _identity_file(backend: ECBackend) -> str:
+        return 'identity.json' if backend.name == 'brainpoolP256r1' else 'identity-{0}.json'.format(backend.name)
+
+    def _read(self, path: str):
+        try:
+            with open(path) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def _write(self, path: str, data):
+        """
+        Writes json to a file atomically, readers see either the old or the new file, never a partial one.
+
+        :param path: Path of the file to replace.
+        :param data: Json serialisable data.
+        """
+        descriptor, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(descriptor, 'w') as file:
+                json.dump(data, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def load_local_keys(self, file_prefix: str, backend: ECBackend) -> tuple:
+        """
+        Gets the identity key-pair for a prefix and curve, loading it from disk or generating and storing a new one.
+
+        :param file_prefix: File prefix of the identity.
+        :param backend: ECBackend of the curve.
+        :return: Tuple of Private and Public keys.
+        """
+        with self.lock:
+            if (file_prefix, backend.name) in self.local_keys:
+                return self.local_keys[(file_prefix, backend.name)]
+
+            path = self._path(file_prefix, self._identity_file(backend)) if self.directory else None
+            stored = self._read(path) if path else None
+            if stored is not None:
+                keys = (int(stored['private_key'], 16), backend.decode_public(*stored['public_key']))
+                self.local_keys[(file_prefix, backend.name)] = keys
+            else:
+                keys = backend.generate_keys()
+                self.store_local_keys(file_prefix, *keys, backend)
+            return keys
+
+    def store_local_keys(self, file_prefix: str, private_key: int, public_key, backend: ECBackend,
+                         save: bool = True):
+        """
+        Stores an identity key-pair.
+
+        :param file_prefix: File prefix of the identity.
+        :param private_key: Private key.
+        :param public_key: Public key.
+        :param backend: ECBackend of the curve.
+        :param save: If False the key-pair is only kept in memory, e.g. when it was loaded by another process.
+        """
+        with self.lock:
+            self.local_keys[(file_prefix, backend.name)] = (private_key, public_key)
+            if save and self.directory is not None:
+                path = self._path(file_prefix, self._identity_file(backend))
+                self._write(path, {'curve': backend.name, 'private_key': '{0:x}'.format(private_key),
+                                   'public_key': backend.encode_public(public_key)})
+                os.chmod(path, 0o600)
+
+    def _peers(self, file_prefix: str) -> dict:
+        if file_prefix not in self.peer_keys:
+            stored = self._read(self._path(file_prefix, 'peers.json')) if self.directory else None
+            self.peer_keys[file_prefix] = stored or {}
+        return self.peer_keys[file_prefix]
+
+    def store_peer_key(self, file_prefix: str, peer_name: str, public_key, backend: ECBackend):
+        """
+        Stores the public key a peer used the first time it connected, the key is pinned to its name.
+
+        :param file_prefix: File prefix of our identity.
+        :param peer_name: Name of the peer.
+        :param public_key: Public key of the peer.
+        :param backend: ECBackend of the curve.
+        """
+        with self.lock:
+            peer = self._peers(file_prefix).setdefault(peer_name, {})
+            xy = list(backend.encode_public(public_key))
+            if peer.get(backend.name) is None:
+                peer[backend.name] = xy
+                if self.directory is not None:
+                    self._write(self._path(file_prefix, 'peers.json'), self._peers(file_prefix))
+            elif peer[backend.name] != xy:
+                raise Exception('Identity of {0} changed.'.format(peer_name))
+
+    def get_peer_key(self, file_prefix: str, peer_name: str, backend: ECBackend):
+        """
+        Gets the stored public key of a peer.
+
+        :param file_prefix: File prefix of our identity.
+        :param peer_name: Name of the peer.
+        :param backend: ECBackend of the curve.
+        :return: The public key, None if the peer is unknown.
+        """
+        with self.lock:
+            xy = self._peers(file_prefix).get(peer_name, {}).get(backend.name)
+        return self.point(backend, *xy) if xy is not None else None
+
+    def point(self, backend: ECBackend, x: int, y: int):
+        """
+        Gets a validated public key, keys seen before are not parsed or validated again.
+
+        :param backend: ECBackend of the curve.
+        :param x: x coordinate.
+        :param y: y coordinate.
+        :return: The public key.
+        """
+        point = self.points.get((backend.name, x, y))
+        if point is None:
+            point = backend.decode_public(x, y)
+            self._cache(self.points, (backend.name, x, y), point)
+        return point
+
+    def _cache(self, cache: dict, key, value):
+        with self.lock:
+            cache[key] = value
+            if len(cache) > self.max_cached:
+                del cache[next(iter(cache))]
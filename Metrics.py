@@ -0,0 +1,295 @@
+import http.server
+import json
+import os
+import socket
+import stat
+import threading
+import time
+from typing import Callable
+
+
+class Histogram(object):
+
+    def __init__(self, scale: float = 1e6):
+        """
+        Initialise Histogram, counts values in power of two buckets so recording is a few integer operations
+        whatever the number of values, percentiles are accurate to a factor of two.
+
+        :param scale: Values are multiplied by scale before bucketing, 1e6 buckets seconds by microseconds.
+        """
+        self.scale = scale
+        self.buckets = [0] * 64  # Bucket i counts scaled values below 2 ** i, and from 2 ** (i - 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        """
+        Records one value.
+
+        :param value: The value, seconds for the default scale.
+        """
+        index = min(int(value * self.scale).bit_length(), 63)
+        with self.lock:
+            self.buckets[index] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, fraction: float) -> float:
+        """
+        Estimates a percentile from the buckets.
+
+        :param fraction: 0.5 for the median, 0.99 for the 99th percentile.
+        :return: Upper bound of the bucket holding the percentile, no more than the largest value.
+        """
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min((1 << index) / self.scale, self.max)
+        return 0.0
+
+    def snapshot(self, unit: float = 1000.0) -> dict:
+        """
+        Gets count, mean, p50, p90, p99 and max.
+
+        :param unit: Values are multiplied by unit, 1000 reports seconds in milliseconds.
+        :return: Dictionary of statistics.
+        """
+        with self.lock:
+            if not self.count:
+                return {'count': 0}
+            return {'count': self.count, 'mean': self.total / self.count * unit,
+                    'p50': self.percentile(0.5) * unit, 'p90': self.percentile(0.9) * unit,
+                    'p99': self.percentile(0.99) * unit, 'max': self.max * unit}
+
+
+class ConnectionMetrics(object):
+
+    def __init__(self):
+        """
+        Initialise ConnectionMetrics, the counters and histograms of one connection.
+        Connections only create it when metrics are enabled, every hot path checks for None first,
+        so disabled metrics cost one attribute check per message.
+        """
+        self.created = time.perf_counter()
+        self.established = None  # perf_counter when the handshake completed
+        self.handshake = 0.0  # Seconds from creating the connection to completing the handshake
+        self.encrypt = Histogram()  # Seconds to compress, encode and encrypt a message or fragment
+        self.decrypt = Histogram()
+        self.messages_sent = 0
+        self.messages_received = 0
+        self.bytes_sent = 0  # Ciphertext bytes, before framing
+        self.bytes_received = 0
+
+    def handshake_done(self):
+        self.established = time.perf_counter()
+        self.handshake = self.established - self.created
+
+    def sent(self, size: int, seconds: float, messages: int = 1):
+        """
+        Records an encrypted message or fragment.
+
+        :param size: Bytes of ciphertext.
+        :param seconds: Time spent encoding and encrypting it.
+        :param messages: 1 if it completes a message, 0 for other fragments.
+        """
+        self.encrypt.observe(seconds)
+        self.bytes_sent += size
+        self.messages_sent += messages
+
+    def received(self, size: int, seconds: float, messages: int = 1):
+        """
+        Records a decrypted message or fragment.
+
+        :param size: Bytes of ciphertext.
+        :param seconds: Time spent decrypting and decoding it.
+        :param messages: 1 if it completes a message, 0 for other fragments.
+        """
+        self.decrypt.observe(seconds)
+        self.bytes_received += size
+        self.messages_received += messages
+
+    def snapshot(self) -> dict:
+        """
+        Gets the counters, message rates since the handshake completed, and the histograms in milliseconds.
+
+        :return: Dictionary of statistics.
+        """
+        uptime = time.perf_counter() - self.established if self.established is not None else 0.0
+        return {'handshake_ms': self.handshake * 1000, 'uptime_s': uptime,
+                'messages_sent': self.messages_sent, 'messages_received': self.messages_received,
+                'bytes_sent': self.bytes_sent, 'bytes_received': self.bytes_received,
+                'sent_per_second': self.messages_sent / uptime if uptime else 0.0,
+                'received_per_second': self.messages_received / uptime if uptime else 0.0,
+                'encrypt_ms': self.encrypt.snapshot(), 'decrypt_ms': self.decrypt.snapshot()}
+
+
+class HandshakeMetrics(object):
+    window = 10  # Seconds the recent handshake rate is averaged over
+
+    def __init__(self):
+        """
+        Initialise HandshakeMetrics, the counters of incoming connections going through the accept pipeline.
+        """
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.accepted = 0
+        self.established = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.in_progress = 0
+        self.peak_in_progress = 0
+        self.seconds = Histogram()  # Seconds from starting a handshake to establishing the connection
+        self.recent = [[0, 0] for _ in range(self.window)]  # [second, handshakes established in it]
+
+    def begin(self) -> float:
+        """
+        Records the start of a handshake.
+
+        :return: perf_counter to pass to end.
+        """
+        with self.lock:
+            self.accepted += 1
+            self.in_progress += 1
+            if self.in_progress > self.peak_in_progress:
+                self.peak_in_progress = self.in_progress
+        return time.perf_counter()
+
+    def end(self, started: float, error: BaseException = None):
+        """
+        Records the end of a handshake.
+
+        :param started: Returned by begin.
+        :param error: Exception the handshake failed with, None if the connection was established.
+        """
+        now = time.perf_counter()
+        with self.lock:
+            self.in_progress -= 1
+            if error is None:
+                self.established += 1
+                second = int(now)
+                slot = self.recent[second % self.window]
+                if slot[0] != second:
+                    slot[0], slot[1] = second, 0
+                slot[1] += 1
+            elif isinstance(error, TimeoutError):
+                self.timed_out += 1
+            else:
+                self.failed += 1
+        if error is None:
+            self.seconds.observe(now - started)
+
+    def snapshot(self) -> dict:
+        """
+        Gets the counters, handshake rates overall and over the last window seconds, and handshake time.
+
+        :return: Dictionary of statistics.
+        """
+        now = time.perf_counter()
+        with self.lock:
+            recent = sum(count for second, count in self.recent if now - second <= self.window)
+            return {'accepted': self.accepted, 'established': self.established, 'failed': self.failed,
+                    'timed_out': self.timed_out, 'in_progress': self.in_progress,
+                    'peak_in_progress': self.peak_in_progress,
+                    'per_second': self.established / (now - self.started),
+                    'recent_per_second': recent / self.window, 'handshake_ms': self.seconds.snapshot()}
+
+
+class Metrics(object):
+
+    def __init__(self):
+        """
+        Initialise Metrics, the peer wide histograms, connections keep their own ConnectionMetrics.
+        """
+        self.started = time.perf_counter()
+        self.handler = Histogram()  # Seconds from receiving a message to its handler returning, queueing included
+        self.handshakes = HandshakeMetrics()  # Incoming connections
+
+    def timed(self, received: float, handler: Callable, *args):
+        """
+        Runs a message handler and records its latency.
+
+        :param received: perf_counter when the message was received.
+        :param handler: Message handler.
+        :param args: Arguments of the handler.
+        """
+        try:
+            handler(*args)
+        finally:
+            self.handler.observe(time.perf_counter() - received)
+
+    def snapshot(self) -> dict:
+        return {'uptime_s': time.perf_counter() - self.started, 'handler_ms': self.handler.snapshot(),
+                'handshakes': self.handshakes.snapshot()}
+
+
+class _StatsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.rstrip('/') not in ('', '/metrics'):
+            self.send_error(404)
+            return
+        body = json.dumps(self.server.stats(), default=str).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self) -> str:
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _UnixHTTPServer(http.server.ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        socket.socket.bind(self.socket, self.server_address)  # HTTPServer.server_bind expects a (host, port)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+class MetricsServer(object):
+
+    def __init__(self, stats: Callable[[], dict], endpoint, _debug: bool = False):
+        """
+        Initialise MetricsServer, serves stats() as JSON on GET / or /metrics, only to this machine.
+
+        :param stats: Returns the statistics, called on every request.
+        :param endpoint: Port to listen to on 127.0.0.1, or the path of a Unix socket, a socket left at the path
+                         is replaced, any other file is not.
+        :param _debug: If True prints debug information to the console; otherwise no debug information is printed.
+        """
+        self.endpoint = endpoint
+        if isinstance(endpoint, int):
+            self.server = http.server.ThreadingHTTPServer(('127.0.0.1', endpoint), _StatsHandler)
+        else:
+            if os.path.lexists(endpoint):
+                if not stat.S_ISSOCK(os.lstat(endpoint).st_mode):
+                    raise Exception('Metrics endpoint {0} exists and is not a socket.'.format(endpoint))
+                os.unlink(endpoint)  # Left over by a peer that did not stop cleanly
+            self.server = _UnixHTTPServer(endpoint, _StatsHandler)
+        self.server.daemon_threads = True
+        self.server.stats = stats
+        self.thread = threading.Thread(target=self.server.serve_forever, name='MetricsServer')
+        self.thread.daemon = True
+        self.thread.start()
+        if _debug:
+            print('[METRICS] Serving on {0}'.format(endpoint))
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if not isinstance(self.endpoint, int):
+            try:
+                os.unlink(self.endpoint)
+            except OSError:
+                pass
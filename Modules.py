@@ -1,25 +1,92 @@
 #!/usr/bin/env python3
-import time
+import datetime
 from Peer import Peer
+from Scheduler import Scheduler
+from Schema import SCHEMA
+from Shards import Shard
 from typing import Callable
 import threading
 
+TIME_TIMER = SCHEMA.register(0x101, 'TIME-TIMER', ('length', 'int'), ('unit', 'str'))
+TIME_ALARM = SCHEMA.register(0x102, 'TIME-ALARM', ('time', 'str'))
+TIME_789 = SCHEMA.register(0x103, 'TIME-789')
+TIME_DONE = SCHEMA.register(0x104, 'TIME-DONE', ('timer', 'u32'), ('what', 'str'))  # Sent when a timer expires
+TIME_CANCEL = SCHEMA.register(0x105, 'TIME-CANCEL', ('timer', 'u32'))
+MONITORCAMERA = SCHEMA.register(0x201, 'MONITORCAMERA', ('code', 'str'))
+
+MICROPHONE_TARGETS = {  # name of this peer: targets of its MicrophoneModule when none are given
+    'server': [('chocy1', ('192.168.1.95', 12110), MONITORCAMERA('456'))],
+    'chocy1': [('chocy2', ('192.168.1.95', 12111), TIME_ALARM('3PM'))],
+    'chocy2': [('server', ('192.168.1.95', 12109), TIME_TIMER(3, 'MINUTES'))],
+}
+
 
 class PeerModule(Peer):
     _peer: Peer = None
+    prefix: str = None  # Command prefix routed to handle_message, e.g. 'TIME'
 
     def __init__(self, peer: Peer):
         self._peer = peer
+        self.dispatch_message = peer.dispatch_message  # Bound to the innermost peer, no per-module delegation
+        if self.prefix is not None:
+            self.register_handler(self.prefix, self.handle_message)
+        if type(self).process_message is not PeerModule.process_message:
+            self.set_fallback_handler(self.process_message)  # Decorator-style module, keep its chain working
 
     def peer(self) -> Peer:
         return self._peer
 
-    def send_message(self, name: str, msg: str):
-        self._peer.send_message(name, msg)
+    def send_message(self, name: str, msg, channel: int = 0):
+        self._peer.send_message(name, msg, channel)
+
+    def send_stream(self, name: str, source, stream_name: str = '', channel: int = 1, chunk_size: int = None) -> int:
+        return self._peer.send_stream(name, source, stream_name, channel, chunk_size)
+
+    def set_stream_handler(self, stream_handler: Callable[[str, str], object]):
+        self._peer.set_stream_handler(stream_handler)
+
+    def broadcast(self, msg, names: list = None, channel: int = 0):
+        self._peer.broadcast(msg, names, channel)
+
+    def create_group(self, group: str, members):
+        self._peer.create_group(group, members)
+
+    def add_group_member(self, group: str, name: str):
+        self._peer.add_group_member(group, name)
+
+    def remove_group_member(self, group: str, name: str):
+        self._peer.remove_group_member(group, name)
+
+    def send_group(self, group: str, msg):
+        self._peer.send_group(group, msg)
+
+    def handle_message(self, name: str, message: str) -> bool:
+        """
+        Handles a message starting with prefix, intended to be overridden by a child Object.
+
+        :param name: Name of peer the message originated from.
+        :param message: Message received from peer.
+        :return: True if the message was handled; False otherwise.
+        """
+        return False
 
     def process_message(self, name: str, message: str, handled: bool):
+        if not handled and self.prefix is not None and message.partition('-')[0] == self.prefix:
+            handled = self.handle_message(name, message)
         self._peer.process_message(name, message, handled)
 
+    def register_handler(self, prefix: str, handler: Callable[[str, str], bool]):
+        self._peer.register_handler(prefix, handler)
+
+    def register_command(self, command, handler: Callable[[str, object], bool]):
+        self._peer.register_command(command, handler)
+
+    def handle_command(self, name: str, message) -> bool:
+        return self._peer.handle_command(name, message)
+
+    def set_fallback_handler(self, fallback_handler: Callable[[str, str, bool], None]):
+        self._peer.set_fallback_handler(fallback_handler)
+
     def open_connection(self, ip: str, port: int):
         self._peer.open_connection(ip, port)
 
@@ -38,9 +105,45 @@ class PeerModule(Peer):
     def is_running(self) -> bool:
         return self._peer.is_running()
 
+    def supervise(self, name: str, ip: str, port: int):
+        self._peer.supervise(name, ip, port)
+
+    def unsupervise(self, name: str):
+        self._peer.unsupervise(name)
+
+    def set_shard(self, shard: Shard):
+        self._peer.set_shard(shard)
+
+    def fan_out(self, names: list, send):
+        self._peer.fan_out(names, send)
+
+    def deliver_message(self, name: str, msg, channel: int = 0):
+        self._peer.deliver_message(name, msg, channel)
+
+    def wait_until_running(self, timeout: float = None) -> bool:
+        return self._peer.wait_until_running(timeout)
+
+    def wait_until_stopped(self, timeout: float = None) -> bool:
+        return self._peer.wait_until_stopped(timeout)
+
+    def handler_stats(self) -> dict:
+        return self._peer.handler_stats()
+
+    def compression_stats(self) -> dict:
+        return self._peer.compression_stats()
+
+    def stats(self) -> dict:
+        return self._peer.stats()
+
+    def request_stats(self, name: str):
+        self._peer.request_stats(name)
+
     def get_name(self) -> str:
         return self._peer.get_name()
 
+    def is_debug(self) -> bool:
+        return self._peer.is_debug()
+
     def get_message_handler(self) -> Callable[[str, str, bool], None]:
         return self._peer.get_message_handler()
 
@@ -49,108 +152,156 @@ class PeerModule(Peer):
 
 
 class TimeModule(PeerModule):
-
-    def process_message(self, name: str, message: str, handled: bool):
-        prefix = 'TIME'
-        if not handled and message.startswith(prefix):
-            handled = True
-            args = message.split('-')
-            match args[1]:
-                case 'TIMER':
-                    length = args[2]
-                    unit = args[3]
-                    self.create_timer(length, unit)
-                    self.send_message(name, 'Timer started for {0} {1}'.format(length, unit))
-                case 'ALARM':
-                    time_ = args[2]
-                    self.create_alarm(time_)
-                    self.send_message(name, 'Alarm set for {0}'.format(time_))
-                case '789':
-                    self.send_message(name, 'zxcvbn3')
-                case _:
-                    handled = False
-
-        self._peer.process_message(name, message, handled)
+    units = {'SECOND': 1, 'SECONDS': 1, 'MINUTE': 60, 'MINUTES': 60, 'HOUR': 3600, 'HOURS': 3600,
+             'DAY': 86400, 'DAYS': 86400}
+    alarm_formats = ('%I%p', '%I:%M%p', '%H:%M', '%H:%M:%S')  # 3PM, 3:30PM, 15:30, 15:30:00
+
+    def __init__(self, peer: Peer, timers_path: str = None):
+        """
+        Initialise TimeModule, runs the timers and alarms peers ask for on one Scheduler and sends
+        TIME-DONE to the peer that asked once they expire.
+
+        :param peer: Peer to decorate.
+        :param timers_path: JSON file timers are saved to, so they survive restarts, None keeps them in memory.
+        """
+        super().__init__(peer)
+        self.scheduler = Scheduler(self.timer_expired, path=timers_path, _debug=peer.is_debug())
+        self.register_command(TIME_TIMER, self.handle_timer)
+        self.register_command(TIME_ALARM, self.handle_alarm)
+        self.register_command(TIME_789, self.handle_789)
+        self.register_command(TIME_CANCEL, self.handle_cancel)
+
+    def handle_timer(self, name: str, message) -> bool:
+        timer_id = self.create_timer(message.length, message.unit, name)
+        if timer_id is None:
+            return False
+        self.send_message(name, 'Timer {0} started for {1} {2}'.format(timer_id, message.length, message.unit))
+        return True
+
+    def handle_alarm(self, name: str, message) -> bool:
+        timer_id = self.create_alarm(message.time, name)
+        if timer_id is None:
+            return False
+        self.send_message(name, 'Alarm {0} set for {1}'.format(timer_id, message.time))
+        return True
+
+    def handle_cancel(self, name: str, message) -> bool:
+        cancelled = self.scheduler.cancel(message.timer)
+        self.send_message(name, 'Timer {0} {1}'.format(message.timer, 'cancelled' if cancelled else 'not found'))
+        return True
+
+    def handle_789(self, name: str, message) -> bool:
+        self.send_message(name, 'zxcvbn3')
+        return True
 
     def start(self):
         if not self.get_message_handler():
-            self.set_message_handler(self.process_message)
+            self.set_message_handler(self.dispatch_message)
+        self.scheduler.start()
         self._peer.start()
 
-    def create_timer(self, length, unit):
-        #  TODO: Implement
-        pass
+    def stop(self):
+        self.scheduler.stop()
+        self._peer.stop()
 
-    def create_alarm(self, time_):
-        #  TODO: Implement
-        pass
+    def create_timer(self, length, unit, name: str = None) -> int:
+        """
+        Starts a timer.
+
+        :param length: Number of units.
+        :param unit: 'SECONDS', 'MINUTES', 'HOURS' or 'DAYS', in any case, singular or plural.
+        :param name: Name of the peer notified when the timer expires, None notifies nobody.
+        :return: Id of the timer, None if the unit is unknown.
+        """
+        seconds = self.units.get(str(unit).upper())
+        if seconds is None or length < 0:
+            return None
+        return self.scheduler.schedule(length * seconds, {'peer': name, 'what': '{0} {1}'.format(length, unit)})
+
+    def create_alarm(self, time_, name: str = None) -> int:
+        """
+        Sets an alarm for the next time the local clock shows a time of day.
+
+        :param time_: Time of day, e.g. '3PM', '3:30PM' or '15:30'.
+        :param name: Name of the peer notified when the alarm goes off, None notifies nobody.
+        :return: Id of the alarm, None if the time does not parse.
+        """
+        for time_format in self.alarm_formats:
+            try:
+                clock = datetime.datetime.strptime(time_.upper(), time_format).time()
+                break
+            except ValueError:
+                continue
+        else:
+            return None
+        now = datetime.datetime.now()
+        due = datetime.datetime.combine(now.date(), clock)
+        if due <= now:
+            due += datetime.timedelta(days=1)
+        return self.scheduler.schedule((due - now).total_seconds(), {'peer': name, 'what': 'alarm {0}'.format(time_)})
+
+    def timer_expired(self, timer_id: int, data: dict):
+        if data.get('peer') is not None:
+            self.send_message(data['peer'], TIME_DONE(timer_id, data['what']))
 
 
 class MicrophoneModule(PeerModule):
+    # Microphones have nothing to output, so no prefix is registered.
 
-    def process_message(self, name: str, message: str, handled: bool):
-        # Microphones have nothing to output.
-        self._peer.process_message(name, message, handled)
+    def __init__(self, peer: Peer, targets: list = None, interval: float = 5.0):
+        """
+        Initialise MicrophoneModule, sends a message to every connected target each interval.
+        Targets are supervised by the peer, which reconnects them with backoff when their connection closes.
+
+        :param peer: Peer to decorate.
+        :param targets: List of (peer_name, (ip, port), message), MICROPHONE_TARGETS of this peers name if None.
+        :param interval: Seconds between messages.
+        """
+        super().__init__(peer)
+        self.targets = targets if targets is not None else MICROPHONE_TARGETS.get(self.get_name(), [])
+        self.interval = interval
 
     def start(self):
         if not self.get_message_handler():
-            self.set_message_handler(self.process_message)
+            self.set_message_handler(self.dispatch_message)
 
+        for peer, address, msg in self.targets:
+            self.supervise(peer, address[0], address[1])
         thread = threading.Thread(target=self.listen)
         thread.start()
         self._peer.start()
 
     def listen(self):
-        peer = ''
-        msg = ''
-        address = ()
-        if self.get_name() == 'server':
-            peer = 'chocy1'
-            msg = 'MONITORCAMERA-456'
-            address = ('192.168.1.95', 12110)
-        elif self.get_name() == 'chocy1':
-            peer = 'chocy2'
-            msg = 'TIME-ALARM-3PM'
-            address = ('192.168.1.95', 12111)
-        elif self.get_name() == 'chocy2':
-            peer = 'server'
-            msg = 'TIME-TIMER-3-MINUTES'
-            address = ('192.168.1.95', 12109)
-
-        while not self.is_running():
-            pass
-
-        while self.is_running():
-            if self.is_connected_to_peer(peer):
-                self.send_message(peer, msg)
-            else:  # here
-                try:
-                    self.open_connection(address[0], address[1])
-                except ConnectionRefusedError:
-                    pass
-            time.sleep(5)
+        if not self.targets:
+            return
 
+        self.wait_until_running()
+        while not self.wait_until_stopped(self.interval):
+            for peer, address, msg in self.targets:
+                if self.is_connected_to_peer(peer):
+                    self.send_message(peer, msg)
 
-class MonitorModule(PeerModule):
 
-    def process_message(self, name: str, message: str, handled: bool):
-        prefix = 'MONITORCAMERA'
-        if not handled and message.startswith(prefix):
-            handled = True
-            args = message.split('-')
-            match args[1]:
-                case '123':
-                    self.send_message(name, 'zxcvbn1')
-                case '456':
-                    self.send_message(name, 'I did it.')
-                case '789':
-                    self.send_message(name, 'zxcvbn3')
-                case _:
-                    handled = False
+class MonitorModule(PeerModule):
 
-        self._peer.process_message(name, message, handled)
+    def __init__(self, peer: Peer):
+        super().__init__(peer)
+        self.register_command(MONITORCAMERA, self.handle_camera)
+
+    def handle_camera(self, name: str, message) -> bool:
+        handled = True
+        match message.code:
+            case '123':
+                self.send_message(name, 'zxcvbn1')
+            case '456':
+                self.send_message(name, 'I did it.')
+            case '789':
+                self.send_message(name, 'zxcvbn3')
+            case _:
+                handled = False
+        return handled
 
     def start(self):
         if not self.get_message_handler():
-            self.set_message_handler(self.process_message)
+            self.set_message_handler(self.dispatch_message)
         self._peer.start()
@@ -1,12 +1,34 @@
 #!/usr/bin/env python3
+import json
 import sys
 import threading
 import time
-from CommunicationProtocols import CommunicationProtocol
+from concurrent.futures import ThreadPoolExecutor
+from CommunicationProtocols import BinaryFraming, CommunicationProtocol
+from Connections import ConnectionRegistry
+from CryptoPool import CryptoPool
+from Discovery import Discovery
+from Gossip import Gossip
+from Groups import GROUP_KEY, GroupFrame, Groups
+from KeyExchange import backends
+from KeyStore import KeyStore
+from Metrics import Metrics, MetricsServer
+from Schema import SCHEMA
+from Sessions import SessionCache
+from Shards import Shard
+from Supervisor import ConnectionSupervisor
+from Workers import HandlerPool
 import socket
 from typing import Callable
 from abc import ABC, abstractmethod
 
+PEERLIST_REQ = SCHEMA.register(1, 'BUILTIN-PEERLIST-REQ')
+PEERLIST_UPD = SCHEMA.register(2, 'BUILTIN-PEERLIST-UPD', ('peers', (('name', 'str'), ('ip', 'str'), ('port', 'u16'))))
+STATS_REQ = SCHEMA.register(3, 'BUILTIN-STATS-REQ')
+STATS_RES = SCHEMA.register(4, 'BUILTIN-STATS-RES', ('stats', 'str'))  # JSON of Peer.stats
+
+BACKLOG = 128  # Default number of incoming connections waiting to be accepted, shared by both engines
+
 
 class Peer(ABC):
     name: str = None
@@ -15,21 +37,49 @@ class Peer(ABC):
     _debug: bool = False
 
     message_handler: Callable = None
+    stream_handler: Callable = None  # (name, stream_name) -> sink of an incoming stream, None discards streams
+    handlers: dict = None  # prefix: handler(name, message) -> handled, see dispatch_message
+    commands: dict = None  # command id: handler(name, parsed message) -> handled, see handle_command
+    fallback_handler: Callable = None
 
     incoming_socket: socket.socket = None
     comm: CommunicationProtocol = None
     running: bool = False
-    connections: dict = {}
-    known_peers: dict = {}  # peer_name: (ip, port)
+    connections: ConnectionRegistry = None  # Open connections and known peers, one per instance
+    framing: str = 'eom'
+    cipher: str = 'cbc'
+    curve: str = 'brainpoolP256r1'
+    resumption: bool = False
+    mux: bool = False
+    compression: str = None
+    compression_threshold: int = 256
+    compression_dictionary: bytes = None
+    schema: bool = False
+    pipeline: bool = False
+    group: bool = False  # Offer group frames, sealed once per group instead of once per connection
+    groups: Groups = None  # Groups we send to and the group keys of other peers
+    discovery: Discovery = None  # Announces this peer by UDP multicast on the LAN, None if disabled
+    sessions: SessionCache = None
+    keystore: KeyStore = None
+    private_key: int = None
+    public_key = None
+    handler_pool: HandlerPool = None  # None runs handlers inline on the receive loop
+    gossip: Gossip = None  # Answers gossip exchanges, gossips periodically if its interval is set
+    gossip_interval: float = 0.0  # 0 keeps the full PEERLIST exchange at start up
+    metrics: Metrics = None  # None disables handler latency and per connection metrics
+    metrics_endpoint = None  # Port or Unix socket path stats are served on, None serves none
+    metrics_server: MetricsServer = None
+    peer_stats: dict = None  # peer_name: stats it last sent in answer to request_stats
+    supervisor: ConnectionSupervisor = None  # Reconnects to supervised peers when their connection closes
+    started: threading.Event = None  # Set once the peer is running
+    crypto_pool: CryptoPool = None  # Processes encrypting and decrypting messages, None does it on each connection
+    shard: Shard = None  # Worker of a ShardedServer this peer runs as, None if it runs alone
+    stopped: threading.Event = None  # Set once the peer is stopped
 
     @abstractmethod
     def send_message(self, name: str, msg: str):
         pass
 
-    @abstractmethod
-    def process_message(self, name: str, message: str, handled: bool):
-        pass
-
     @abstractmethod
     def open_connection(self, ip: str, port: int):
         pass
@@ -52,6 +102,500 @@ class Peer(ABC):
     def set_message_handler(self, message_handler: Callable):
         self.message_handler = message_handler
 
+    def set_stream_handler(self, stream_handler: Callable[[str, str], object]):
+        """
+        Sets the handler opening a sink for every incoming stream, e.g. a Streams.FileSink or Streams.StreamReader.
+        Sinks are written to on the receive loop of the connection, so they should not block for long.
+
+        :param stream_handler: Called with (name, stream_name), returns an object with write(data) and close(),
+                               and optionally abort(), or None to discard the stream.
+        """
+        self.stream_handler = stream_handler
+
+    def open_stream_sink(self, name: str, stream_name: str):
+        """
+        Opens the sink of an incoming stream with the stream handler.
+
+        :param name: Name of peer the stream originated from.
+        :param stream_name: Name the sender gave the stream.
+        :return: The sink, None to discard the stream.
+        """
+        if self.stream_handler is None:
+            if self._debug:
+                print('[DISCARDED] Stream \"{0}\" FROM {1}'.format(stream_name, name))
+            return None
+        return self.stream_handler(name, stream_name)
+
+    def register_handler(self, prefix: str, handler: Callable[[str, str], bool]):
+        """
+        Routes every message whose prefix, the text before the first '-', matches to a handler.
+
+        :param prefix: Command prefix, e.g. 'TIME'.
+        :param handler: Called with (name, message), returns True if the message was handled.
+        """
+        if self.handlers is None:
+            self.handlers = {}
+        self.handlers[prefix] = handler
+
+    def register_command(self, command, handler: Callable[[str, object], bool]):
+        """
+        Routes every message of a command of the schema to a handler, with its fields already parsed.
+        Binary messages are decoded once by the connection, text messages are parsed once on dispatch.
+
+        :param command: Command registered with Schema.SCHEMA.
+        :param handler: Called with (name, message), returns True if the message was handled.
+        """
+        if self.commands is None:
+            self.commands = {}
+        self.commands[command.id] = handler
+
+    def handle_command(self, name: str, message) -> bool:
+        """
+        Passes a message of a registered command to its handler.
+
+        :param name: Name of peer the message originated from.
+        :param message: Parsed message, or text which is parsed here.
+        :return: True if the message was handled; False otherwise.
+        """
+        if not self.commands:
+            return False
+        if isinstance(message, str):
+            message = SCHEMA.parse_text(message)
+            if message is None:
+                return False
+        handler = self.commands.get(message.command.id)
+        return handler is not None and handler(name, message)
+
+    def set_fallback_handler(self, fallback_handler: Callable[[str, str, bool], None]):
+        """
+        Sets the process_message chain messages are passed to when no registered handler took them.
+
+        :param fallback_handler: Called with (name, message, handled).
+        """
+        self.fallback_handler = fallback_handler
+
+    def dispatch_message(self, name: str, message, handled: bool = False):
+        """
+        Routes a message of a registered command to its command handler, otherwise straight to the handler
+        registered for its prefix, a single dictionary lookup.
+        Messages no handler took go through the process_message chain of decorator-style modules, if any,
+        as text, handled messages reach process_message as they were received.
+
+        :param name: Name of peer the message originated from.
+        :param message: Message received from peer, text or a message decoded from the binary envelope.
+        :param handled: True if the message has been handled; False otherwise.
+        """
+        if not handled and self.commands:
+            handled = self.handle_command(name, message)
+        if not handled:
+            message = str(message)  # Commands without a handler go on as text
+            handler = self.handlers.get(message.partition('-')[0]) if self.handlers else None
+            if handler is not None:
+                handled = handler(name, message)
+        if not handled and self.fallback_handler is not None:
+            self.fallback_handler(name, message, handled)
+        else:
+            self.process_message(name, message, handled)
+
+    def process_message(self, name: str, message: str, handled: bool):
+        """
+        Intended to be overridden by a child Object to process incoming messages, here to maintain debug printing.
+
+        :param name: Name of peer the message originated from.
+        :param message: Message received from peer.
+        :param handled: True if the message has been handled; False otherwise.
+        """
+        if not handled and message.partition('-')[0] == 'BUILTIN':
+            handled = self.handle_builtin(name, message)
+
+        if self._debug:
+            if handled:
+                print('[RECEIVED] \"{0}\" FROM {1} '.format(message, name))
+            else:
+                print('[RECEIVED UNKNOWN] \"{0}\" FROM {1} '.format(message, name))
+
+    def register_builtins(self):
+        """
+        Registers the handlers of the BUILTIN messages every engine answers.
+        """
+        self.register_handler('BUILTIN', self.handle_builtin)
+        self.register_command(PEERLIST_REQ, self.handle_peerlist_request)
+        self.register_command(PEERLIST_UPD, self.handle_peerlist_update)
+        self.register_command(STATS_REQ, self.handle_stats_request)
+        self.register_command(STATS_RES, self.handle_stats_response)
+        self.register_command(GROUP_KEY, self.handle_group_key)
+
+    def received_handler(self, name: str, message) -> tuple:
+        """
+        Gets the call passing a received message to the message handler, group frames are opened first.
+        Peers without a message handler dispatch to their registered handlers.
+        With metrics, the handler's latency from now until it returns is recorded.
+
+        :param name: Name of peer the message originated from.
+        :param message: Message received from peer.
+        :return: Tuple of (function, arguments) to run, None if the message was dropped.
+        """
+        if message.__class__ is GroupFrame:
+            message = self.open_group_frame(name, message)
+            if message is None:
+                return None
+        handler = self.message_handler if self.message_handler is not None else self.dispatch_message
+        if self.metrics is None:
+            return handler, (name, message, False)
+        return self.metrics.timed, (time.perf_counter(), handler, name, message, False)
+
+    def handle_received(self, name: str, message: str):
+        """
+        Passes a received message to the message handler, on the handler pool if there is one.
+        Blocks while the pool's queue is full under the 'block' policy.
+
+        :param name: Name of peer the message originated from.
+        :param message: Message received from peer.
+        """
+        call = self.received_handler(name, message)
+        if call is None:
+            return
+        handler, args = call
+        if self.handler_pool is None:
+            handler(*args)
+        else:
+            self.handler_pool.submit(name, handler, *args)
+
+    def handler_stats(self) -> dict:
+        """
+        Gets the counters and queue latency of the handler pool.
+
+        :return: Dictionary of statistics, empty if handlers run inline.
+        """
+        return self.handler_pool.stats() if self.handler_pool is not None else {}
+
+    def compression_stats(self) -> dict:
+        """
+        Gets the compression ratio and CPU time of every connection that negotiated compression.
+
+        :return: Dictionary of peer_name: statistics.
+        """
+        return {comm.get_peer_name(): comm.compression_stats() for comm in self.connections.values()
+                if comm.compressor is not None}
+
+    def open_group_frame(self, name: str, frame: GroupFrame):
+        """
+        Opens a frame sealed with the group key of the peer it arrived from.
+
+        :param name: Name of peer the frame originated from.
+        :param frame: The frame.
+        :return: The message, None if it could not be opened.
+        """
+        message = self.groups.open(name, frame)
+        if message is None and self._debug:
+            print('[DROPPED] Group message FROM {0}, unknown key or invalid'.format(name))
+        return message
+
+    def create_group(self, group: str, members):
+        """
+        Creates a group with a new key of ours and hands the key to every member over its encrypted connection.
+        Members need not create the group to receive from it, only to send to it.
+
+        :param group: Name of the group.
+        :param members: Names of the peers in the group.
+        """
+        self.groups.create(group, [member for member in members if member != self.name])
+        self.send_group_key(group, self.groups.members_of(group))
+
+    def add_group_member(self, group: str, name: str):
+        self.groups.add(group, name)
+        self.send_group_key(group, [name])
+
+    def remove_group_member(self, group: str, name: str):
+        """
+        Removes a member, the remaining members get a new key so it cannot read later messages.
+
+        :param group: Name of the group.
+        :param name: Name of the member.
+        """
+        self.groups.remove(group, name)
+        self.send_group_key(group, self.groups.members_of(group))
+
+    def send_group_key(self, group: str, names: list):
+        key = self.groups.key(group)
+        for name in names:
+            self.send_message(name, GROUP_KEY(group, key.key_id, key.key))
+
+    def handle_group_key(self, name: str, message) -> bool:
+        self.groups.store(name, message)
+        return True
+
+    def send_group(self, group: str, msg):
+        """
+        Sends a message to every member of a group, encrypted once with our group key and the same frame sent to
+        every member that negotiated group frames. Other members get it encrypted for their connection.
+
+        :param group: Name of a group created with create_group.
+        :param msg: Message to be sent, text or a message created by a command of the schema.
+        """
+        frame = BinaryFraming.frame_group(self.groups.seal(group, msg))
+
+        def send(comm):
+            if 'group' in comm.negotiated:
+                comm.send_frame(frame)
+            else:
+                comm.send_message(msg)
+
+        self.fan_out(self.groups.members_of(group), send)
+
+    def broadcast(self, msg, names: list = None, channel: int = 0):
+        """
+        Sends a message to several peers in parallel, encrypted for each connection.
+        Use send_group to encrypt it only once.
+
+        :param msg: Message to be sent, text or a message created by a command of the schema.
+        :param names: Names of the peers, every connected and known peer if None.
+        :param channel: Channel to send on, lower channels are sent first when channels were negotiated.
+        """
+        if names is None:
+            names = set(self.connections.names()) | set(self.connections.known_peers())
+        self.fan_out([name for name in names if name != self.name], lambda comm: comm.send_message(msg, channel))
+
+    @abstractmethod
+    def fan_out(self, names: list, send: Callable[[CommunicationProtocol], None]):
+        """
+        Calls send with the connection of every peer, connecting to known peers first.
+
+        :param names: Names of the peers.
+        :param send: Called with each connection.
+        """
+        pass
+
+    def create_discovery(self, interval: float, secret: bytes = None):
+        """
+        Creates the UDP multicast discovery, peers announcing themselves on the LAN become known peers.
+
+        :param interval: Seconds between announcements.
+        :param secret: Shared key authenticating announcements, None accepts every peer on the LAN.
+        """
+        self.discovery = Discovery(self.name, self.port, lambda peer_name, address: self.add_peer(peer_name, *address),
+                                   interval=interval, secret=secret, _debug=self._debug)
+
+    def start_discovery(self):
+        if self.discovery is not None:
+            try:
+                self.discovery.start()
+            except OSError as e:  # No multicast route, the peer still works without discovery
+                print('[DISCOVERY] Unavailable: {0}'.format(e))
+
+    def create_supervisor(self, workers: int = 4, base: float = 0.5, cap: float = 60.0):
+        """
+        Creates the connection supervisor and the events signalling the peer started and stopped.
+
+        :param workers: Connection attempts running at the same time.
+        :param base: Seconds before the first reconnect attempt.
+        :param cap: Largest number of seconds between reconnect attempts.
+        """
+        self.started = threading.Event()
+        self.stopped = threading.Event()
+        self.supervisor = ConnectionSupervisor(self.connect_peer, self.is_connected_to_peer, workers=workers,
+                                               base=base, cap=cap, _debug=self._debug)
+
+    def supervise(self, name: str, ip: str, port: int):
+        """
+        Keeps a connection to a peer open while running, it is reconnected with backoff whenever it closes.
+
+        :param name: Name of the peer.
+        :param ip: IP address of the peer.
+        :param port: Port of the peer.
+        """
+        self.add_peer(name, ip, port)
+        self.supervisor.watch(name, (ip, port))
+
+    def unsupervise(self, name: str):
+        self.supervisor.unwatch(name)
+
+    def connect_peer(self, name: str, address: tuple) -> bool:
+        """
+        Connects to a peer for the supervisor, called on one of its threads.
+
+        :param name: Name of the peer.
+        :param address: Tuple of (ip, port) of the peer.
+        :return: True if the peer is connected; False otherwise.
+        """
+        self.open_connection(*address)
+        return self.is_connected_to_peer(name)
+
+    def connection_opened(self, comm: CommunicationProtocol):
+        """
+        Called once a connection is registered, routes its peer to this shard.
+
+        :param comm: The connection.
+        """
+        if self.shard is not None:
+            self.shard.claim(comm.get_peer_name())
+
+    def connection_closed(self, comm: CommunicationProtocol):
+        """
+        Called when the receive loop of a connection ends, unregisters it and wakes the supervisor.
+
+        :param comm: The connection.
+        """
+        if not self.connections.remove(comm):
+            return
+        if self.shard is not None:
+            self.shard.release(comm.get_peer_name())
+        if self.running:
+            self.supervisor.closed(comm.get_peer_name())
+
+    def set_shard(self, shard: Shard):
+        """
+        Runs this peer as a worker of a ShardedServer, must be called before it starts, the engines call it when
+        they are created with a shard. The port is shared with the other workers, and the identity key of the
+        server, loaded before forking, replaces this peers own in memory only.
+
+        :param shard: Shard of this worker.
+        """
+        self.shard = shard
+        for curve, keys in shard.identity.items():
+            self.keystore.store_local_keys('{0}-'.format(self.name), *keys, backends[curve], save=False)
+        self.private_key, self.public_key = shard.identity['brainpoolP256r1']
+
+    @abstractmethod
+    def deliver_message(self, name: str, msg, channel: int = 0):
+        """
+        Sends a message to a peer by name from this process, never forwarding it to another shard.
+
+        :param name: Name of the peer.
+        :param msg: Text, or a message created by a command of the schema.
+        :param channel: Channel to send on.
+        """
+        pass
+
+    def wait_until_running(self, timeout: float = None) -> bool:
+        """
+        Blocks until the peer is running.
+
+        :param timeout: Seconds to wait at most, None waits indefinitely.
+        :return: True if the peer is running; False if the timeout passed.
+        """
+        return self.started.wait(timeout)
+
+    def wait_until_stopped(self, timeout: float = None) -> bool:
+        """
+        Blocks until the peer is stopped.
+
+        :param timeout: Seconds to wait at most, None waits indefinitely.
+        :return: True if the peer is stopped; False if the timeout passed.
+        """
+        return self.stopped.wait(timeout)
+
+    def create_metrics(self, enabled: bool, endpoint=None):
+        """
+        Enables metrics, every connection opened afterwards records its own.
+
+        :param enabled: If True records handler latency and per connection metrics.
+        :param endpoint: Port on 127.0.0.1 or Unix socket path to serve stats as JSON on while running,
+                         None serves them only to peers asking with BUILTIN-STATS-REQ.
+        """
+        self.metrics = Metrics() if enabled or endpoint is not None else None
+        self.metrics_endpoint = endpoint
+        self.peer_stats = {}
+
+    def start_metrics_server(self):
+        if self.metrics_endpoint is not None and self.metrics_server is None:
+            self.metrics_server = MetricsServer(self.stats, self.metrics_endpoint, _debug=self._debug)
+
+    def stop_metrics_server(self):
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            self.metrics_server = None
+
+    def stats(self) -> dict:
+        """
+        Gets the statistics of this peer and every open connection, see CommunicationProtocol.stats.
+
+        :return: Dictionary of statistics.
+        """
+        result = {'name': self.name, 'connections': {comm.get_peer_name(): comm.stats()
+                                                     for comm in self.connections.values()}}
+        if self.metrics is not None:
+            result.update(self.metrics.snapshot())
+        if self.handler_pool is not None:
+            result['handler_pool'] = self.handler_pool.stats()
+        if self.gossip is not None:
+            result['gossip'] = self.gossip.stats()
+        if self.discovery is not None:
+            result['discovery'] = self.discovery.stats()
+        if self.crypto_pool is not None:
+            result['crypto_pool'] = self.crypto_pool.stats()
+        if self.shard is not None:
+            result['shard'] = self.shard.stats()
+        result['supervisor'] = self.supervisor.stats()
+        return result
+
+    def request_stats(self, name: str):
+        """
+        Asks a peer for its statistics, its answer is kept in peer_stats. Peers without metrics do not answer.
+
+        :param name: Name of the peer.
+        """
+        self.send_message(name, STATS_REQ())
+
+    def handle_builtin(self, name: str, message: str) -> bool:
+        """
+        Handles BUILTIN messages, gossip, the peer list exchange and statistics.
+
+        :param name: Name of peer the message originated from.
+        :param message: Message received from peer.
+        :return: True if the message was handled; False otherwise.
+        """
+        if message.startswith('BUILTIN-GOSSIP-'):
+            return self.gossip is not None and self.gossip.handle(name, message)
+        return self.handle_command(name, message)
+
+    def handle_peerlist_request(self, name: str, message) -> bool:
+        self.send_message(name, self.create_known_peer_list())
+        return True
+
+    def handle_peerlist_update(self, name: str, message) -> bool:
+        for peer_name, ip, port in message.peers:
+            self.add_peer(peer_name, ip, port)
+        return True
+
+    def handle_stats_request(self, name: str, message) -> bool:
+        if self.metrics is None:
+            return False
+        self.send_message(name, STATS_RES(json.dumps(self.stats(), default=str)))
+        return True
+
+    def handle_stats_response(self, name: str, message) -> bool:
+        try:
+            self.peer_stats[name] = json.loads(message.stats)
+        except (TypeError, ValueError):
+            return False
+        return True
+
+    def create_gossip(self, fanout: int, interval: float):
+        """
+        Creates the gossip subsystem spreading this peers known peers.
+
+        :param fanout: Peers gossiped with per round.
+        :param interval: Seconds between rounds, 0 only answers other peers.
+        """
+        self.gossip_interval = interval
+        self.gossip = Gossip(self.name, self.send_message, self.connections.known_peers,
+                             on_update=lambda peer_name, address: self.add_peer(peer_name, *address),
+                             fanout=fanout, interval=interval, _debug=self._debug)
+        if self.host:
+            self.gossip.observe(self.name, (self.host, self.port))
+
+    def add_peer(self, peer_name: str, ip: str, port: int):
+        status = self.connections.add_known_peer(peer_name, (ip, port))
+        if self.gossip is not None:
+            self.gossip.observe(peer_name, (ip, port))
+        if self._debug:
+            print('[ADD_PEER] PEER [{0}@{1}:{2}] {3}'.format(peer_name, ip, port, status))
+
+    def create_known_peer_list(self):
+        return PEERLIST_UPD([(peer_name, address[0], address[1])
+                             for peer_name, address in self.connections.known_peers().items()])
+
     def is_connected_to_peer(self, name: str) -> bool:
         """
         Gets connection status to the peer.
@@ -59,14 +603,41 @@ class Peer(ABC):
         :param name: Name of the peer to check the connection status to.
         :return: True if connection to the peer is open; False otherwise.
         """
-        connected = False
-        if name in self.connections.keys():
-            connected = self.connections[name].is_open()
-        return connected
+        return self.connections.is_connected(name)
 
     def is_running(self) -> bool:
         return self.running
 
+    def connection_options(self, address: tuple = None) -> dict:
+        """
+        Gets the keyword arguments for the CommunicationProtocol of a connection.
+
+        :param address: Tuple of (ip, port) for outgoing connections, None for incoming connections.
+        :return: Keyword arguments for CommunicationProtocol.
+        """
+        options = {'private_key': self.private_key, 'public_key': self.public_key, 'keystore': self.keystore,
+                   'file_prefix': '{0}-'.format(self.name), 'stream_handler': self.open_stream_sink,
+                   'compression_threshold': self.compression_threshold,
+                   'compression_dictionary': self.compression_dictionary, 'metrics': self.metrics is not None,
+                   '_debug': self._debug}
+        if self.crypto_pool is not None:
+            options['crypto_pool'] = self.crypto_pool
+        if address is None:
+            options['session_cache'] = self.sessions
+        else:
+            options['framing'] = self.framing
+            options['cipher'] = self.cipher
+            options['curve'] = self.curve
+            options['mux'] = self.mux
+            options['compression'] = self.compression
+            options['schema'] = self.schema
+            options['pipeline'] = self.pipeline
+            options['group'] = self.group
+            if self.resumption:
+                options['session_cache'] = self.sessions
+                options['resume_peer'] = self.connections.known_peer_name(address)
+        return options
+
     def get_name(self) -> str:
         return self.name
 
@@ -76,7 +647,18 @@ class Peer(ABC):
 
 class Client(Peer):
 
-    def __init__(self, name: str, host: str, port: int, _debug: bool = False):
+    def __init__(self, name: str, host: str, port: int, _debug: bool = False, framing: str = 'eom',
+                 cipher: str = 'cbc', curve: str = 'brainpoolP256r1', resumption: bool = False,
+                 session_ttl: float = 3600, key_directory: str = None, flush_latency: float = 0.0,
+                 flush_bytes: int = 65536, handler_workers: int = 0, handler_queue: int = 1024,
+                 handler_policy: str = 'block', mux: bool = False, gossip_interval: float = 0.0,
+                 gossip_fanout: int = 3, compression: str = None, compression_threshold: int = 256,
+                 compression_dictionary: bytes = None, schema: bool = False, pipeline: bool = False,
+                 metrics: bool = False, metrics_endpoint=None, group: bool = False, broadcast_workers: int = 8,
+                 discovery: bool = False, discovery_interval: float = 30.0, discovery_secret: bytes = None,
+                 reconnect_workers: int = 4, reconnect_base: float = 0.5, reconnect_cap: float = 60.0,
+                 backlog: int = BACKLOG, handshake_workers: int = 16, handshake_timeout: float = 10.0,
+                 crypto_processes: int = 0, shard: Shard = None):
         """
         Initialise Client Object.
 
@@ -84,119 +666,255 @@ class Client(Peer):
         :param host: IP address of the server.
         :param port: Port the peer is listening to.
         :param _debug: If True prints debug information to the console; otherwise no debug information is printed.
+        :param framing: Framing offered on outgoing connections, 'eom' or 'binary'.
+        :param cipher: Cipher offered on outgoing connections, 'cbc', 'aes-gcm' or 'chacha20-poly1305'.
+        :param curve: Curve offered for the key exchange on outgoing connections, 'brainpoolP256r1' or 'P-256'.
+        :param resumption: If True outgoing connections offer to resume cached sessions instead of a full handshake.
+        :param session_ttl: Seconds a session can be resumed for.
+        :param key_directory: Directory the identity key and peer keys are saved in, None keeps them in memory.
+        :param flush_latency: Seconds outgoing messages may wait to be coalesced into one send, 0 sends immediately.
+        :param flush_bytes: Pending outgoing bytes per connection that are sent without waiting for flush_latency.
+        :param handler_workers: Threads running message handlers, 0 runs them on each connection's receive thread.
+        :param handler_queue: Maximum number of received messages waiting for a handler thread.
+        :param handler_policy: 'block' stops reading while the queue is full, 'drop' discards new messages.
+        :param mux: If True outgoing connections offer logical channels, requires an AEAD cipher.
+        :param gossip_interval: Seconds between gossip rounds exchanging only changed peer list entries,
+                                0 requests the full peer list from every known peer at start up instead.
+        :param gossip_fanout: Peers gossiped with per round.
+        :param compression: Compression offered on outgoing connections, 'zlib' or 'lzma', requires an AEAD cipher.
+        :param compression_threshold: Messages shorter than this many bytes are sent uncompressed.
+        :param compression_dictionary: Preset zlib dictionary shared with peers, improves ratios of short messages.
+        :param schema: If True outgoing connections offer binary messages of registered commands,
+                       requires an AEAD cipher.
+        :param pipeline: If True outgoing connections offer the pipelined handshake, messages are sent
+                         one round trip sooner.
+        :param metrics: If True records handler latency, handshake and encryption time and message counters.
+        :param metrics_endpoint: Port on 127.0.0.1 or Unix socket path serving stats as JSON, enables metrics.
+        :param group: If True outgoing connections offer group frames, see send_group.
+        :param broadcast_workers: Threads sending a broadcast or group message to several peers in parallel.
+        :param discovery: If True announces this peer and learns other peers by UDP multicast on the LAN.
+        :param discovery_interval: Seconds between announcements.
+        :param discovery_secret: Shared key authenticating announcements, None accepts every peer on the LAN.
+        :param reconnect_workers: Connection attempts to supervised peers running at the same time.
+        :param reconnect_base: Seconds before the first attempt to reconnect to a supervised peer.
+        :param reconnect_cap: Largest number of seconds between attempts to reconnect to a supervised peer.
+        :param backlog: Maximum number of incoming connections waiting to be accepted.
+        :param handshake_workers: Threads running the handshakes of incoming connections, connections are
+                                  only accepted while one is free, the others wait in the backlog.
+        :param handshake_timeout: Seconds the whole handshake of an incoming connection may take.
+        :param crypto_processes: Processes encrypting and decrypting the messages of every connection in batches,
+                                 so a peer with many connections uses every core, 0 encrypts on each
+                                 connection's thread. Messages sent on channels are always encrypted there.
+        :param shard: Shard of a ShardedServer this peer runs as a worker of, its identity is used instead of
+                      loading or generating one, see set_shard.
         """
         self.name = name
         self.host = host
         self.port = port
         self._debug = _debug
+        self.framing = framing
+        self.cipher = cipher
+        self.curve = curve
+        self.resumption = resumption
+        self.mux = mux
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.compression_dictionary = compression_dictionary
+        self.schema = schema
+        self.pipeline = pipeline
+        self.group = group
+        self.groups = Groups()
+        self.broadcast_workers = broadcast_workers
+        self.broadcast_pool: ThreadPoolExecutor = None  # Created by the first fan out to several peers
+        self.sessions = SessionCache(ttl=session_ttl)
+        self.keystore = KeyStore(key_directory)
+        self.flush_latency = flush_latency
+        self.flush_bytes = flush_bytes
+        self.backlog = backlog
+        self.handshake_timeout = handshake_timeout
+        self.handshake_slots = threading.BoundedSemaphore(handshake_workers)
+        self.handshake_pool = ThreadPoolExecutor(max_workers=handshake_workers, thread_name_prefix='Handshake')
+        if crypto_processes > 0:
+            self.crypto_pool = CryptoPool(crypto_processes, _debug=_debug)
+        self.connections = ConnectionRegistry()
+        if shard is not None:
+            self.set_shard(shard)
+        else:
+            self.private_key, self.public_key = self.keystore.load_local_keys('{0}-'.format(name),
+                                                                              backends['brainpoolP256r1'])
+        self.register_builtins()
+        if handler_workers > 0:
+            self.handler_pool = HandlerPool(handler_workers, handler_queue, handler_policy, _debug=_debug)
+        self.create_gossip(gossip_fanout, gossip_interval)
+        self.create_metrics(metrics, metrics_endpoint)
+        if discovery:
+            self.create_discovery(discovery_interval, discovery_secret)
+        self.create_supervisor(reconnect_workers, reconnect_base, reconnect_cap)
 
-    def send_message(self, name: str, msg: str):
+    def send_message(self, name: str, msg, channel: int = 0):
         """
         Sends message to peer by name.
 
         :param name: Name of peer to send message to.
-        :param msg: Message to be sent to the peer.
+        :param msg: Message to be sent to the peer, text or a message created by a command of the schema.
+        :param channel: Channel to send on, lower channels are sent first when channels were negotiated.
+        """
+        if self.shard is not None and not self.connections.is_connected(name):
+            if self.shard.forward(name, msg, channel):  # Connected to another shard
+                return
+        self.deliver_message(name, msg, channel)
+
+    def deliver_message(self, name: str, msg, channel: int = 0):
+        comm = self.get_connection(name)
+        if comm is not None:
+            comm.send_message(msg, channel)
+
+    def get_connection(self, name: str) -> CommunicationProtocol:
+        """
+        Gets the connection to a peer by name, connecting first if the peer is known but not connected.
+
+        :param name: Name of the peer.
+        :return: The connection, None if the peer is not connected.
         """
-        if name not in self.connections.keys():
-            if name in self.known_peers.keys():
-                self.open_connection(self.known_peers[name][0], self.known_peers[name][1])
+        comm = self.connections.get(name)
+        if comm is None:
+            address = self.connections.get_known_peer(name)
+            if address is not None:
+                comm = self.open_connection(*address)
             elif self._debug:
                 print('UNKNOWN name {0}'.format(name))
 
-        if name in self.connections.keys():
-            self.connections[name].send_message(msg)
-        else:
+        if comm is None:
             print('Peer {0} is not connected'.format(name))
+        return comm
 
-    def process_message(self, name: str, message: str, handled: bool):
+    def fan_out(self, names: list, send: Callable[[CommunicationProtocol], None]):
         """
-        Intended to be overridden by a child Object to process incoming messages, here to maintain debug printing.
+        Calls send with the connection of every peer, on the broadcast threads so a slow peer or connection
+        does not hold up the others, and returns once every peer was sent to.
 
-        :param name: Name of peer the message originated from.
-        :param message: Message received from peer.
-        :param handled: True if the message has been handled; False otherwise.
+        :param names: Names of the peers.
+        :param send: Called with each connection.
         """
-        prefix = 'BUILTIN'
-        if not handled and message.startswith(prefix):
-            handled = True
-            args = message.split('-')
-            match args[1]:
-                case 'PEERLIST':
-                    if args[2] == 'REQ':
-                        self.send_message(name, self.create_known_peer_list())
-                    elif args[2] == 'UPD':
-                        peers = args[3].split('>')
-                        try:
-                            for peer in peers:
-                                peer_ = peer.split('@')
-                                self.add_peer(peer_[0], peer_[1], int(peer_[2]))
-                        except Exception as e:
-                            if self._debug:
-                                print(e)
+        def deliver(name):
+            comm = self.get_connection(name)
+            if comm is not None:
+                send(comm)
 
-        if self._debug:
-            if handled:
-                print('[RECEIVED] \"{0}\" FROM {1} '.format(message, name))
-            else:
-                print('[RECEIVED UNKNOWN] \"{0}\" FROM {1} '.format(message, name))
+        if len(names) <= 1:
+            for name in names:
+                deliver(name)
+            return
+        if self.broadcast_pool is None:
+            self.broadcast_pool = ThreadPoolExecutor(max_workers=self.broadcast_workers,
+                                                     thread_name_prefix='Broadcast')
+        for future in [self.broadcast_pool.submit(deliver, name) for name in names]:
+            try:
+                future.result()
+            except Exception as e:
+                print(str(e))
 
-    def open_connection(self, ip: str, port: int):
+    def send_stream(self, name: str, source, stream_name: str = '', channel: int = 1, chunk_size: int = None) -> int:
+        """
+        Streams a file or other large payload to a peer by name, requires channels.
+
+        :param name: Name of peer to stream to.
+        :param source: File path, binary file object, bytes-like object or iterable of bytes-like objects.
+        :param stream_name: Name of the stream, passed to the peers stream handler.
+        :param channel: Channel to stream on, one stream per channel at a time.
+        :param chunk_size: Bytes per chunk, the fragment size of the channels if None.
+        :return: Number of bytes streamed.
+        """
+        comm = self.connections.get(name)
+        if comm is None and self.connections.get_known_peer(name) is not None:
+            comm = self.open_connection(*self.connections.get_known_peer(name))
+        if comm is None:
+            raise Exception('Peer {0} is not connected'.format(name))
+        return comm.send_stream(source, stream_name, channel, chunk_size)
+
+    def open_connection(self, ip: str, port: int) -> CommunicationProtocol:
         """
-        Open connection to the server.
+        Open connection to the server, unless one is already open or being opened by another thread.
 
         :param ip: IP address to open a connection to.
         :param port: Port to open a connection on.
+        :return: The connection, None if it could not be opened.
         """
-        peers = self.connections.copy()
-        already_connected = False
-        for name in peers.keys():
-            if peers[name] == (ip, port):
-                already_connected = True
+        try:
+            return self.connections.get_or_connect((ip, port), lambda: self._connect(ip, port),
+                                                   on_connected=self._connected)
+        except ConnectionRefusedError:
+            if self._debug:
+                print('[FAILED] Unable to connect to \'{0}:{1}\''.format(ip, port))
+            return None
 
-        if not already_connected:
-            try:
-                new_socket = socket.socket()
-                new_socket.connect((ip, port))
-                comm = CommunicationProtocol(new_socket, (ip, port), self.name, _debug=self._debug)
-                comm.establish_encrypted_connection_cs()
-                self.connections[comm.get_peer_name()] = comm
+    def _connect(self, ip: str, port: int) -> CommunicationProtocol:
+        """
+        Opens a socket and establishes an encrypted connection.
 
-                thread = threading.Thread(target=self.connection_listener, args=(comm,))
-                #  thread.daemon = True
-                thread.start()
+        :param ip: IP address to open a connection to.
+        :param port: Port to open a connection on.
+        :return: The established connection.
+        """
+        new_socket = socket.socket()
+        try:
+            new_socket.connect((ip, port))
+            comm = CommunicationProtocol(new_socket, (ip, port), self.name, flush_latency=self.flush_latency,
+                                         flush_bytes=self.flush_bytes, **self.connection_options((ip, port)))
+            comm.establish_encrypted_connection_cs()
+        except BaseException:
+            new_socket.close()
+            raise
+        return comm
 
-                self.add_peer(comm.get_peer_name(), ip, port)
+    def _connected(self, comm: CommunicationProtocol):
+        """
+        Starts receiving on a registered outgoing connection.
 
-            except ConnectionRefusedError as e:
-                if self._debug:
-                    print('[FAILED] Unable to connect to \'{0}:{1}\''.format(ip, port))
+        :param comm: The connection.
+        """
+        thread = threading.Thread(target=self.connection_listener, args=(comm,))
+        #  thread.daemon = True
+        thread.start()
+
+        self.add_peer(comm.get_peer_name(), *comm.get_address())
+        self.connection_opened(comm)
 
     def connection_listener(self, comm: CommunicationProtocol):
         """
         Called when a new connection is made to the client.
+        A message the peer sent that cannot be read, or a handler failing on it, closes the connection.
 
         :param comm: CommunicationProtocol object representing the connection to the client.
         """
-        while comm.is_open() and self.running:
-            messages = comm.receive_message()
-            if messages:
-                for message in messages:
-                    self.message_handler(comm.get_peer_name(), message, False)
-
-        self.connections.pop(comm.get_peer_name())
+        try:
+            while comm.is_open() and self.running:
+                messages = comm.receive_message()
+                if messages:
+                    for message in messages:
+                        self.handle_received(comm.get_peer_name(), message)
+        except Exception as e:
+            print('[ERROR] Connection {0}@{1}:{2} {3}'.format(comm.get_peer_name(), *comm.get_address()[:2], e))
+        finally:
+            comm.close_connection()
+            self.connection_closed(comm)
         sys.exit(0)
 
     def incoming_connection_listener(self):
         """
-        Starts a loop waiting for new incoming connections, opens a new thread to handle each connection.
+        Starts a loop waiting for new incoming connections, hands each one to a handshake thread.
+        A connection is only accepted while a handshake thread is free, so a burst of connections waits in
+        the backlog instead of behind every handshake accepted before it.
         """
         self.incoming_socket = socket.socket()
         self.incoming_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.shard is not None:  # Every shard listens on the port, the kernel spreads connections over them
+            self.incoming_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         not_listening = True
         while not_listening:
             try:
                 self.incoming_socket.bind(('', self.port))
-                self.incoming_socket.listen(10)
+                self.incoming_socket.listen(self.backlog)
                 not_listening = False
                 if self._debug:
                     print('[AVAILABLE] \'{0}:{1}\''.format('', self.port))
@@ -213,24 +931,57 @@ class Client(Peer):
                 sys.exit(interrupt)
 
         while self.running:
-            peer, addr = self.incoming_socket.accept()
+            self.handshake_slots.acquire()
             try:
-                comm = CommunicationProtocol(peer, addr, self.name, file_prefix='{0}-'.format(self.name),
-                                             _debug=self._debug)
-                comm.establish_encrypted_connection_ss()
-                self.connections[comm.get_peer_name()] = comm
-
-                thread = threading.Thread(target=self.connection_listener, args=(comm,))
-                #  thread.daemon = True
-                thread.start()
-            except Exception as e:
-                print(str(e))
+                peer, addr = self.incoming_socket.accept()
+            except OSError as e:
+                self.handshake_slots.release()
+                if self.running:
+                    print(str(e))
+                continue
+            self.handshake_pool.submit(self.accept_connection, peer, addr)
+
+    def accept_connection(self, peer: socket.socket, addr: tuple):
+        """
+        Runs the handshake of an incoming connection on a handshake thread, then starts receiving on it.
+
+        :param peer: Socket of the connection.
+        :param addr: Tuple of (ip, port) of the peer.
+        """
+        handshakes = self.metrics.handshakes if self.metrics is not None else None
+        started = handshakes.begin() if handshakes is not None else 0.0
+        error = None
+        try:
+            comm = CommunicationProtocol(peer, addr, self.name, flush_latency=self.flush_latency,
+                                         flush_bytes=self.flush_bytes, **self.connection_options())
+            comm.establish_encrypted_connection_ss(self.handshake_timeout)
+            self.connections.add(comm)
+            self.connection_opened(comm)
+
+            thread = threading.Thread(target=self.connection_listener, args=(comm,))
+            #  thread.daemon = True
+            thread.start()
+        except Exception as e:
+            error = e
+            peer.close()
+            print(str(e))
+        finally:
+            self.handshake_slots.release()
+            if handshakes is not None:
+                handshakes.end(started, error)
 
     def start(self):
         """
         Starts a thread to listen to all new incoming connections.
         """
         self.running = True
+        self.stopped.clear()
+        self.started.set()
+        self.start_metrics_server()
+        self.start_discovery()
+        self.supervisor.start()
+        if self.shard is not None:
+            self.shard.start(self.deliver_message)
         thread = threading.Thread(target=self.request_known_peers)
         thread.start()
         self.incoming_connection_listener()
@@ -239,12 +990,27 @@ class Client(Peer):
         """
         Stops the peer safely.
         """
-        incoming_connections = self.connections.copy()
-        for name in incoming_connections:
-            self.connections[name].close_connection()
+        self.supervisor.stop()  # Before closing, so the closed connections are not reconnected
+        for comm in self.connections.values():
+            comm.close_connection()
 
         self.running = False
         self.incoming_socket.close()
+        if self.handler_pool is not None:
+            self.handler_pool.close()
+        self.gossip.stop()
+        self.stop_metrics_server()
+        if self.discovery is not None:
+            self.discovery.stop()
+        if self.broadcast_pool is not None:
+            self.broadcast_pool.shutdown(wait=False)
+        self.handshake_pool.shutdown(wait=False)
+        if self.crypto_pool is not None:
+            self.crypto_pool.close()
+        if self.shard is not None:
+            self.shard.stop()
+        self.started.clear()
+        self.stopped.set()
         if self._debug:
             print('Stopped peer.')
 
@@ -254,37 +1020,11 @@ class Client(Peer):
         """
         self.comm.close_connection()
 
-    def add_peer(self, peer_name: str, ip: str, port: int):
-        known_peers = self.known_peers.copy()
-        if peer_name in known_peers.keys():
-            if self.known_peers[peer_name] == (ip, port):
-                if self._debug:
-                    print('[ADD_PEER] PEER [{0}@{1}:{2}] KNOWN'.format(peer_name, ip, port))
-            else:
-                self.known_peers[peer_name] = (ip, port)
-                if self._debug:
-                    print('[ADD_PEER] PEER [{0}@{1}:{2}] UPDATED'.format(peer_name, ip, port))
-        else:
-            self.known_peers[peer_name] = (ip, port)
-            if self._debug:
-                print('[ADD_PEER] PEER [{0}@{1}:{2}] ADDED'.format(peer_name, ip, port))
-
     def request_known_peers(self):
-        while not self.running:
-            pass
-
-        peers = self.known_peers.copy()
-        for peer in peers.keys():
-            self.send_message(peer, 'BUILTIN-PEERLIST-REQ')
-
-    def create_known_peer_list(self) -> str:
-        known_peers = self.known_peers.copy()
-        peer_str = 'BUILTIN-PEERLIST-UPD-'
-        for peer_name in known_peers.keys():
-            peer_str += '{0}@{1}@{2}>'.format(peer_name, *known_peers[peer_name])
-        peer_str = peer_str[:len(peer_str) - 1]
-        return peer_str
-
-
-
+        if self.gossip_interval > 0:
+            self.gossip.run_round()
+            self.gossip.start()
+            return
 
+        for peer in self.connections.known_peers():
+            self.send_message(peer, PEERLIST_REQ())
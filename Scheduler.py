@@ -0,0 +1,223 @@
+import heapq
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Callable
+
+
+class Scheduler(object):
+
+    def __init__(self, on_expire: Callable[[int, object], None], path: str = None, coalesce: float = 0.001,
+                 save_interval: float = 1.0, _debug: bool = False):
+        """
+        Initialise Scheduler, runs any number of timers on a single thread.
+        Timers are kept in a heap ordered by due time, scheduling is O(log n) and cancelling O(1), cancelled
+        entries stay in the heap until they reach the top or outnumber the live ones, then it is rebuilt.
+        The thread sleeps until the earliest timer is due and fires every timer due within coalesce of it
+        on the same wake up.
+
+        :param on_expire: Called on the scheduler thread with (timer_id, data) when a timer is due.
+        :param path: JSON file persistent timers are saved to and loaded from, None keeps them in memory.
+                     Timers that came due while stopped fire as soon as the scheduler starts.
+        :param coalesce: Seconds a timer may fire early to share a wake up with an earlier one.
+        :param save_interval: Seconds changes to persistent timers may wait before they are saved.
+        :param _debug: If True prints debug information to the console; otherwise no debug information is printed.
+        """
+        self.on_expire = on_expire
+        self.path = path
+        self.coalesce = coalesce
+        self.save_interval = save_interval
+        self._debug = _debug
+
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)  # Notified when a timer becomes the earliest, or on stop
+        self.heap = []  # (due, timer_id), including cancelled timers
+        self.timers = {}  # timer_id: (due, data, persistent), live timers only
+        self.stale = 0  # Cancelled entries still in the heap
+        self.next_id = 1
+        self.running = False
+        self.thread: threading.Thread = None
+        self.dirty = False  # Persistent timers changed since the last save
+        self.saved = 0.0
+
+        self.fired = 0
+        self.wakeups = 0
+        if path is not None:
+            self.load()
+
+    def schedule(self, delay: float, data=None, persistent: bool = True) -> int:
+        """
+        Schedules a timer.
+
+        :param delay: Seconds until the timer is due.
+        :param data: Passed to on_expire, must be JSON serialisable if the timer is persistent.
+        :param persistent: If True the timer is saved and survives restarts.
+        :return: Id of the timer.
+        """
+        with self.lock:
+            timer_id = self.next_id
+            self.next_id += 1
+            self._push(timer_id, time.monotonic() + delay, data, persistent)
+            return timer_id
+
+    def _push(self, timer_id: int, due: float, data, persistent: bool):
+        self.timers[timer_id] = (due, data, persistent)
+        heapq.heappush(self.heap, (due, timer_id))
+        self.dirty |= persistent and self.path is not None
+        if self.heap[0][1] == timer_id:  # Earlier than the thread is sleeping for
+            self.changed.notify()
+
+    def cancel(self, timer_id: int) -> bool:
+        """
+        Cancels a timer.
+
+        :param timer_id: Id returned by schedule.
+        :return: True if the timer was pending; False if it already fired or does not exist.
+        """
+        with self.lock:
+            timer = self.timers.pop(timer_id, None)
+            if timer is None:
+                return False
+            self.stale += 1
+            self.dirty |= timer[2] and self.path is not None
+            if self.stale > 1024 and self.stale > len(self.timers):
+                self.heap = [(due, timer_id) for timer_id, (due, _, _) in self.timers.items()]
+                heapq.heapify(self.heap)
+                self.stale = 0
+            return True
+
+    def remaining(self, timer_id: int) -> float:
+        """
+        Gets the seconds until a timer is due.
+
+        :param timer_id: Id returned by schedule.
+        :return: Seconds, None if the timer is not pending.
+        """
+        with self.lock:
+            timer = self.timers.get(timer_id)
+        return None if timer is None else timer[0] - time.monotonic()
+
+    def __len__(self):
+        return len(self.timers)
+
+    def start(self):
+        """
+        Starts the scheduler thread.
+        """
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self.run, name='Scheduler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            with self.lock:
+                expired = self._wait()
+            if expired is None:
+                return
+            for timer_id, data in expired:
+                try:
+                    self.on_expire(timer_id, data)
+                except Exception as e:
+                    print(str(e))
+            if self.dirty and time.monotonic() - self.saved >= self.save_interval:
+                self.save()
+
+    def _wait(self) -> list:
+        """
+        Sleeps until timers are due or a save is, must hold the lock.
+
+        :return: List of (timer_id, data) of the due timers, removed from the scheduler, None once stopped.
+        """
+        while self.running:
+            now = time.monotonic()
+            expired = []
+            while self.heap and self.heap[0][0] <= now + self.coalesce:
+                due, timer_id = heapq.heappop(self.heap)
+                timer = self.timers.get(timer_id)
+                if timer is None or timer[0] != due:  # Cancelled
+                    self.stale -= 1
+                    continue
+                del self.timers[timer_id]
+                self.dirty |= timer[2] and self.path is not None
+                expired.append((timer_id, timer[1]))
+            if expired:
+                self.fired += len(expired)
+                self.wakeups += 1
+                return expired
+
+            timeout = self.heap[0][0] - now if self.heap else None
+            if self.dirty:
+                save_in = max(0.0, self.saved + self.save_interval - now)
+                if save_in == 0.0:
+                    return []
+                timeout = save_in if timeout is None else min(timeout, save_in)
+            self.changed.wait(timeout)
+        return None
+
+    def stop(self):
+        """
+        Stops the scheduler thread and saves the pending persistent timers.
+        """
+        with self.lock:
+            self.running = False
+            self.changed.notify()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        if self.dirty:
+            self.save()
+
+    def save(self):
+        """
+        Writes the pending persistent timers, with their due time as wall clock time, atomically to path.
+        """
+        if self.path is None:
+            return
+        with self.lock:
+            offset = time.time() - time.monotonic()
+            timers = [[timer_id, due + offset, data] for timer_id, (due, data, persistent) in self.timers.items()
+                      if persistent]
+            data = {'next_id': self.next_id, 'timers': timers}
+            self.dirty = False
+            self.saved = time.monotonic()
+        directory = os.path.dirname(os.path.abspath(self.path))
+        descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(descriptor, 'w') as file:
+                json.dump(data, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def load(self):
+        """
+        Schedules the persistent timers saved to path.
+        """
+        try:
+            with open(self.path) as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return
+        offset = time.monotonic() - time.time()
+        with self.lock:
+            self.next_id = max(self.next_id, data.get('next_id', 1))
+            for timer_id, due, timer_data in data.get('timers', ()):
+                self._push(timer_id, due + offset, timer_data, True)
+        if self._debug:
+            print('[SCHEDULER] Loaded {0} timers from {1}'.format(len(self.timers), self.path))
+
+    def stats(self) -> dict:
+        """
+        Gets scheduler counters.
+
+        :return: Dictionary of pending, fired, wakeups and stale.
+        """
+        return {'pending': len(self.timers), 'fired': self.fired, 'wakeups': self.wakeups, 'stale': self.stale}
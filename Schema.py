@@ -0,0 +1,317 @@
+import base64
+import collections
+import functools
+import itertools
+import struct
+
+ENVELOPE = b'\x00'  # First byte of a binary message, text messages never start with it as it ends them in eom framing
+
+_u16 = struct.Struct('!H')
+_u32 = struct.Struct('!I')
+
+
+def _escape(text: str) -> str:
+    return text.replace('%', '%25').replace('-', '%2D').replace('@', '%40').replace('>', '%3E')
+
+
+def _unescape(text: str) -> str:
+    if '%' not in text:
+        return text
+    return text.replace('%2D', '-').replace('%40', '@').replace('%3E', '>').replace('%25', '%')
+
+
+@functools.lru_cache(maxsize=1024)
+def _column(count: int, code: str) -> struct.Struct:
+    return struct.Struct('!{0}{1}'.format(count, code))
+
+
+class Field(object):
+    fixed = {'int': 'q', 'u16': 'H', 'u32': 'I', 'float': 'd'}  # type: struct format
+    texts = {'int': (str, int), 'u16': (str, int), 'u32': (str, int), 'float': (repr, float), 'str': (str, str),
+             'bytes': (lambda value: base64.b64encode(value).decode(), base64.b64decode)}  # type: (to, from text)
+
+    def __init__(self, name: str, type_):
+        """
+        Initialise Field, one typed value of a command.
+        Fixed size values are packed in the header of the command, other fields put their length there and
+        their data after the header. Lists of records are packed column by column, one struct call per column,
+        so decoding a list does not cost a function call per value.
+
+        :param name: Name of the field, the attribute of the parsed message.
+        :param type_: 'int', 'u16', 'u32', 'float', 'str', 'bytes', or a tuple of (name, type) for a list of
+                      records, records are tuples and their fields may not be lists.
+        """
+        self.name = name
+        if isinstance(type_, str):
+            if type_ not in self.texts:
+                raise Exception('Unknown field type {0}'.format(type_))
+            self.type = type_
+            to_text, from_text = self.texts[type_]
+            self.to_text = lambda value: _escape(to_text(value))  # Separators in values are percent-escaped
+            self.from_text = _unescape if type_ == 'str' else lambda text: from_text(_unescape(text))
+        else:
+            self.type = 'list'
+            self.record = [Field(*field) for field in type_]
+            if any(field.type == 'list' for field in self.record):
+                raise Exception('Records may not contain lists.')
+            self.to_text, self.from_text = self._list_to_text, self._list_from_text
+        self.slot = self.fixed.get(self.type, 'I')  # Header format, the value itself or the length of its data
+
+    def pack(self, value, data: list) -> int:
+        """
+        Packs a variable size value.
+
+        :param value: The value.
+        :param data: List of buffers following the header, the packed value is appended.
+        :return: The length stored in the header, bytes for 'str' and 'bytes', records for lists.
+        """
+        if self.type == 'str':
+            value = value.encode('utf-8')
+        elif self.type == 'list':
+            if value:
+                for field, column in zip(self.record, zip(*value)):
+                    field.pack_column(column, data)
+            return len(value)
+        data.append(value)
+        return len(value)
+
+    def unpack(self, view, offset: int, size: int) -> tuple:
+        """
+        Unpacks a variable size value.
+
+        :param view: Bytes-like message.
+        :param offset: Offset of the data of the value.
+        :param size: Length stored in the header.
+        :return: Tuple of (value, offset after its data).
+        """
+        if self.type == 'str':
+            return str(view[offset:offset + size], 'utf-8'), offset + size
+        if self.type == 'bytes':
+            return bytes(view[offset:offset + size]), offset + size
+        if not size:
+            return [], offset
+        columns = []
+        for field in self.record:
+            column, offset = field.unpack_column(view, offset, size)
+            columns.append(column)
+        return list(zip(*columns)), offset
+
+    def pack_column(self, values: tuple, data: list):
+        if self.type in self.fixed:
+            data.append(_column(len(values), self.fixed[self.type]).pack(*values))
+            return
+        if self.type == 'str':
+            joined = '\x00'.join(values)
+            if joined.count('\x00') == len(values) - 1:  # Split in a single call when no value contains the separator
+                joined = joined.encode('utf-8')
+                data.append(b'S' + _u32.pack(len(joined)))
+                data.append(joined)
+                return
+            values = [value.encode('utf-8') for value in values]
+        sizes = [len(value) for value in values]
+        code = 'H' if max(sizes) < 65536 else 'I'
+        data.append(code.encode() + _column(len(sizes), code).pack(*sizes))
+        data.extend(values)
+
+    def unpack_column(self, view, offset: int, count: int) -> tuple:
+        if self.type in self.fixed:
+            column = _column(count, self.fixed[self.type])
+            return column.unpack_from(view, offset), offset + column.size
+        code = chr(view[offset])
+        if code == 'S':
+            size, = _u32.unpack_from(view, offset + 1)
+            offset += 5
+            column = str(view[offset:offset + size], 'utf-8').split('\x00')
+            if len(column) != count:
+                raise ValueError('Invalid Message.')
+            return column, offset + size
+        if code not in ('H', 'I'):
+            raise ValueError('Invalid Message.')
+        sizes = _column(count, code)
+        ends = list(itertools.accumulate(sizes.unpack_from(view, offset + 1)))
+        offset += 1 + sizes.size
+        data = bytes(view[offset:offset + ends[-1]])
+        column = [data[start:end] for start, end in zip([0] + ends[:-1], ends)]
+        if self.type == 'str':
+            column = [value.decode('utf-8') for value in column]
+        return column, offset + ends[-1]
+
+    def _list_to_text(self, records) -> str:
+        if not records:
+            return ''
+        columns = [map(field.to_text, column) for field, column in zip(self.record, zip(*records))]
+        return '>'.join(map('@'.join, zip(*columns)))
+
+    def _list_from_text(self, text: str) -> list:
+        rows = [record.split('@') for record in text.split('>') if record]
+        if not rows:
+            return []
+        if any(len(row) != len(self.record) for row in rows):
+            raise ValueError('Record does not match {0}'.format(self.name))
+        columns = [map(field.from_text, column) for field, column in zip(self.record, zip(*rows))]
+        return list(zip(*columns))
+
+
+class Command(object):
+
+    def __init__(self, command_id: int, text: str, fields: tuple = ()):
+        """
+        Initialise Command, a message type with a numeric id and typed fields.
+        The binary form is ENVELOPE, the id, a header packed by a single struct holding every fixed size value
+        and the length of every other value, then the data of the other values in field order.
+        Parsed messages are namedtuples with one attribute per field, str() of a message is its text form,
+        the text followed by every field, separated by '-', so it stays readable by peers without the schema.
+        A '-', '@', '>' or '%' within a value is percent-escaped, so it cannot be mistaken for a separator.
+
+        :param command_id: Id sent in the binary envelope, unique within the schema.
+        :param text: Text form, e.g. 'TIME-TIMER'.
+        :param fields: Tuple of (name, type) pairs, see Field.
+        """
+        self.id = command_id
+        self.text = text
+        self.prefix = text.partition('-')[0]
+        self.fields = [Field(*field) for field in fields]
+        self.format = struct.Struct('!H' + ''.join(field.slot for field in self.fields))
+        self.variable = [(index + 1, field) for index, field in enumerate(self.fields) if field.type not in Field.fixed]
+
+        command = self
+        base = collections.namedtuple(text.title().replace('-', ''), [field.name for field in self.fields])
+
+        class Message(base):
+            __slots__ = ()
+
+            def __str__(self) -> str:
+                return command.to_text(self)
+
+        Message.command = self
+        self.message = Message
+
+    def __call__(self, *values, **fields):
+        """
+        Creates a message of this command.
+
+        :return: The message.
+        """
+        return self.message(*values, **fields)
+
+    def to_text(self, message) -> str:
+        if not self.fields:
+            return self.text
+        return self.text + '-' + '-'.join(field.to_text(value) for field, value in zip(self.fields, message))
+
+    def from_text(self, text: str):
+        """
+        Parses the fields of a text message, the last field keeps any unescaped '-' it contains.
+
+        :param text: Text after the command and its separator.
+        :return: The message, None if the fields do not parse.
+        """
+        if not self.fields:
+            return None if text else self.message()
+        values = text.split('-', len(self.fields) - 1)
+        if len(values) != len(self.fields):
+            return None
+        try:
+            values = [field.from_text(value) for field, value in zip(self.fields, values)]
+        except ValueError:
+            return None
+        return self.message._make(values)
+
+    def encode(self, message) -> bytearray:
+        if not self.variable:
+            return ENVELOPE + self.format.pack(self.id, *message)
+        header = [self.id]
+        header.extend(message)
+        data = []
+        for index, field in self.variable:
+            header[index] = field.pack(header[index], data)
+        return ENVELOPE + self.format.pack(*header) + b''.join(data)
+
+    def decode(self, view):
+        """
+        Decodes a message of this command.
+
+        :param view: Bytes-like message, starting with ENVELOPE.
+        :return: The message.
+        """
+        values = list(self.format.unpack_from(view, 1))
+        offset = 1 + self.format.size
+        for index, field in self.variable:
+            values[index], offset = field.unpack(view, offset, values[index])
+        if offset > len(view):  # Slices past the end are only short, not an error
+            raise ValueError('Truncated {0}'.format(self.text))
+        return self.message._make(values[1:])
+
+
+class Schema(object):
+
+    def __init__(self):
+        """
+        Initialise Schema, the registry of commands shared by every peer in this process.
+        """
+        self.by_id = {}  # command id: Command
+        self.by_text = {}  # text form: Command
+        self.prefixes = set()  # First part of the text form of every command, rejects other messages early
+        self.depth = 1  # Most '-' separated parts in the text form of a command
+
+    def register(self, command_id: int, text: str, *fields) -> Command:
+        """
+        Registers a command.
+
+        :param command_id: Id sent in the binary envelope, 1 to 65535.
+        :param text: Text form, e.g. 'TIME-TIMER'.
+        :param fields: (name, type) pairs, see Field.
+        :return: The command, call it with the field values to create a message.
+        """
+        if command_id in self.by_id or text in self.by_text:
+            raise Exception('Command {0} {1} is already registered.'.format(command_id, text))
+        command = Command(command_id, text, fields)
+        self.by_id[command_id] = command
+        self.by_text[text] = command
+        self.prefixes.add(command.prefix)
+        self.depth = max(self.depth, text.count('-') + 1)
+        return command
+
+    def encode(self, message) -> bytes:
+        """
+        Encodes a message in the binary envelope.
+
+        :param message: Message created by a registered command.
+        :return: ENVELOPE, the command id and the packed fields.
+        """
+        return message.command.encode(message)
+
+    def decode(self, payload):
+        """
+        Decodes a message in the binary envelope.
+
+        :param payload: Bytes starting with ENVELOPE.
+        :return: The message, None if its command is not registered here or the message is truncated or malformed.
+        """
+        try:
+            command = self.by_id.get(_u16.unpack_from(payload, 1)[0])
+            if command is None:
+                return None
+            return command.decode(payload)
+        except (struct.error, IndexError, ValueError):  # UnicodeDecodeError is a ValueError
+            return None
+
+    def parse_text(self, text: str):
+        """
+        Parses a text message of a registered command, the one place text commands are split.
+
+        :param text: Text message.
+        :return: The message, None if it is not a registered command or its fields do not parse.
+        """
+        parts = text.split('-', self.depth)
+        if parts[0] not in self.prefixes:
+            return None
+        for depth in range(min(self.depth, len(parts)), 0, -1):
+            command = self.by_text.get('-'.join(parts[:depth]))
+            if command is not None:
+                rest = len(command.text) + 1
+                return command.from_text(text[rest:])
+        return None
+
+
+SCHEMA = Schema()
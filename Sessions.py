@@ -0,0 +1,111 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class Session(object):
+
+    def __init__(self, peer_name: str, secret: bytes, ticket: str, expires: float):
+        """
+        Initialise Session, the resumption state kept for one peer after a successful handshake.
+
+        :param peer_name: Name of the peer the session was established with.
+        :param secret: Resumption secret both peers derived from the handshake.
+        :param ticket: Public identifier of the secret, sent by the client to resume.
+        :param expires: time.monotonic() after which the session may no longer be resumed.
+        """
+        self.peer_name = peer_name
+        self.secret = secret
+        self.ticket = ticket
+        self.expires = expires
+
+
+class SessionCache(object):
+
+    def __init__(self, ttl: float = 3600, max_sessions: int = 1024):
+        """
+        Initialise SessionCache, a thread-safe LRU cache of resumable sessions keyed by peer name.
+
+        :param ttl: Seconds a session can be resumed for after it was stored.
+        :param max_sessions: Maximum number of sessions kept, the least recently used is evicted first.
+        """
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()  # peer_name: Session
+        self.tickets = {}  # ticket: peer_name
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def derive_ticket(secret: bytes) -> str:
+        """
+        Derives the public ticket for a resumption secret.
+
+        :param secret: Resumption secret.
+        :return: Ticket identifying the secret.
+        """
+        return hashlib.sha256(b'SAGA-TICKET' + secret).hexdigest()[:32]
+
+    def store(self, peer_name: str, secret: bytes):
+        """
+        Stores a resumption secret for a peer, replacing any previous session with that peer.
+
+        :param peer_name: Name of the peer.
+        :param secret: Resumption secret both peers derived from the handshake.
+        """
+        session = Session(peer_name, secret, self.derive_ticket(secret), time.monotonic() + self.ttl)
+        with self.lock:
+            self._remove(peer_name)
+            self.sessions[peer_name] = session
+            self.tickets[session.ticket] = peer_name
+            while len(self.sessions) > self.max_sessions:
+                self._remove(next(iter(self.sessions)))
+
+    def get(self, peer_name: str) -> Session:
+        """
+        Gets the session with a peer, marking it as recently used.
+
+        :param peer_name: Name of the peer.
+        :return: The session, None if there is no unexpired session with the peer.
+        """
+        with self.lock:
+            session = self.sessions.get(peer_name)
+            if session is None:
+                return None
+            if session.expires < time.monotonic():
+                self._remove(peer_name)
+                return None
+            self.sessions.move_to_end(peer_name)
+            return session
+
+    def pop_ticket(self, ticket: str) -> Session:
+        """
+        Removes and returns the session identified by a ticket, tickets can only be resumed once.
+
+        :param ticket: Ticket sent by the client.
+        :return: The session, None if the ticket is unknown or expired.
+        """
+        with self.lock:
+            peer_name = self.tickets.get(ticket)
+            if peer_name is None:
+                return None
+            session = self.sessions[peer_name]
+            self._remove(peer_name)
+            return session if session.expires >= time.monotonic() else None
+
+    def remove(self, peer_name: str):
+        """
+        Forgets the session with a peer.
+
+        :param peer_name: Name of the peer.
+        """
+        with self.lock:
+            self._remove(peer_name)
+
+    def _remove(self, peer_name: str):
+        session = self.sessions.pop(peer_name, None)
+        if session is not None:
+            self.tickets.pop(session.ticket, None)
+
+    def __len__(self):
+        return len(self.sessions)
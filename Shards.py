@@ -0,0 +1,241 @@
+import hashlib
+import mmap
+import multiprocessing
+import os
+import signal
+import struct
+import threading
+from typing import Callable
+from KeyExchange import backends
+from KeyStore import KeyStore
+from Schema import SCHEMA
+
+
+class RoutingTable(object):
+    entry = struct.Struct('=Qi')  # hash of the peer name, 0 if the slot is free; shard, -1 once released
+
+    def __init__(self, slots: int = 65536, lock=None):
+        """
+        Initialise RoutingTable, which shard owns the connection to each peer, shared by forked processes.
+        It is an open addressing hash table in an anonymous shared mapping, the mapping and the lock
+        are inherited by every process forked afterwards. Names are stored as 64 bit hashes.
+
+        :param slots: Maximum number of peers routed, released peers keep their slot.
+        :param lock: multiprocessing lock guarding the table, a new one if None.
+        """
+        self.slots = slots
+        self.memory = mmap.mmap(-1, slots * self.entry.size)
+        self.lock = lock if lock is not None else multiprocessing.Lock()
+
+    @staticmethod
+    def hash(name: str) -> int:
+        return int.from_bytes(hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest(), 'big') or 1
+
+    def _find(self, key: int) -> int:
+        """
+        Finds the slot of a hash, must hold the lock.
+
+        :param key: Hash of the name.
+        :return: Offset of its slot or of the free slot it would take, None if the table is full.
+        """
+        index = key % self.slots
+        for _ in range(self.slots):
+            offset = index * self.entry.size
+            stored = self.entry.unpack_from(self.memory, offset)[0]
+            if stored == key or stored == 0:
+                return offset
+            index = (index + 1) % self.slots
+        return None
+
+    def get(self, name: str) -> int:
+        """
+        Gets the shard owning the connection to a peer.
+
+        :param name: Name of the peer.
+        :return: Index of the shard, None if no shard is connected to the peer.
+        """
+        key = self.hash(name)
+        with self.lock:
+            offset = self._find(key)
+            if offset is None:
+                return None
+            stored, shard = self.entry.unpack_from(self.memory, offset)
+        return shard if stored == key and shard >= 0 else None
+
+    def set(self, name: str, shard: int):
+        key = self.hash(name)
+        with self.lock:
+            offset = self._find(key)
+            if offset is None:
+                raise Exception('Routing table is full.')
+            self.entry.pack_into(self.memory, offset, key, shard)
+
+    def release(self, name: str, shard: int) -> bool:
+        """
+        Removes the route to a peer, unless another shard took it over meanwhile.
+
+        :param name: Name of the peer.
+        :param shard: Index of the shard releasing it.
+        :return: True if the route was removed; False otherwise.
+        """
+        key = self.hash(name)
+        with self.lock:
+            offset = self._find(key)
+            if offset is None or self.entry.unpack_from(self.memory, offset) != (key, shard):
+                return False
+            self.entry.pack_into(self.memory, offset, key, -1)
+            return True
+
+
+class Shard(object):
+
+    def __init__(self, index: int, table: RoutingTable, inboxes: list, identity: dict, _debug: bool = False):
+        """
+        Initialise Shard, one worker process of a ShardedServer.
+        Peers connected to another shard are sent to by forwarding the message to its inbox.
+
+        :param index: Index of this shard.
+        :param table: RoutingTable shared by every shard.
+        :param inboxes: multiprocessing queue of every shard, by index.
+        :param identity: curve: (private_key, public_key), the identity every shard presents.
+        :param _debug: If True prints debug information to the console; otherwise no debug information is printed.
+        """
+        self.index = index
+        self.table = table
+        self.inboxes = inboxes
+        self.identity = identity
+        self._debug = _debug
+        self.thread: threading.Thread = None
+        self.forwarded = 0
+        self.delivered = 0
+
+    def claim(self, name: str):
+        self.table.set(name, self.index)
+
+    def release(self, name: str):
+        self.table.release(name, self.index)
+
+    def forward(self, name: str, msg, channel: int = 0) -> bool:
+        """
+        Forwards a message to the shard connected to a peer.
+
+        :param name: Name of the peer.
+        :param msg: Text, or a message created by a command of the schema.
+        :param channel: Channel to send on.
+        :return: True if another shard is connected to the peer and was handed the message; False otherwise.
+        """
+        owner = self.table.get(name)
+        if owner is None or owner == self.index:
+            return False
+        payload = msg if isinstance(msg, str) else bytes(SCHEMA.encode(msg))
+        self.inboxes[owner].put((name, payload, channel))
+        self.forwarded += 1
+        return True
+
+    def start(self, deliver: Callable[[str, object, int], None]):
+        """
+        Starts the thread delivering messages forwarded by other shards.
+
+        :param deliver: Called with (name, msg, channel), sends the message without forwarding it again.
+        """
+        self.thread = threading.Thread(target=self.run, args=(deliver,), name='Shard')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, deliver: Callable[[str, object, int], None]):
+        inbox = self.inboxes[self.index]
+        while True:
+            item = inbox.get()
+            if item is None:
+                return
+            name, payload, channel = item
+            msg = payload if isinstance(payload, str) else SCHEMA.decode(payload)
+            if msg is None:
+                continue
+            self.delivered += 1
+            try:
+                deliver(name, msg, channel)
+            except Exception as e:
+                print(str(e))
+
+    def stop(self):
+        if self.thread is not None:
+            self.inboxes[self.index].put(None)
+            self.thread.join(1.0)  # The worker exits next, closing the inbox under a blocked get
+
+    def stats(self) -> dict:
+        """
+        Gets shard counters.
+
+        :return: Dictionary of index, forwarded and delivered.
+        """
+        return {'index': self.index, 'forwarded': self.forwarded, 'delivered': self.delivered}
+
+
+class ShardedServer(object):
+
+    def __init__(self, build: Callable[[Shard], object], workers: int, name: str, key_directory: str = None,
+                 slots: int = 65536, _debug: bool = False):
+        """
+        Initialise ShardedServer, runs one peer as several forked worker processes sharing its port.
+        Workers listen with SO_REUSEPORT, so the kernel spreads incoming connections over them, and each one owns
+        the connections it accepted or opened. Sending to a peer connected to another worker forwards the message
+        to that worker. Every worker presents the same identity key, loaded or generated before forking.
+
+        :param build: Called with the Shard of the worker in the worker process, returns the peer, or a
+                      ClientBuilder, to start there, created with shard=shard so it never loads an identity of its own.
+        :param workers: Number of worker processes.
+        :param name: Name of the peer, the identity key is stored under it.
+        :param key_directory: Directory the identity key is saved in, None keeps it in memory.
+        :param slots: Maximum number of peers routed.
+        :param _debug: If True prints debug information to the console; otherwise no debug information is printed.
+        """
+        self.build = build
+        self.workers = workers
+        self.name = name
+        self.key_directory = key_directory
+        self.slots = slots
+        self._debug = _debug
+        self.processes = []
+
+    def start(self):
+        """
+        Forks the workers and waits for them to exit.
+        """
+        context = multiprocessing.get_context('fork')  # Workers inherit the table and the identity
+        keystore = KeyStore(self.key_directory)
+        identity = {curve: keystore.load_local_keys('{0}-'.format(self.name), backend)
+                    for curve, backend in backends.items()}
+        table = RoutingTable(self.slots, context.Lock())
+        inboxes = [context.Queue() for _ in range(self.workers)]
+        self.processes = [context.Process(target=self.run, args=(Shard(index, table, inboxes, identity, self._debug),),
+                                          name='Shard-{0}'.format(index)) for index in range(self.workers)]
+        for process in self.processes:
+            process.start()
+        if self._debug:
+            print('[SHARDS] Started {0} workers'.format(self.workers))
+        for process in self.processes:
+            process.join()
+
+    def run(self, shard: Shard):
+        peer = self.build(shard)
+        try:
+            peer.start()
+        except KeyboardInterrupt:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C reaches the workers and stop interrupts them again
+            peer.stop()
+
+    def stop(self, timeout: float = 5.0):
+        """
+        Interrupts the workers so they stop their peers, terminates those still running after the timeout.
+
+        :param timeout: Seconds to wait for the workers to stop.
+        """
+        for process in self.processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGINT)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+                process.join()
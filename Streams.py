@@ -0,0 +1,115 @@
+import mmap
+import os
+import queue
+
+
+def iter_chunks(source, chunk_size: int = 16384):
+    """
+    Reads a stream source in chunks without loading it whole.
+    Files are memory mapped and handed out as memoryview slices of the mapping, bytes-like sources as
+    memoryview slices of themselves, so no chunk is copied before it is encrypted.
+
+    :param source: File path, binary file object, bytes-like object or iterable of bytes-like objects.
+    :param chunk_size: Largest chunk in bytes.
+    :return: Generator of bytes-like chunks.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            if size == 0:
+                return
+            mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                view = memoryview(mapping)
+                for start in range(0, size, chunk_size):
+                    yield view[start:start + chunk_size]
+                view.release()
+            finally:
+                try:
+                    mapping.close()
+                except BufferError:
+                    pass  # A chunk is still referenced, the mapping is closed once it is collected
+
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source).cast('B')
+        for start in range(0, len(view), chunk_size):
+            yield view[start:start + chunk_size]
+
+    elif hasattr(source, 'read'):
+        for chunk in iter(lambda: source.read(chunk_size), b''):
+            yield chunk
+
+    else:
+        for item in source:
+            view = memoryview(item).cast('B')
+            for start in range(0, len(view), chunk_size):
+                yield view[start:start + chunk_size]
+
+
+class FileSink(object):
+
+    def __init__(self, path: str):
+        """
+        Initialise FileSink, writes a received stream to a file.
+        Data is written to path + '.part' and moved to path once the stream is complete,
+        an aborted stream leaves no file behind.
+
+        :param path: Path of the file to write.
+        """
+        self.path = path
+        self.partial = path + '.part'
+        self.file = open(self.partial, 'wb')
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def close(self):
+        self.file.close()
+        os.replace(self.partial, self.path)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.partial)
+
+
+class StreamReader(object):
+
+    def __init__(self, max_chunks: int = 64):
+        """
+        Initialise StreamReader, hands a received stream to another thread as an iterator of chunks.
+        At most max_chunks wait to be read, after that the receive loop blocks so TCP pushes back on the sender.
+        Must not be read from the thread receiving the stream, on asyncio peers not from the event loop.
+
+        :param max_chunks: Chunks buffered before the receiver blocks.
+        """
+        self.chunks = queue.Queue(max_chunks)
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.put(data)
+        self.size += len(data)
+
+    def close(self):
+        self.chunks.put(None)
+
+    def abort(self):
+        self.chunks.put(Exception('Stream aborted by peer.'))
+
+    def __iter__(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    def read(self) -> bytes:
+        """
+        Reads the rest of the stream into memory.
+
+        :return: Bytes of the stream.
+        """
+        return b''.join(self)
@@ -0,0 +1,147 @@
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from Scheduler import Scheduler
+
+
+class ConnectionSupervisor(object):
+
+    def __init__(self, connect: Callable[[str, tuple], bool], is_connected: Callable[[str], bool],
+                 workers: int = 4, base: float = 0.5, cap: float = 60.0, _debug: bool = False):
+        """
+        Initialise ConnectionSupervisor, keeps connections to watched peers open.
+        Nothing polls: a retry is a timer on a Scheduler, armed when a connection closes or an attempt fails,
+        and attempts run on a small thread pool so slow peers do not hold up the others.
+        Retries back off exponentially with jitter, half the delay is fixed and half random, so peers that
+        lost a connection together do not all come back at once.
+
+        :param connect: Called with (name, (ip, port)) on a pool thread, returns True if the connection opened.
+        :param is_connected: Called with a name, returns True if the peer is connected.
+        :param workers: Connection attempts running at the same time.
+        :param base: Seconds before the first retry.
+        :param cap: Largest number of seconds between retries.
+        :param _debug: If True prints debug information to the console; otherwise no debug information is printed.
+        """
+        self.connect = connect
+        self.is_connected = is_connected
+        self.base = base
+        self.cap = cap
+        self._debug = _debug
+
+        self.lock = threading.Lock()
+        self.watched = {}  # name: (ip, port)
+        self.failures = {}  # name: failed attempts since the last connection
+        self.pending = {}  # name: timer id of its next attempt, or None while it runs
+        self.workers = workers
+        self.scheduler = Scheduler(self._due, coalesce=0.01)
+        self.pool: ThreadPoolExecutor = None  # Created by start, threads are only spawned by attempts
+        self.running = False
+
+        self.attempts = 0
+        self.reconnects = 0
+
+    def watch(self, name: str, address: tuple):
+        """
+        Keeps a connection to a peer open, connecting now if it is not connected.
+
+        :param name: Name of the peer.
+        :param address: Tuple of (ip, port) of the peer.
+        """
+        with self.lock:
+            self.watched[name] = address
+            self.failures.setdefault(name, 0)
+        self._arm(name, 0.0)
+
+    def unwatch(self, name: str):
+        with self.lock:
+            self.watched.pop(name, None)
+            self.failures.pop(name, None)
+            timer_id = self.pending.pop(name, None)
+        if timer_id is not None:
+            self.scheduler.cancel(timer_id)
+
+    def closed(self, name: str):
+        """
+        Called when the connection to a peer closed, retries it after the backoff if the peer is watched.
+
+        :param name: Name of the peer.
+        """
+        self._arm(name, self.delay(name))
+
+    def delay(self, name: str) -> float:
+        """
+        Gets the backoff before the next attempt to connect to a peer.
+
+        :param name: Name of the peer.
+        :return: Seconds, between half and all of min(cap, base * 2 ** failures).
+        """
+        delay = min(self.cap, self.base * 2 ** min(self.failures.get(name, 0), 32))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _arm(self, name: str, delay: float):
+        with self.lock:
+            if not self.running or name not in self.watched or name in self.pending:
+                return  # Not supervised, or an attempt is already armed or running
+            self.pending[name] = self.scheduler.schedule(delay, name, persistent=False)
+
+    def _due(self, timer_id: int, name: str):
+        with self.lock:
+            if not self.running or self.pending.get(name) != timer_id:
+                return
+            self.pending[name] = None
+            self.pool.submit(self._attempt, name)
+
+    def _attempt(self, name: str):
+        with self.lock:
+            address = self.watched.get(name)
+        connected = address is None or self.is_connected(name)
+        if not connected:
+            self.attempts += 1
+            try:
+                connected = self.connect(name, address)
+            except Exception as e:
+                if self._debug:
+                    print('[SUPERVISOR] {0}@{1}:{2} {3}'.format(name, address[0], address[1], e))
+            if connected:
+                self.reconnects += 1
+        with self.lock:
+            self.pending.pop(name, None)
+            if name not in self.failures:
+                return
+            self.failures[name] = 0 if connected else self.failures[name] + 1
+        if not connected:
+            self._arm(name, self.delay(name))
+
+    def start(self):
+        """
+        Starts supervising, connects to every watched peer.
+        """
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+            self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='Supervisor')
+            names = list(self.watched)
+        self.scheduler.start()
+        for name in names:
+            self._arm(name, 0.0)
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            self.pending.clear()
+            pool, self.pool = self.pool, None
+        self.scheduler.stop()
+        if pool is not None:
+            pool.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        """
+        Gets supervisor counters.
+
+        :return: Dictionary of watched, waiting, attempts and reconnects.
+        """
+        with self.lock:
+            return {'watched': len(self.watched), 'waiting': len(self.pending), 'attempts': self.attempts,
+                    'reconnects': self.reconnects}
@@ -0,0 +1,150 @@
+import collections
+import statistics
+import threading
+import time
+
+
+class HandlerPool(object):
+    policies = ('block', 'drop')
+
+    def __init__(self, workers: int = 4, max_queue: int = 1024, policy: str = 'block', _debug: bool = False):
+        """
+        Initialise HandlerPool, runs message handlers on worker threads instead of the receive loop.
+        Tasks with the same key, the peer name, run one at a time in the order they were submitted,
+        tasks of different peers run in parallel.
+
+        :param workers: Number of worker threads.
+        :param max_queue: Maximum number of tasks waiting to run, across all peers.
+        :param policy: What submit does when the queue is full, 'block' waits for space so the receive loop stops
+                       reading and TCP pushes back on the sender, 'drop' discards the message.
+        :param _debug: If True prints debug information to the console; otherwise no debug information is printed.
+        """
+        if policy not in self.policies:
+            raise Exception('Unknown queue policy {0}, expected one of {1}'.format(policy, self.policies))
+        self.max_queue = max_queue
+        self.policy = policy
+        self._debug = _debug
+
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.pending = {}  # key: deque of (submitted, function, args), present while the key is queued or running
+        self.ready = collections.deque()  # keys with tasks and no task running
+        self.queued = 0
+        self.closed = False
+
+        self.submitted = 0
+        self.completed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.latencies = collections.deque(maxlen=4096)  # Seconds between submit and start of recent tasks
+        self.max_latency = 0.0
+
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.run, name='HandlerPool-{0}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def offer(self, key, function, *args) -> bool:
+        """
+        Queues a task if there is space, never blocks or drops.
+
+        :param key: Tasks with equal keys run in submission order.
+        :param function: Function to run.
+        :param args: Arguments of the function.
+        :return: True if the task was queued; False if the queue is full or the pool is closed.
+        """
+        with self.lock:
+            if self.queued >= self.max_queue or self.closed:
+                return False
+            self._push(key, function, args)
+            return True
+
+    def submit(self, key, function, *args) -> bool:
+        """
+        Queues a task, applying the policy when the queue is full.
+
+        :param key: Tasks with equal keys run in submission order.
+        :param function: Function to run.
+        :param args: Arguments of the function.
+        :return: True if the task was queued; False if it was dropped or the pool is closed.
+        """
+        with self.lock:
+            if self.queued >= self.max_queue and self.policy == 'drop':
+                self.dropped += 1
+                if self._debug:
+                    print('[DROPPED] Message from {0}, handler queue full'.format(key))
+                return False
+            while self.queued >= self.max_queue and not self.closed:
+                self.not_full.wait()
+            if self.closed:
+                return False
+            self._push(key, function, args)
+            return True
+
+    def _push(self, key, function, args: tuple):
+        tasks = self.pending.get(key)
+        if tasks is None:
+            tasks = self.pending[key] = collections.deque()
+            self.ready.append(key)
+            self.not_empty.notify()
+        tasks.append((time.monotonic(), function, args))
+        self.queued += 1
+        self.submitted += 1
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.ready and not self.closed:
+                    self.not_empty.wait()
+                if not self.ready:
+                    return
+                key = self.ready.popleft()
+                submitted, function, args = self.pending[key].popleft()
+                self.queued -= 1
+                self.not_full.notify()
+
+            latency = time.monotonic() - submitted
+            failed = False
+            try:
+                function(*args)
+            except Exception as e:
+                failed = True
+                print(str(e))
+
+            with self.lock:
+                self.completed += 1
+                self.failed += failed
+                self.latencies.append(latency)
+                self.max_latency = max(self.max_latency, latency)
+                if self.pending[key]:
+                    self.ready.append(key)  # Next task of this key, behind keys that were already waiting
+                    self.not_empty.notify()
+                else:
+                    del self.pending[key]
+
+    def close(self):
+        """
+        Stops the workers once every queued task has run, blocked submitters are released.
+        """
+        with self.lock:
+            self.closed = True
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+
+    def stats(self) -> dict:
+        """
+        Gets queue counters and the queue latency of recent tasks.
+
+        :return: Dictionary of submitted, completed, dropped, failed, queued and latency in milliseconds.
+        """
+        with self.lock:
+            latencies = sorted(self.latencies)
+            result = {'submitted': self.submitted, 'completed': self.completed, 'dropped': self.dropped,
+                      'failed': self.failed, 'queued': self.queued, 'max_latency_ms': self.max_latency * 1000}
+        if latencies:
+            result['mean_latency_ms'] = statistics.fmean(latencies) * 1000
+            result['p99_latency_ms'] = latencies[int(0.99 * (len(latencies) - 1))] * 1000
+        return result
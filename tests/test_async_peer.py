@@ -0,0 +1,69 @@
+import threading
+
+import pytest
+
+from AsyncPeer import AsyncClient
+from Modules import PeerModule
+from Peer import Client
+
+pytestmark = pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')  # Listeners sys.exit
+
+
+class EchoModule(PeerModule):
+    prefix = 'ECHO'
+
+    def __init__(self, peer):
+        super().__init__(peer)
+        self.received = []
+        self.event = threading.Event()
+
+    def handle_message(self, name: str, message: str) -> bool:
+        self.received.append((name, message))
+        self.event.set()
+        return True
+
+
+def serve(peer) -> threading.Thread:
+    thread = threading.Thread(target=peer.start, daemon=True)
+    thread.start()
+    assert peer.wait_until_running(5)
+    return thread
+
+
+@pytest.mark.parametrize('options', [{}, {'cipher': 'aes-gcm', 'framing': 'binary', 'schema': True}])
+def test_client_to_async_client(options):
+    server = AsyncClient('a', '127.0.0.1', 15610 + len(options))
+    module = EchoModule(server)
+    thread = serve(module)
+    client = Client('b', '127.0.0.1', 15620 + len(options), **options)
+    client.set_message_handler(client.dispatch_message)
+    client.running = True
+    comm = client.open_connection('127.0.0.1', server.port)
+    try:
+        assert comm is not None and comm.peer_name == 'a'
+        client.send_message('a', 'ECHO-hello')
+        assert module.event.wait(5)
+        assert module.received == [('b', 'ECHO-hello')]
+    finally:
+        client.running = False
+        comm.close_connection()
+        server.stop()
+        thread.join(5)
+
+
+def test_async_client_loopback():
+    server = AsyncClient('a', '127.0.0.1', 15630)
+    module = EchoModule(server)
+    client = AsyncClient('b', '127.0.0.1', 15631, cipher='chacha20-poly1305', mux=True)
+    threads = [serve(module), serve(client)]
+    try:
+        client.open_connection('127.0.0.1', server.port)
+        assert 'a' in client.connections
+        client.send_message('a', 'ECHO-over the loop')
+        assert module.event.wait(5)
+        assert module.received == [('b', 'ECHO-over the loop')]
+    finally:
+        client.stop()
+        server.stop()
+        for thread in threads:
+            thread.join(5)
@@ -0,0 +1,89 @@
+import socket
+import time
+
+from Buffers import OutboundQueue, ReceiveBuffer
+
+
+def test_write_take_round_trip():
+    buffer = ReceiveBuffer(initial_size=16)
+    buffer.write(b'hello ')
+    buffer.write(b'world')
+    assert len(buffer) == 11
+    assert buffer.take(6) == b'hello '
+    assert buffer.take(5) == b'world'
+    assert len(buffer) == 0
+    assert buffer.start == buffer.end == 0
+
+
+def test_write_grows_and_keeps_unread_bytes():
+    buffer = ReceiveBuffer(initial_size=8, min_read=8)
+    buffer.write(b'abcdef')
+    buffer.consume(4)
+    buffer.write(b'0123456789')
+    assert buffer.take(len(buffer)) == b'ef0123456789'
+    assert buffer.resizes >= 1
+
+
+def test_reserve_fits_the_whole_frame():
+    buffer = ReceiveBuffer(initial_size=16, min_read=16)
+    buffer.write(b'xy')
+    buffer.reserve(1000)
+    assert len(buffer.data) - buffer.start >= 1000
+    assert buffer.take(2) == b'xy'
+
+
+def test_recv_into_fills_a_reserved_frame():
+    left, right = socket.socketpair()
+    try:
+        buffer = ReceiveBuffer(initial_size=16, min_read=16)
+        frame = bytes(range(256)) * 20
+        buffer.reserve(len(frame))
+        left.sendall(frame + b'next')
+        while len(buffer) < len(frame):
+            assert buffer.recv_into(right) > 0
+        assert buffer.take(len(frame)) == frame
+        assert b'next'.startswith(buffer.take(len(buffer)))  # Bytes of the next frame stay buffered
+    finally:
+        left.close()
+        right.close()
+
+
+def test_recv_into_returns_zero_when_closed():
+    left, right = socket.socketpair()
+    left.close()
+    try:
+        assert ReceiveBuffer().recv_into(right) == 0
+    finally:
+        right.close()
+
+
+def test_read_size_follows_average_frame_within_limits():
+    buffer = ReceiveBuffer(min_read=1024, max_read=8192)
+    assert buffer.read_size() == 1024
+    for _ in range(100):
+        buffer.observe(100000)
+    assert buffer.read_size() == 8192
+    for _ in range(100):
+        buffer.observe(10)
+    assert buffer.read_size() == 1024
+
+
+def test_slow_peer_does_not_hold_up_deferred_writes():
+    slow, slow_peer = socket.socketpair()
+    fast, fast_peer = socket.socketpair()
+    try:
+        stalled = OutboundQueue(slow)
+        stalled.push_deferred(b'x' * 2 ** 23)  # More than the socket buffers hold, the peer never reads
+        time.sleep(0.05)
+        assert stalled.pending_bytes > 0 and stalled.bytes_sent > 0
+        OutboundQueue(fast).push_deferred(b'ping')
+        fast_peer.settimeout(2)
+        assert fast_peer.recv(4) == b'ping'
+        received = 0
+        slow_peer.settimeout(2)
+        while received < 2 ** 23:
+            received += len(slow_peer.recv(2 ** 20))  # The rest follows once the peer reads
+        assert stalled.pending_bytes == 0 and stalled.frames_sent == 1
+    finally:
+        for connection in (slow, slow_peer, fast, fast_peer):
+            connection.close()
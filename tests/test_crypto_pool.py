@@ -0,0 +1,89 @@
+import socket
+import threading
+import time
+from concurrent.futures import Future
+
+from CommunicationProtocols import CommunicationProtocol
+
+
+class ReversePool(object):
+    """
+    Stands in for CryptoPool, runs the jobs when finish is called, the last submitted first.
+    """
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, function, job) -> Future:
+        future = Future()
+        self.jobs.append((function, job, future))
+        return future
+
+    def finish(self, keep: int = 0):
+        jobs, self.jobs = self.jobs[keep:], self.jobs[:keep]
+        for function, job, future in reversed(jobs):
+            future.set_result(function(job))
+
+
+def connect() -> tuple:
+    left, right = socket.socketpair()
+    client = CommunicationProtocol(left, ('a', 0), 'b', cipher='aes-gcm')
+    server = CommunicationProtocol(right, ('b', 0), 'a')
+    thread = threading.Thread(target=server.establish_encrypted_connection_ss, args=(5,))
+    thread.start()
+    client.establish_encrypted_connection_cs()
+    thread.join(5)
+    server.connection.settimeout(2)
+    return client, server
+
+
+def receive(server: CommunicationProtocol, count: int) -> list:
+    messages = []
+    while len(messages) < count:
+        messages.extend(server.receive_message())
+    return messages
+
+
+def test_sealed_messages_are_sent_in_nonce_order():
+    client, server = connect()
+    pool = client.crypto_pool = ReversePool()
+    try:
+        expected = ['message {0}'.format(i) for i in range(20)]
+        for message in expected:
+            client.send_message(message)
+        pool.finish(keep=1)
+        time.sleep(0.05)
+        assert client.outbound.pending_frames == 0 and client.outbound.frames_sent == 0  # Waiting for the first
+        pool.finish()
+        assert receive(server, len(expected)) == expected
+    finally:
+        client.close_connection()
+        server.close_connection()
+
+
+def test_opened_messages_are_returned_in_nonce_order():
+    client, server = connect()
+    pool = server.crypto_pool = ReversePool()
+    try:
+        expected = ['message {0}'.format(i) for i in range(20)]
+        for message in expected:
+            client.send_message(message)
+        client.outbound.flush()  # Every frame is in the socket buffer once it returns
+        server.connection.settimeout(0.1)
+        data = b''
+        try:
+            while True:
+                data += server.connection.recv(65536)
+        except socket.timeout:
+            pass
+        messages = []
+        thread = threading.Thread(target=lambda: messages.extend(server.process_received(data)))
+        thread.start()
+        while len(pool.jobs) < len(expected):
+            time.sleep(0.001)
+        pool.finish()
+        thread.join(5)
+        assert messages == expected
+    finally:
+        client.close_connection()
+        server.close_connection()
@@ -0,0 +1,60 @@
+import pytest
+
+from Buffers import ReceiveBuffer
+from CommunicationProtocols import BinaryFraming, HELLO_LIMIT
+from Groups import GroupFrame
+
+
+def receive(*chunks) -> ReceiveBuffer:
+    buffer = ReceiveBuffer(initial_size=16)
+    for chunk in chunks:
+        buffer.write(chunk)
+    return buffer
+
+
+def test_frame_split_round_trip():
+    framing = BinaryFraming()
+    payloads = [b'', b'a', b'x' * 5000]
+    buffer = receive(*(b''.join(framing.frame(payload)) for payload in payloads))
+    assert framing.split(buffer) == payloads
+    assert len(buffer) == 0
+
+
+def test_partial_frame_stays_buffered():
+    framing = BinaryFraming()
+    data = b''.join(framing.frame(b'payload'))
+    buffer = receive(data[:6])
+    assert framing.split(buffer) == []
+    assert buffer.expected == len(data)
+    buffer.write(data[6:])
+    assert framing.split(buffer) == [b'payload']
+
+
+def test_split_limit():
+    framing = BinaryFraming()
+    buffer = receive(b''.join(framing.frame(b'one')) + b''.join(framing.frame(b'two')))
+    assert framing.split(buffer, limit=1) == [b'one']
+    assert framing.split(buffer) == [b'two']
+
+
+def test_oversized_frame_is_rejected():
+    framing = BinaryFraming(max_frame_size=HELLO_LIMIT)
+    buffer = receive(BinaryFraming.header.pack(HELLO_LIMIT + 1))
+    with pytest.raises(Exception, match='exceeds limit'):
+        framing.split(buffer)
+
+
+def test_frame_at_the_limit_is_accepted():
+    framing = BinaryFraming(max_frame_size=16)
+    buffer = receive(b''.join(framing.frame(b'x' * 16)))
+    assert framing.split(buffer) == [b'x' * 16]
+
+
+def test_group_frames_only_once_negotiated():
+    framing = BinaryFraming()
+    data = b''.join(BinaryFraming.frame_group(b'sealed'))
+    with pytest.raises(Exception, match='exceeds limit'):
+        framing.split(receive(data))
+    framing.groups = True
+    frames = framing.split(receive(data))
+    assert len(frames) == 1 and isinstance(frames[0], GroupFrame)
@@ -0,0 +1,89 @@
+from Gossip import BloomFilter, Gossip
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(1024, hashes=4, salt=7)
+    items = [BloomFilter.hash('peer-{0}'.format(i)) for i in range(64)]
+    for item in items:
+        bloom.add(item)
+    assert all(item in bloom for item in items)
+
+
+def test_bloom_filter_encode_decode_round_trip():
+    bloom = BloomFilter(100, hashes=3, salt=12345)
+    bloom.add(BloomFilter.hash('a'))
+    decoded = BloomFilter.decode(bloom.encode())
+    assert (decoded.size, decoded.hashes, decoded.salt, decoded.bits) == (104, 3, 12345, bloom.bits)
+    assert BloomFilter.hash('a') in decoded
+
+
+def connect(*peers):
+    """
+    Delivers the messages of gossiping peers to each other synchronously.
+    """
+    by_name = {peer.name: peer for peer in peers}
+    for peer in peers:
+        peer.send = lambda name, message, sender=peer.name: by_name[name].handle(sender, message)
+
+
+def create(name: str, updates: list = None) -> Gossip:
+    return Gossip(name, None, lambda: {}, on_update=lambda peer, address: updates.append((peer, address))
+                  if updates is not None else None)
+
+
+def test_exchange_sends_only_missing_entries():
+    updates = []
+    a, b = create('a'), create('b', updates)
+    connect(a, b)
+    for i in range(50):
+        a.merge('peer-{0}'.format(i), ('10.0.0.{0}'.format(i), 1000 + i), 1)
+        b.merge('peer-{0}'.format(i), ('10.0.0.{0}'.format(i), 1000 + i), 1)
+    a.observe('new', ('10.0.1.1', 2000))
+    a.gossip_with('b')
+    assert ('new', ('10.0.1.1', 2000)) in updates
+    assert a.create_summary() == b.create_summary()
+    assert a.entries_sent <= 2  # Hidden only by a false positive
+
+
+def test_peers_in_sync_only_exchange_the_summary():
+    a, b = create('a'), create('b')
+    connect(a, b)
+    a.observe('x', ('10.0.0.1', 1))
+    b.merge('x', ('10.0.0.1', 1), a.entries['x'][1])
+    a.gossip_with('b')
+    assert a.messages_sent == 1 and b.messages_sent == 0
+
+
+def test_newest_version_wins():
+    gossip = create('a')
+    assert gossip.merge('x', ('10.0.0.1', 1), 5)
+    assert not gossip.merge('x', ('10.0.0.2', 1), 4)
+    assert gossip.entries['x'] == (('10.0.0.1', 1), 5)
+
+
+def test_stale_entry_about_ourselves_is_refuted():
+    gossip = create('a')
+    gossip.observe('a', ('10.0.0.1', 1))
+    version = gossip.entries['a'][1]
+    assert not gossip.merge('a', ('10.6.6.6', 1), version + 10)
+    assert gossip.entries['a'] == (('10.0.0.1', 1), version + 11)
+
+
+def test_unknown_gossip_messages_are_not_handled():
+    gossip = create('a')
+    assert not gossip.handle('b', 'BUILTIN-GOSSIP')
+    assert not gossip.handle('b', 'BUILTIN-GOSSIP-NOPE-x')
+
+
+def test_malformed_gossip_messages_are_not_handled():
+    sent = []
+    gossip = Gossip('a', lambda name, message: sent.append(message), lambda: {})
+    gossip.observe('x', ('10.0.0.1', 1))
+    digest = gossip.create_digest()
+    for message in ('BUILTIN-GOSSIP-DIG-', 'BUILTIN-GOSSIP-DIG-x@1', 'BUILTIN-GOSSIP-DIG-1',
+                    'BUILTIN-GOSSIP-SUM-2@3', 'BUILTIN-GOSSIP-SUM-2@3@4@5@%%%', 'BUILTIN-GOSSIP-SUM-2@3@4@0@AA==',
+                    'BUILTIN-GOSSIP-SUM-2@3@4@5@', 'BUILTIN-GOSSIP-DLT--y@10.0.0.2@port@1',
+                    'BUILTIN-GOSSIP-DLT--y@10.0.0.2', 'BUILTIN-GOSSIP-DLT-1@2-'):
+        assert not gossip.handle('b', message), message
+    assert sent == [] and list(gossip.entries) == ['x']
+    assert gossip.handle('b', 'BUILTIN-GOSSIP-SUM-{0}'.format(digest))
@@ -0,0 +1,38 @@
+from Groups import GROUP_KEY, GroupFrame, Groups
+
+
+def share(sender: Groups, receiver: Groups, group: str):
+    key = sender.key(group)
+    receiver.store('a', GROUP_KEY(group, key.key_id, key.key))
+
+
+def test_seal_open_round_trip():
+    a, b = Groups(), Groups()
+    a.create('g', ['b'])
+    share(a, b, 'g')
+    assert b.open('a', GroupFrame(a.seal('g', 'hello'))) == 'hello'
+    assert b.open('a', GroupFrame(a.seal('g', GROUP_KEY('x', 1, b'k')))) == GROUP_KEY('x', 1, b'k')
+    assert b.open('c', GroupFrame(a.seal('g', 'hello'))) is None  # Key of another peer
+
+
+def test_replayed_and_late_frames_are_rejected():
+    a, b = Groups(), Groups()
+    a.create('g', ['b'])
+    share(a, b, 'g')
+    first = a.seal('g', 'first')
+    later = [a.seal('g', str(i)) for i in range(70)]
+    assert b.open('a', GroupFrame(later[-1])) == '69'
+    assert b.open('a', GroupFrame(later[-1])) is None
+    assert b.open('a', GroupFrame(later[10])) == '10'
+    assert b.open('a', GroupFrame(first)) is None  # Behind the window
+
+
+def test_short_and_forged_frames_are_rejected():
+    a, b = Groups(), Groups()
+    a.create('g', ['b'])
+    share(a, b, 'g')
+    sealed = bytearray(a.seal('g', 'hello'))
+    for size in range(len(sealed)):
+        assert b.open('a', GroupFrame(bytes(sealed[:size]))) is None
+    sealed[-1] ^= 1
+    assert b.open('a', GroupFrame(bytes(sealed))) is None
@@ -0,0 +1,58 @@
+import socket
+import threading
+
+import pytest
+
+from CommunicationProtocols import CommunicationProtocol
+from KeyExchange import backends
+from KeyStore import KeyStore
+
+BACKEND = backends['brainpoolP256r1']
+
+
+def test_peer_key_is_pinned(tmp_path):
+    keystore = KeyStore(str(tmp_path))
+    first, second = BACKEND.generate_keys()[1], BACKEND.generate_keys()[1]
+    assert keystore.get_peer_key('b-', 'a', BACKEND) is None
+    keystore.store_peer_key('b-', 'a', first, BACKEND)
+    keystore.store_peer_key('b-', 'a', first, BACKEND)
+    with pytest.raises(Exception, match='Identity of a changed'):
+        keystore.store_peer_key('b-', 'a', second, BACKEND)
+    stored = KeyStore(str(tmp_path)).get_peer_key('b-', 'a', BACKEND)
+    assert BACKEND.encode_public(stored) == BACKEND.encode_public(first)
+
+
+def handshake(keystore: KeyStore, identity: tuple) -> list:
+    """
+    Runs a handshake of client b, trusting keystore, with server a presenting identity.
+
+    :return: Exceptions of the client and the server.
+    """
+    left, right = socket.socketpair()
+    client = CommunicationProtocol(left, ('a', 0), 'b', cipher='aes-gcm', keystore=keystore, file_prefix='b-')
+    server = CommunicationProtocol(right, ('b', 0), 'a', *identity)
+    errors = [None, None]
+
+    def run(index, establish, *args):
+        try:
+            establish(*args)
+        except Exception as e:
+            errors[index] = e
+        finally:
+            (client, server)[index].close_connection()
+    thread = threading.Thread(target=run, args=(1, server.establish_encrypted_connection_ss, 5))
+    thread.start()
+    run(0, client.establish_encrypted_connection_cs)
+    thread.join(5)
+    return errors
+
+
+def test_handshake_with_a_changed_identity_is_rejected():
+    keystore = KeyStore()
+    identity = CommunicationProtocol.generate_keys()
+    assert handshake(keystore, identity) == [None, None]
+    assert handshake(keystore, identity) == [None, None]
+    client_error, _ = handshake(keystore, CommunicationProtocol.generate_keys())
+    assert 'Identity of a changed' in str(client_error)
+    stored = keystore.get_peer_key('b-', 'a', BACKEND)
+    assert BACKEND.encode_public(stored) == BACKEND.encode_public(identity[1])
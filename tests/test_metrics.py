@@ -0,0 +1,45 @@
+import json
+import socket
+
+import pytest
+
+from Metrics import MetricsServer
+
+
+def get(path: str) -> dict:
+    client = socket.socket(socket.AF_UNIX)
+    client.connect(path)
+    client.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+    response = b''
+    while True:
+        data = client.recv(65536)
+        if not data:
+            break
+        response += data
+    client.close()
+    return json.loads(response.split(b'\r\n\r\n', 1)[1])
+
+
+def test_stale_socket_is_replaced(tmp_path):
+    path = str(tmp_path / 'metrics.sock')
+    stale = socket.socket(socket.AF_UNIX)
+    stale.bind(path)
+    stale.close()
+    server = MetricsServer(lambda: {'messages': 1}, path)
+    try:
+        assert get(path) == {'messages': 1}
+    finally:
+        server.close()
+
+
+def test_other_files_are_not_removed(tmp_path):
+    path = tmp_path / 'metrics.sock'
+    path.write_text('keep')
+    with pytest.raises(Exception, match='not a socket'):
+        MetricsServer(dict, str(path))
+    assert path.read_text() == 'keep'
+    link = tmp_path / 'link'
+    link.symlink_to(path)
+    with pytest.raises(Exception, match='not a socket'):
+        MetricsServer(dict, str(link))
+    assert link.is_symlink()
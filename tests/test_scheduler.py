@@ -0,0 +1,90 @@
+import threading
+import time
+
+from Scheduler import Scheduler
+
+
+def collect():
+    fired = []
+    done = threading.Event()
+
+    def on_expire(timer_id, data):
+        fired.append(data)
+        done.set()
+    return fired, done, on_expire
+
+
+def test_timers_fire_in_due_order():
+    fired, _, on_expire = collect()
+    scheduler = Scheduler(on_expire)
+    scheduler.schedule(0.06, 'third')
+    scheduler.schedule(0.02, 'first')
+    scheduler.schedule(0.04, 'second')
+    scheduler.start()
+    try:
+        deadline = time.monotonic() + 2
+        while len(fired) < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        scheduler.stop()
+    assert fired == ['first', 'second', 'third']
+    assert len(scheduler) == 0
+
+
+def test_cancelled_timer_does_not_fire():
+    fired, done, on_expire = collect()
+    scheduler = Scheduler(on_expire)
+    cancelled = scheduler.schedule(0.01, 'cancelled')
+    scheduler.schedule(0.05, 'kept')
+    assert scheduler.cancel(cancelled)
+    assert not scheduler.cancel(cancelled)
+    assert scheduler.remaining(cancelled) is None
+    scheduler.start()
+    try:
+        assert done.wait(2)
+    finally:
+        scheduler.stop()
+    assert fired == ['kept']
+
+
+def test_heap_is_rebuilt_after_many_cancels():
+    scheduler = Scheduler(lambda timer_id, data: None)
+    ids = [scheduler.schedule(60) for _ in range(3000)]
+    for timer_id in ids[:2500]:
+        scheduler.cancel(timer_id)
+    assert len(scheduler) == 500
+    assert len(scheduler.heap) < 3000
+
+
+def test_failing_callback_does_not_stop_the_scheduler():
+    fired = []
+
+    def on_expire(timer_id, data):
+        if data == 'fail':
+            raise Exception('handler failed')
+        fired.append(data)
+    scheduler = Scheduler(on_expire)
+    scheduler.schedule(0.01, 'fail')
+    scheduler.schedule(0.03, 'after')
+    scheduler.start()
+    try:
+        deadline = time.monotonic() + 2
+        while not fired and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        scheduler.stop()
+    assert fired == ['after']
+
+
+def test_persistent_timers_survive_a_restart(tmp_path):
+    path = str(tmp_path / 'timers.json')
+    scheduler = Scheduler(lambda timer_id, data: None, path=path)
+    kept = scheduler.schedule(60, {'unit': 'MINUTES'})
+    scheduler.schedule(60, 'memory only', persistent=False)
+    scheduler.stop()
+
+    restored = Scheduler(lambda timer_id, data: None, path=path)
+    assert len(restored) == 1
+    assert 55 < restored.remaining(kept) <= 60
+    assert restored.timers[kept][1] == {'unit': 'MINUTES'}
+    assert restored.schedule(1) > kept
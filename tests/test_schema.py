@@ -0,0 +1,87 @@
+import pytest
+
+from Schema import ENVELOPE, Schema
+
+
+@pytest.fixture
+def schema():
+    schema = Schema()
+    schema.register(1, 'TEST-PING')
+    schema.register(2, 'TEST-TIMER', ('length', 'int'), ('unit', 'str'))
+    schema.register(3, 'TEST-BLOB', ('ratio', 'float'), ('data', 'bytes'), ('port', 'u16'))
+    schema.register(4, 'TEST-PEERS', ('peers', (('name', 'str'), ('ip', 'str'), ('port', 'u16'))))
+    return schema
+
+
+def messages(schema):
+    return [schema.by_text['TEST-PING'](),
+            schema.by_text['TEST-TIMER'](5, 'MINUTES'),
+            schema.by_text['TEST-TIMER'](2 ** 40, 'with-dash and ünïcode'),
+            schema.by_text['TEST-BLOB'](0.5, bytes(range(256)), 65535),
+            schema.by_text['TEST-PEERS']([]),
+            schema.by_text['TEST-PEERS']([('a', '10.0.0.1', 1), ('b\x00c', '::1', 2), ('d' * 70000, '', 3)])]
+
+
+def test_binary_round_trip(schema):
+    for message in messages(schema) + [schema.by_text['TEST-TIMER'](-1, 'SECONDS')]:
+        encoded = schema.encode(message)
+        assert encoded[:1] == ENVELOPE
+        assert schema.decode(encoded) == message
+
+
+def test_text_round_trip(schema):
+    for message in messages(schema):
+        assert schema.parse_text(str(message)) == message
+    peers = schema.by_text['TEST-PEERS']([('a', '10.0.0.1', 1), ('b', '10.0.0.2', 2)])
+    assert schema.parse_text(str(peers)) == peers
+    assert str(peers) == 'TEST-PEERS-a@10.0.0.1@1>b@10.0.0.2@2'
+
+
+def test_separators_in_values_are_escaped(schema):
+    schema.register(5, 'TEST-PAIR', ('first', 'str'), ('second', 'int'), ('ratio', 'float'))
+    for message in (schema.by_text['TEST-PAIR']('a-b', -1, -2.5e-07), schema.by_text['TEST-PAIR']('%2D-%', 0, 1.0),
+                    schema.by_text['TEST-TIMER'](-5, '-'), schema.by_text['TEST-PEERS']([('a@b>c', '::1', 1)])):
+        text = str(message)
+        assert text.count('-') == len(message.command.text.split('-')) + len(message) - 1
+        assert schema.parse_text(text) == message
+    assert schema.parse_text('TEST-TIMER-5-with-dash') == schema.by_text['TEST-TIMER'](5, 'with-dash')
+
+
+def test_text_that_does_not_parse(schema):
+    assert schema.parse_text('TEST-TIMER-five-MINUTES') is None
+    assert schema.parse_text('TEST-TIMER') is None
+    assert schema.parse_text('OTHER-TIMER-5-MINUTES') is None
+    assert schema.parse_text('TEST-PING-extra') is None
+
+
+def test_unknown_command_decodes_to_none(schema):
+    assert schema.decode(ENVELOPE + b'\x00\x63') is None
+
+
+def test_truncated_messages_decode_to_none(schema):
+    for message in messages(schema):
+        encoded = bytes(schema.encode(message))
+        for size in range(len(encoded)):
+            assert schema.decode(encoded[:size]) is None
+
+
+def test_malformed_messages_decode_to_none(schema):
+    peers = bytearray(schema.encode(messages(schema)[-1]))
+    header = 1 + schema.by_id[4].format.size
+    peers[header] = ord('x')  # Unknown column code
+    assert schema.decode(peers) is None
+    timer = bytearray(schema.encode(messages(schema)[1]))
+    timer[-3] = 0xff  # Invalid UTF-8
+    assert schema.decode(timer) is None
+
+
+def test_duplicate_registration(schema):
+    with pytest.raises(Exception, match='already registered'):
+        schema.register(1, 'TEST-OTHER')
+    with pytest.raises(Exception, match='already registered'):
+        schema.register(9, 'TEST-PING')
+
+
+def test_unknown_field_type():
+    with pytest.raises(Exception, match='Unknown field type'):
+        Schema().register(1, 'TEST-BAD', ('value', 'complex'))
@@ -0,0 +1,94 @@
+import socket
+import threading
+import time
+
+from CommunicationProtocols import CommunicationProtocol
+from KeyExchange import backends
+from Sessions import SessionCache
+
+
+def test_store_get_round_trip():
+    cache = SessionCache()
+    cache.store('peer', b'secret')
+    session = cache.get('peer')
+    assert session.secret == b'secret'
+    assert session.ticket == SessionCache.derive_ticket(b'secret')
+    assert cache.get('other') is None
+
+
+def test_ticket_resumes_only_once():
+    cache = SessionCache()
+    cache.store('peer', b'secret')
+    ticket = cache.get('peer').ticket
+    assert cache.pop_ticket(ticket).peer_name == 'peer'
+    assert cache.pop_ticket(ticket) is None
+    assert cache.get('peer') is None
+
+
+def test_store_replaces_the_previous_ticket():
+    cache = SessionCache()
+    cache.store('peer', b'first')
+    old = cache.get('peer').ticket
+    cache.store('peer', b'second')
+    assert cache.pop_ticket(old) is None
+    assert len(cache) == 1
+
+
+def test_least_recently_used_is_evicted():
+    cache = SessionCache(max_sessions=2)
+    cache.store('a', b'1')
+    cache.store('b', b'2')
+    cache.get('a')
+    cache.store('c', b'3')
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+
+
+def test_expired_sessions_are_not_resumed():
+    cache = SessionCache(ttl=0.01)
+    cache.store('a', b'1')
+    cache.store('b', b'2')
+    ticket = cache.get('b').ticket
+    time.sleep(0.02)
+    assert cache.get('a') is None
+    assert cache.pop_ticket(ticket) is None
+
+
+def test_unknown_ticket():
+    assert SessionCache().pop_ticket('0' * 32) is None
+
+
+def handshake(client_cache: SessionCache, server_cache: SessionCache, identities: dict) -> tuple:
+    left, right = socket.socketpair()
+    client = CommunicationProtocol(left, ('a', 0), 'b', *identities['b'], session_cache=client_cache,
+                                   resume_peer='a')
+    server = CommunicationProtocol(right, ('b', 0), 'a', *identities['a'], session_cache=server_cache)
+    thread = threading.Thread(target=server.establish_encrypted_connection_ss, args=(5,))
+    thread.start()
+    client.establish_encrypted_connection_cs()
+    thread.join(5)
+    return client, server
+
+
+def test_resumed_handshake_takes_one_round_trip_without_key_exchange(monkeypatch):
+    client_cache, server_cache = SessionCache(), SessionCache()
+    identities = {name: CommunicationProtocol.generate_keys() for name in 'ab'}  # Held by the peers
+    for comm in handshake(client_cache, server_cache, identities):
+        comm.close_connection()
+    multiplications = []
+    for backend in backends.values():
+        for method in ('generate_keys', 'shared_secret'):
+            def count(*args, _method=getattr(backend, method)):
+                multiplications.append(_method)
+                return _method(*args)
+            monkeypatch.setattr(backend, method, count)
+    client, server = handshake(client_cache, server_cache, identities)
+    try:
+        assert client.resumed is not None and server.resumed is not None
+        assert multiplications == []
+        assert client.pipelined() and server.pipelined()  # The server acked with its hello
+        client.send_message('resumed')
+        assert server.receive_message() == ['resumed']
+    finally:
+        client.close_connection()
+        server.close_connection()
@@ -0,0 +1,48 @@
+import multiprocessing
+
+import pytest
+
+from Shards import RoutingTable
+
+
+def test_set_get_release():
+    table = RoutingTable(slots=64)
+    assert table.get('peer') is None
+    table.set('peer', 2)
+    assert table.get('peer') == 2
+    assert not table.release('peer', 1)  # Taken over by another shard
+    assert table.get('peer') == 2
+    assert table.release('peer', 2)
+    assert table.get('peer') is None
+
+
+def test_released_slot_is_reused_by_the_same_peer():
+    table = RoutingTable(slots=2)
+    table.set('a', 0)
+    table.release('a', 0)
+    table.set('b', 1)
+    table.set('a', 1)
+    assert table.get('a') == 1 and table.get('b') == 1
+
+
+def test_full_table():
+    table = RoutingTable(slots=2)
+    table.set('a', 0)
+    table.set('b', 0)
+    assert table.get('c') is None
+    with pytest.raises(Exception, match='full'):
+        table.set('c', 0)
+
+
+def _claim(table: RoutingTable, name: str, shard: int):
+    table.set(name, shard)
+
+
+def test_routes_are_shared_with_forked_processes():
+    context = multiprocessing.get_context('fork')
+    table = RoutingTable(slots=64, lock=context.Lock())
+    process = context.Process(target=_claim, args=(table, 'peer', 3))
+    process.start()
+    process.join(10)
+    assert process.exitcode == 0
+    assert table.get('peer') == 3
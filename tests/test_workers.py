@@ -0,0 +1,91 @@
+import threading
+import time
+
+import pytest
+
+from Workers import HandlerPool
+
+
+def wait_for(condition, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+
+def test_tasks_of_one_key_run_in_order():
+    pool = HandlerPool(workers=4)
+    order = {key: [] for key in 'abc'}
+
+    def handle(key, i):
+        time.sleep(0.001 * ((i * 7) % 3))  # Uneven durations, later tasks would overtake without ordering
+        order[key].append(i)
+    for i in range(50):
+        for key in order:
+            pool.submit(key, handle, key, i)
+    assert wait_for(lambda: pool.stats()['completed'] == 150)
+    pool.close()
+    assert all(values == list(range(50)) for values in order.values())
+
+
+def test_keys_run_in_parallel():
+    pool = HandlerPool(workers=2)
+    blocked = threading.Event()
+    ran = threading.Event()
+    pool.submit('slow', blocked.wait, 5)
+    pool.submit('fast', ran.set)
+    assert ran.wait(2)
+    blocked.set()
+    pool.close()
+
+
+def test_drop_policy_when_full():
+    pool = HandlerPool(workers=1, max_queue=1, policy='drop')
+    blocked = threading.Event()
+    pool.submit('a', blocked.wait, 5)
+    assert wait_for(lambda: pool.stats()['queued'] == 0)
+    assert pool.submit('a', lambda: None)
+    assert not pool.submit('a', lambda: None)
+    assert not pool.offer('b', lambda: None)
+    blocked.set()
+    pool.close()
+    assert pool.stats()['dropped'] == 1
+
+
+def test_block_policy_waits_for_space():
+    pool = HandlerPool(workers=1, max_queue=1)
+    blocked = threading.Event()
+    pool.submit('a', blocked.wait, 5)
+    assert wait_for(lambda: pool.stats()['queued'] == 0)
+    pool.submit('a', lambda: None)
+    submitted = threading.Event()
+    threading.Thread(target=lambda: pool.submit('b', lambda: None) and submitted.set(), daemon=True).start()
+    assert not submitted.wait(0.1)
+    blocked.set()
+    assert submitted.wait(2)
+    pool.close()
+
+
+def test_failing_task_is_counted_and_the_key_continues():
+    pool = HandlerPool(workers=1)
+    ran = threading.Event()
+
+    def fail():
+        raise Exception('handler failed')
+    pool.submit('a', fail)
+    pool.submit('a', ran.set)
+    assert ran.wait(2)
+    assert wait_for(lambda: pool.stats()['failed'] == 1)
+    pool.close()
+
+
+def test_closed_pool_refuses_tasks():
+    pool = HandlerPool(workers=1)
+    pool.close()
+    assert not pool.submit('a', lambda: None)
+    assert not pool.offer('a', lambda: None)
+
+
+def test_unknown_policy():
+    with pytest.raises(Exception, match='Unknown queue policy'):
+        HandlerPool(workers=0, policy='spill')